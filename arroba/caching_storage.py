@@ -0,0 +1,248 @@
+"""Read-through caching wrapper for any :class:`Storage`."""
+import logging
+from threading import Lock
+
+from cachetools import LRUCache
+
+from .storage import Block, Storage
+
+logger = logging.getLogger(__name__)
+
+# default maximum total sizes of the two tiers, in bytes
+ENCODED_CACHE_SIZE = 64 * 1024 * 1024
+DECODED_CACHE_SIZE = 64 * 1024 * 1024
+
+# approximate per-entry memory overhead of a cached block's CID, metadata, and
+# cache bookkeeping, in bytes
+BLOCK_OVERHEAD = 300
+
+# approximate ratio of a decoded object's size in memory to its DAG-CBOR size
+DECODED_SIZE_FACTOR = 8
+
+
+class CachingStorage(Storage):
+    """Wraps another :class:`Storage` and caches the blocks it reads, by CID.
+
+    Blocks are content-addressed and immutable, so cached entries never need to
+    be invalidated. There are two tiers, each an LRU cache bounded by bytes:
+
+    * *encoded*: each block's DAG-CBOR bytes and metadata. Filled on every read
+      from the wrapped storage.
+    * *decoded*: each block's decoded object, so hot blocks aren't decoded
+      again on every read. Filled when a block is read from the encoded tier,
+      ie on its second read, and by :meth:`apply_commit`.
+
+    :meth:`read_many` serves what it can from the cache and reads all misses
+    with a single :meth:`Storage.read_many` call to the wrapped storage.
+
+    Every read returns a new :class:`Block`, so callers can't modify cached
+    metadata like ``seq``. Decoded objects are shared, though, so callers
+    shouldn't modify them.
+
+    :meth:`read_blocks_by_seq` and everything else that isn't a single block
+    read passes through to the wrapped storage uncached.
+
+    Thread safe.
+
+    Attributes:
+      storage (Storage): the wrapped storage
+      encoded (cachetools.LRUCache): maps CID to :class:`Block`
+      decoded (cachetools.LRUCache): maps CID to (int size, decoded object)
+      hits (int): number of blocks served from cache
+      decoded_hits (int): number of blocks served from cache already decoded
+      misses (int): number of blocks read from the wrapped storage
+    """
+    def __init__(self, storage, *, encoded_size=ENCODED_CACHE_SIZE,
+                 decoded_size=DECODED_CACHE_SIZE):
+        """Constructor.
+
+        Args:
+          storage (Storage): the storage to wrap
+          encoded_size (int): maximum total size of the encoded tier, in bytes
+          decoded_size (int): maximum total size of the decoded tier, in bytes
+        """
+        super().__init__()
+        self.storage = storage
+        self.encoded = LRUCache(
+            maxsize=encoded_size,
+            getsizeof=lambda block: BLOCK_OVERHEAD + len(block.encoded))
+        self.decoded = LRUCache(maxsize=decoded_size,
+                                getsizeof=lambda entry: entry[0])
+        self.lock = Lock()
+        self.hits = self.decoded_hits = self.misses = 0
+
+    @property
+    def head(self):
+        return self.storage.head
+
+    @head.setter
+    def head(self, head):
+        self.storage.head = head
+
+    def _add(self, block, decode=False):
+        """Adds a block to the encoded tier and optionally the decoded tier.
+
+        Skips tiers that the block is too big for.
+
+        Args:
+          block (Block)
+          decode (bool): whether to also add its decoded object
+        """
+        entry = Block(cid=block.cid, encoded=block.encoded, seq=block.seq,
+                      ops=block.ops, time=block.time, repo=block.repo)
+        with self.lock:
+            if self.encoded.getsizeof(entry) <= self.encoded.maxsize:
+                self.encoded[block.cid] = entry
+            if decode:
+                size = BLOCK_OVERHEAD + len(block.encoded) * DECODED_SIZE_FACTOR
+                if size <= self.decoded.maxsize:
+                    self.decoded[block.cid] = (size, block.decoded)
+
+    def _get(self, cid):
+        """Returns a new :class:`Block` for a cached CID, or None if it's not cached.
+
+        Promotes blocks that are only in the encoded tier to the decoded tier.
+
+        Args:
+          cid (CID)
+
+        Returns:
+          Block or None:
+        """
+        with self.lock:
+            entry = self.encoded.get(cid)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            decoded = self.decoded.get(cid)
+            if decoded:
+                self.decoded_hits += 1
+
+        block = Block(cid=cid, encoded=entry.encoded,
+                      decoded=decoded[1] if decoded else None, seq=entry.seq,
+                      ops=entry.ops, time=entry.time, repo=entry.repo)
+        if not decoded:
+            self._add(block, decode=True)
+        return block
+
+    def _wrap(self, repo):
+        """Points a :class:`Repo` loaded by the wrapped storage at this cache.
+
+        Args:
+          repo (Repo or None)
+
+        Returns:
+          Repo or None:
+        """
+        if repo:
+            repo.storage = repo.mst.storage = self
+        return repo
+
+    def clear(self):
+        """Empties both tiers and resets the counters."""
+        with self.lock:
+            self.encoded.clear()
+            self.decoded.clear()
+            self.hits = self.decoded_hits = self.misses = 0
+
+    def stats(self):
+        """Returns the current counters and sizes.
+
+        Returns:
+          dict: with int values for ``hits``, ``decoded_hits``, ``misses``,
+          ``blocks``, ``encoded_size``, ``decoded_size``, and float value for
+          ``hit_rate``
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'decoded_hits': self.decoded_hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'blocks': len(self.encoded),
+            'encoded_size': self.encoded.currsize,
+            'decoded_size': self.decoded.currsize,
+        }
+
+    def create_repo(self, repo, *, signing_key, rotation_key=None):
+        self.storage.create_repo(repo, signing_key=signing_key,
+                                 rotation_key=rotation_key)
+
+    def load_repo(self, did_or_handle, *, with_keys=True):
+        return self._wrap(self.storage.load_repo(did_or_handle,
+                                                 with_keys=with_keys))
+
+    def load_repos(self, after=None, limit=500):
+        return [self._wrap(repo)
+                for repo in self.storage.load_repos(after=after, limit=limit)]
+
+    def _set_repo_status(self, repo, status):
+        self.storage._set_repo_status(repo, status)
+
+    def write_event(self, repo, type, **kwargs):
+        return self.storage.write_event(repo, type, **kwargs)
+
+    def read(self, cid):
+        if block := self._get(cid):
+            return block
+
+        block = self.storage.read(cid)
+        if block:
+            self._add(block)
+        return block
+
+    def read_many(self, cids, require_all=True):
+        found = {cid: self._get(cid) for cid in cids}
+
+        if missing := [cid for cid, block in found.items() if block is None]:
+            for cid, block in self.storage.read_many(missing).items():
+                found[cid] = block
+                if block:
+                    self._add(block)
+
+        return found
+
+    def read_blocks_by_seq(self, start=0, repo=None):
+        return self.storage.read_blocks_by_seq(start=start, repo=repo)
+
+    def has(self, cid):
+        with self.lock:
+            if cid in self.encoded:
+                return True
+        return self.storage.has(cid)
+
+    def has_many(self, cids):
+        with self.lock:
+            found = {cid: cid in self.encoded for cid in cids}
+
+        if missing := [cid for cid, has in found.items() if not has]:
+            found.update(self.storage.has_many(missing))
+
+        return found
+
+    def write(self, repo_did, obj, seq=None):
+        return self.storage.write(repo_did, obj, seq=seq)
+
+    def apply_commit(self, commit_data):
+        """Writes a commit to the wrapped storage and caches its blocks.
+
+        Blocks that were already stored keep their original ``seq`` in storage,
+        so only caches the blocks that are new.
+
+        Args:
+          commit_data (CommitData)
+        """
+        stored = self.has_many(commit_data.blocks.keys())
+        self.storage.apply_commit(commit_data)
+
+        for cid, block in commit_data.blocks.items():
+            if not stored[cid]:
+                self._add(block, decode=True)
+
+    def allocate_seq(self, nsid):
+        return self.storage.allocate_seq(nsid)
+
+    def last_seq(self, nsid):
+        return self.storage.last_seq(nsid)
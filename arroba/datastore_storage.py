@@ -5,7 +5,9 @@ import json
 import logging
 import mimetypes
 import requests
+from threading import Lock
 
+from cachetools import TTLCache
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import ec
 import dag_cbor
@@ -32,6 +34,16 @@ from .util import (
 
 logger = logging.getLogger(__name__)
 
+# max number of values in a native IN query filter
+# https://cloud.google.com/datastore/docs/concepts/queries#in
+MAX_IN_VALUES = 30
+
+# max number of repos in DatastoreStorage's repo cache, if it's enabled
+REPO_CACHE_SIZE = 10000
+
+# default number of blocks per query page in DatastoreStorage.read_blocks_by_seq
+BLOCKS_PAGE_SIZE = 500
+
 
 class WriteOnce:
     """:class:`ndb.Property` mix-in, prevents changing it once it's set."""
@@ -67,18 +79,6 @@ class JsonProperty(ndb.TextProperty):
         return json.loads(value)
 
 
-class ComputedJsonProperty(JsonProperty, ndb.ComputedProperty):
-    """Custom :class:`ndb.ComputedProperty` for JSON values that stores them as
-    strings.
-
-    ...instead of like :class:`ndb.StructuredProperty`, with "entity" type, which
-    bloats them unnecessarily in the datastore.
-    """
-    def __init__(self, *args, **kwargs):
-        kwargs['indexed'] = False
-        super().__init__(*args, **kwargs)
-
-
 class WriteOnceBlobProperty(WriteOnce, ndb.BlobProperty):
     pass
 
@@ -150,7 +150,10 @@ class AtpBlock(ndb.Model):
     Properties:
     * repo (str): DID of the first repo that included this block
     * encoded (bytes): DAG-CBOR encoded value
-    * data (dict): DAG-JSON value, only used for human debugging
+    * decoded (dict): DAG-JSON value, only used for human debugging. Set once,
+      when the entity is constructed with ``encoded``, unless
+      ``store_decoded=False``, and never recomputed, so reading it doesn't
+      decode anything and puts of loaded entities keep what was stored.
     * seq (int): sequence number for the subscribeRepos event stream
     """
     repo = ndb.KeyProperty(AtpRepo, required=True)
@@ -158,18 +161,26 @@ class AtpBlock(ndb.Model):
     seq = ndb.IntegerProperty(required=True)
     ops = ndb.StructuredProperty(CommitOp, repeated=True)
 
+    decoded = JsonProperty()
+
     created = ndb.DateTimeProperty(auto_now_add=True)
 
-    @ComputedJsonProperty
-    def decoded(self):
-        return json.loads(dag_json.encode(dag_cbor.decode(self.encoded)))
+    def __init__(self, *args, store_decoded=True, **kwargs):
+        """Constructor.
+
+        Args:
+          store_decoded (bool): whether to set ``decoded`` from ``encoded``
+        """
+        super().__init__(*args, **kwargs)
+        if store_decoded and self.encoded is not None and self.decoded is None:
+            self.decoded = json.loads(dag_json.encode(dag_cbor.decode(self.encoded)))
 
     @property
     def cid(self):
         return CID.decode(self.key.id())
 
     @staticmethod
-    def create(*, repo_did, data, seq):
+    def create(*, repo_did, data, seq, store_decoded=True):
         """Writes a new AtpBlock to the datastore.
 
         If the block already exists in the datastore, leave it untouched.
@@ -180,6 +191,7 @@ class AtpBlock(ndb.Model):
           repo_did (str):
           data (dict): value
           seq (int):
+          store_decoded (bool): whether to store the ``decoded`` JSON copy
 
         Returns:
           :class:`AtpBlock`
@@ -191,7 +203,8 @@ class AtpBlock(ndb.Model):
 
         repo_key = ndb.Key(AtpRepo, repo_did)
         atp_block = AtpBlock.get_or_insert(cid.encode('base32'), repo=repo_key,
-                                           encoded=encoded, seq=seq)
+                                           encoded=encoded, seq=seq,
+                                           store_decoded=store_decoded)
         assert atp_block.seq <= seq
         return atp_block
 
@@ -208,12 +221,13 @@ class AtpBlock(ndb.Model):
                      time=self.created, repo=self.repo)
 
     @classmethod
-    def from_block(cls, *, repo_did, block):
+    def from_block(cls, *, repo_did, block, store_decoded=True):
         """Converts a :class:`Block` to an :class:`AtpBlock`.
 
         Args:
           repo_did (str)
           block (Block)
+          store_decoded (bool): whether to store the ``decoded`` JSON copy
 
         Returns:
           AtpBlock
@@ -224,7 +238,7 @@ class AtpBlock(ndb.Model):
         created = block.time.astimezone(timezone.utc).replace(tzinfo=None)
         return AtpBlock(id=block.cid.encode('base32'), encoded=block.encoded,
                         repo=ndb.Key(AtpRepo, repo_did), seq=block.seq, ops=ops,
-                        created=created)
+                        created=created, store_decoded=store_decoded)
 
 
 class AtpSequence(ndb.Model):
@@ -246,7 +260,6 @@ class AtpSequence(ndb.Model):
     updated = ndb.DateTimeProperty(auto_now=True)
 
     @classmethod
-    @ndb.transactional()
     def allocate(cls, nsid):
         """Returns the next sequence number for a given NSID.
 
@@ -259,9 +272,27 @@ class AtpSequence(ndb.Model):
         Returns:
           integer, next sequence number for this NSID
         """
+        return cls.allocate_many(nsid, 1)
+
+    @classmethod
+    @ndb.transactional()
+    def allocate_many(cls, nsid, num):
+        """Reserves a block of consecutive sequence numbers for a given NSID.
+
+        Creates a new :class:`AtpSequence` entity if one doesn't already exist
+        for the given NSID.
+
+        Args:
+          nsid (str): the subscription XRPC method for these sequence numbers
+          num (int): how many sequence numbers to reserve
+
+        Returns:
+          integer, first sequence number in the block
+        """
+        assert num >= 1
         seq = AtpSequence.get_or_insert(nsid, next=1)
         ret = seq.next
-        seq.next += 1
+        seq.next += num
         seq.put()
         return ret
 
@@ -399,20 +430,83 @@ class DatastoreStorage(Storage):
     in a given commit will have the same sequence number. They're currently
     sequential counters, starting at 1, stored in an :class:`AtpSequence` entity.
 
+    If ``seq_block_size`` is more than 1, this process leases blocks of that
+    many sequence numbers at a time from :class:`AtpSequence` and hands them
+    out from memory, so most allocations don't need a datastore transaction.
+    Unused numbers in the last leased block become gaps, which
+    ``subscribeRepos`` waits out and skips.
+
+    Leasing does not scale writes across multiple processes. It only saves
+    datastore transactions within a single writer process. Sequence numbers
+    are also commit revs, and with multiple writers, a process can hand out a
+    number from an older block after another process has used a number from a
+    newer one. Live ``subscribeRepos`` streams that have already moved past
+    the lower number never deliver that commit, and a repo's later commit can
+    get a lower rev than its earlier commit. When leasing, :meth:`apply_commit`
+    raises :class:`ValueError` for those instead of letting the repo's rev go
+    backwards, so those writes fail. With multiple writer processes, keep
+    ``seq_block_size`` at 1.
+
+    :attr:`AtpBlock.decoded` stores a DAG-JSON copy of each block for
+    debugging, which costs CPU and storage on every write. ``store_decoded``
+    controls which blocks get it: True for all blocks, ``'records'`` for only
+    records, False for none. Blocks are read from ``encoded`` either way.
+
+    If ``repo_cache_ttl`` is set, :meth:`load_repo` caches each repo's
+    :class:`AtpRepo`, head commit block, and parsed keys for that long. The
+    cache is per process, and entries are only invalidated when this process
+    changes the repo, so other processes' changes may take up to
+    ``repo_cache_ttl`` to be seen. Only loads with ``with_keys=False``, which
+    are read only, use the cached head; loads with keys always read the
+    current head. :meth:`apply_commit` also raises :class:`ValueError` if a
+    commit's ``prev`` isn't the repo's current head.
+
     See :class:`Storage` for method details.
     """
     ndb_client = None
+    seq_block_size = None
+    store_decoded = None
+    blocks_page_size = None
 
-    def __init__(self, *, ndb_client=None):
+    def __init__(self, *, ndb_client=None, seq_block_size=1, repo_cache_ttl=None,
+                 store_decoded=True, blocks_page_size=BLOCKS_PAGE_SIZE):
         """Constructor.
 
         Args:
           ndb_client (google.cloud.ndb.Client): used in :meth:`read_blocks_by_seq`;
             it's used in the `subscribeRepos` event subscription, so lexrpc calls
             it on a different thread, so it needs its own ndb client context.
+          seq_block_size (int): how many sequence numbers to lease from the
+            datastore at a time. Defaults to 1, ie no leasing. Only set this
+            higher if this is the only process that writes to the datastore!
+            Leasing doesn't scale writes across processes.
+          repo_cache_ttl (datetime.timedelta): how long to cache repos loaded
+            by :meth:`load_repo`. Defaults to None, ie no caching.
+          store_decoded (bool or str): which blocks to store
+            :attr:`AtpBlock.decoded` for: True for all, ``'records'`` for only
+            records, False for none. Defaults to True.
+          blocks_page_size (int): how many blocks :meth:`read_blocks_by_seq`
+            fetches per query page
         """
         super().__init__()
+        assert seq_block_size >= 1
+        assert store_decoded in (True, False, 'records'), store_decoded
+        assert blocks_page_size >= 1
         self.ndb_client = ndb_client
+        self.seq_block_size = seq_block_size
+        self.store_decoded = store_decoded
+        self.blocks_page_size = blocks_page_size
+        # maps NSID to [next, last] leased sequence numbers
+        self._seq_leases = {}
+        self._seq_lock = Lock()
+
+        # maps DID and handle to dict with AtpRepo, head Block, and parsed
+        # signing and rotation keys (tuple, or None if they haven't been parsed)
+        self._repo_cache = None
+        if repo_cache_ttl:
+            self._repo_cache = TTLCache(maxsize=REPO_CACHE_SIZE,
+                                        ttl=repo_cache_ttl.total_seconds())
+        self._repo_cache_lock = Lock()
 
     def ndb_context(fn):
         @wraps(fn)
@@ -453,24 +547,78 @@ class DatastoreStorage(Storage):
                            status=repo.status)
         atp_repo.put()
         logger.info(f'Stored repo {atp_repo}')
+        self._invalidate_repo(repo.did)
 
     @ndb_context
-    def load_repo(self, did_or_handle):
+    def load_repo(self, did_or_handle, *, with_keys=True):
         assert did_or_handle
-        atp_repo = (AtpRepo.get_by_id(did_or_handle)
-                    or AtpRepo.query(AtpRepo.handles == did_or_handle).get())
 
-        if not atp_repo:
-            logger.info(f"Couldn't find repo for {did_or_handle}")
-            return None
+        cached = None
+        if self._repo_cache is not None:
+            with self._repo_cache_lock:
+                cached = self._repo_cache.get(did_or_handle)
+
+        # callers that load keys may write, so they need the current head. only
+        # serve the cached head to read only callers.
+        if cached and not with_keys:
+            atp_repo = cached['atp_repo']
+            head = cached['head']
+        else:
+            atp_repo = (AtpRepo.get_by_id(did_or_handle)
+                        or AtpRepo.query(AtpRepo.handles == did_or_handle).get())
+
+            if not atp_repo:
+                logger.info(f"Couldn't find repo for {did_or_handle}")
+                return None
+
+            logger.info(f'Loading repo {atp_repo.key}')
+            head = self.read(CID.decode(atp_repo.head))
+            if self._repo_cache is not None:
+                # keep parsed keys, which don't change unless create_repo
+                # invalidates them
+                keys = (cached['keys'] if cached
+                        and cached['atp_repo'].key == atp_repo.key else None)
+                cached = {'atp_repo': atp_repo, 'head': head, 'keys': keys}
+                with self._repo_cache_lock:
+                    for id in [atp_repo.key.id()] + atp_repo.handles:
+                        self._repo_cache[id] = cached
+
+        keys = {}
+        if with_keys:
+            if cached:
+                if not cached['keys']:
+                    cached['keys'] = (atp_repo.signing_key, atp_repo.rotation_key)
+                signing_key, rotation_key = cached['keys']
+            else:
+                signing_key, rotation_key = atp_repo.signing_key, atp_repo.rotation_key
+            keys = {'signing_key': signing_key, 'rotation_key': rotation_key}
+
+        self.head = head.cid
+        # MST.load doesn't read from storage
+        mst = MST.load(storage=self, cid=head.decoded['data'])
+        return Repo(storage=self, mst=mst, head=head, status=atp_repo.status,
+                    handle=atp_repo.handles[0] if atp_repo.handles else None,
+                    **keys)
+
+    def _invalidate_repo(self, did):
+        """Removes a repo from the repo cache, if it's there.
+
+        If we're in a transaction, waits until it commits, so that concurrent
+        :meth:`load_repo` calls can't cache the old repo again.
 
-        logger.info(f'Loading repo {atp_repo.key}')
-        self.head = CID.decode(atp_repo.head)
-        handle = atp_repo.handles[0] if atp_repo.handles else None
+        Args:
+          did (str)
+        """
+        if self._repo_cache is None:
+            return
+
+        def invalidate():
+            with self._repo_cache_lock:
+                if cached := self._repo_cache.pop(did, None):
+                    for handle in cached['atp_repo'].handles:
+                        self._repo_cache.pop(handle, None)
 
-        return Repo.load(self, cid=self.head, handle=handle, status=atp_repo.status,
-                         signing_key=atp_repo.signing_key,
-                         rotation_key=atp_repo.rotation_key)
+        ndb.get_context().call_on_commit(invalidate)
 
     @ndb_context
     def load_repos(self, after=None, limit=500):
@@ -505,6 +653,7 @@ class DatastoreStorage(Storage):
             atp_repo.put()
 
         update()
+        self._invalidate_repo(repo.did)
 
     @ndb_context
     def read(self, cid):
@@ -521,10 +670,30 @@ class DatastoreStorage(Storage):
 
     # can't use @ndb_context because this is a generator, not a normal function
     def read_blocks_by_seq(self, start=0, repo=None):
+        """Fetches blocks in pages of :attr:`blocks_page_size`, with cursors.
+
+        Prefetches each page while the caller consumes the previous one. If the
+        ndb context is lost, resumes at the cursor after the last page that was
+        fully yielded, so blocks aren't read or yielded twice.
+
+        Queries with ``repo`` use the ``(repo, seq)`` composite index in
+        ``index.yaml``.
+        """
         assert start >= 0
 
-        cur_seq = start
-        cur_seq_cids = []
+        def fetch(cursor):
+            query = AtpBlock.query(AtpBlock.seq >= start)
+            if repo:
+                query = query.filter(AtpBlock.repo == ndb.Key(AtpRepo, repo))
+            # unproven hypothesis: need strong consistency to make sure we
+            # get all blocks for a given seq, including commit
+            # https://console.cloud.google.com/errors/detail/CO2g4eLG_tOkZg;service=atproto-hub;time=P1D;refresh=true;locations=global?project=bridgy-federated
+            return query.order(AtpBlock.seq).fetch_page_async(
+                self.blocks_page_size, start_cursor=cursor,
+                read_consistency=ndb.STRONG)
+
+        # start of the first page that hasn't been fully yielded yet
+        cursor = None
 
         while True:
             ctx = context.get_context(raise_context_error=False)
@@ -533,26 +702,20 @@ class DatastoreStorage(Storage):
                 # on a different thread, so if we're there, we need to create a new
                 # ndb context
                 try:
-                    query = AtpBlock.query(AtpBlock.seq >= cur_seq).order(AtpBlock.seq)
-                    if repo:
-                        query = query.filter(AtpBlock.repo == AtpRepo(id=repo).key)
-                    # unproven hypothesis: need strong consistency to make sure we
-                    # get all blocks for a given seq, including commit
-                    # https://console.cloud.google.com/errors/detail/CO2g4eLG_tOkZg;service=atproto-hub;time=P1D;refresh=true;locations=global?project=bridgy-federated
-                    for atp_block in query.iter(read_consistency=ndb.STRONG):
-                        if atp_block.seq != cur_seq:
-                            cur_seq = atp_block.seq
-                            cur_seq_cids = []
-                        if atp_block.key.id() not in cur_seq_cids:
-                            cur_seq_cids.append(atp_block.key.id())
+                    page = fetch(cursor)
+                    while page:
+                        atp_blocks, next_cursor, more = page.result()
+                        page = fetch(next_cursor) if more and next_cursor else None
+                        for atp_block in atp_blocks:
                             yield atp_block.to_block()
+                        cursor = next_cursor
 
                     # finished cleanly
                     break
 
                 except ContextError as e:
-                    logging.warning(f'lost ndb context! re-querying at {cur_seq}. {e}')
-                    # continue loop, restart query
+                    logging.warning(f'lost ndb context! re-querying at cursor {cursor}. {e}')
+                    # continue loop, resume query at cursor
 
             # Context.use() resets this to the previous context when it exits,
             # but that context is bad now, so make sure we get a new one at the
@@ -563,11 +726,32 @@ class DatastoreStorage(Storage):
     def has(self, cid):
         return self.read(cid) is not None
 
+    @ndb_context
+    def has_many(self, cids):
+        cids = list(cids)
+        keys = [ndb.Key(AtpBlock, cid.encode('base32')) for cid in cids]
+
+        if ndb.in_transaction():
+            # non-ancestor queries aren't allowed inside transactions
+            found = {block.key for block in ndb.get_multi(keys) if block}
+        else:
+            # keys-only, so we don't fetch and decode the blocks themselves
+            found = set()
+            for i in range(0, len(keys), MAX_IN_VALUES):
+                query = AtpBlock.query(
+                    AtpBlock.key.IN(keys[i:i + MAX_IN_VALUES], server_op=True))
+                found.update(query.fetch(keys_only=True))
+
+        return {cid: key in found for cid, key in zip(cids, keys)}
+
     @ndb_context
     def write(self, repo_did, obj, seq=None):
         if seq is None:
             seq = self.allocate_seq(SUBSCRIBE_REPOS_NSID)
-        return AtpBlock.create(repo_did=repo_did, data=obj, seq=seq).to_block()
+        # blocks written here are events, not records
+        return AtpBlock.create(repo_did=repo_did, data=obj, seq=seq,
+                               store_decoded=self.store_decoded is True
+                               ).to_block()
 
     @ndb_context
     # retry aggressively because repo writes can be bursty and cause high
@@ -576,37 +760,83 @@ class DatastoreStorage(Storage):
     @ndb.transactional(retries=10)
     def apply_commit(self, commit_data):
         commit = commit_data.commit.decoded
-        if repo := AtpRepo.get_by_id(commit['did']):
-            if repo.status:
-                raise InactiveRepo(repo.key.id(), repo.status)
-
-        seq = tid_to_int(commit_data.commit.decoded['rev'])
+        seq = tid_to_int(commit['rev'])
         assert seq
 
-        for block in commit_data.blocks.values():
-            template = AtpBlock.from_block(
-                repo_did=commit_data.commit.decoded['did'], block=block)
-            # get_or_insert so we don't wipe out any existing blocks' sequence
-            # numbers. (occasionally we see existing blocks recur, eg MST nodes.)
-            atp_block = AtpBlock.get_or_insert(
-                template.key.id(), repo=template.repo, encoded=block.encoded,
-                seq=seq, ops=template.ops)
+        # one round trip to read the repo, its previous commit, and all blocks,
+        # one to write
+        keys = [ndb.Key(AtpBlock, cid.encode('base32'))
+                for cid in commit_data.blocks.keys()]
+        check_rev = commit_data.prev and self.seq_block_size > 1
+        if check_rev:
+            keys.append(ndb.Key(AtpBlock, commit_data.prev.encode('base32')))
+        repo, *existing = ndb.get_multi([ndb.Key(AtpRepo, commit['did'])] + keys)
+        if repo and repo.status:
+            raise InactiveRepo(repo.key.id(), repo.status)
+
+        # reject commits built on a stale head so the repo can't fork
+        if (commit_data.prev and repo
+                and repo.head != commit_data.prev.encode('base32')):
+            raise ValueError(f"{commit['did']} commit's prev {commit_data.prev} isn't the repo's head {repo.head}")
+
+        if check_rev:
+            # revs are leased sequence numbers, so make sure a repo's revs never
+            # go backwards. pre-v3 commits don't have revs, so skip those.
+            prev = existing.pop()
+            prev_rev = prev and dag_cbor.decode(prev.encoded).get('rev')
+            if prev_rev and tid_to_int(prev_rev) >= seq:
+                raise ValueError(f"{commit['did']} commit rev {commit['rev']} isn't after its previous commit's")
+
+        # only write new blocks so we don't wipe out any existing blocks'
+        # sequence numbers. (occasionally we see existing blocks recur, eg MST
+        # nodes.)
+        records = set()
+        if self.store_decoded == 'records':
+            records = {op.cid for op in commit_data.commit.ops or [] if op.cid}
+
+        to_put = []
+        for block, atp_block in zip(commit_data.blocks.values(), existing):
             block.seq = seq
+            if not atp_block:
+                store_decoded = (self.store_decoded is True
+                                 or block.cid in records)
+                to_put.append(AtpBlock.from_block(repo_did=commit['did'],
+                                                  block=block,
+                                                  store_decoded=store_decoded))
 
         self.head = commit_data.commit.cid
-        head_encoded = self.head.encode('base32')
-
         if repo:
             logger.info(f'Updating {repo.key}')
-            repo.head = head_encoded
-            repo.put()
+            repo.head = self.head.encode('base32')
+            to_put.append(repo)
+            self._invalidate_repo(commit['did'])
+
+        ndb.put_multi(to_put)
 
     @ndb_context
     def allocate_seq(self, nsid):
         assert nsid
-        return AtpSequence.allocate(nsid)
+        if self.seq_block_size == 1:
+            return AtpSequence.allocate(nsid)
+
+        with self._seq_lock:
+            lease = self._seq_leases.get(nsid)
+            if not lease or lease[0] > lease[1]:
+                first = AtpSequence.allocate_many(nsid, self.seq_block_size)
+                lease = self._seq_leases[nsid] = [
+                    first, first + self.seq_block_size - 1]
+
+            seq = lease[0]
+            lease[0] += 1
+            return seq
 
     @ndb_context
     def last_seq(self, nsid):
         assert nsid
+        if self.seq_block_size > 1 and nsid == SUBSCRIBE_REPOS_NSID:
+            # AtpSequence includes numbers that are leased but not used yet
+            block = AtpBlock.query().order(-AtpBlock.seq).get(
+                projection=[AtpBlock.seq])
+            return block.seq if block else 0
+
         return AtpSequence.last(nsid)
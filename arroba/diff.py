@@ -146,6 +146,77 @@ def mst_diff(cur, prev=None):
     return diff
 
 
+def mst_changes(cur, prev=None):
+    """Generates the record changes between two MSTs, in key order.
+
+    Descends both trees together, one layer at a time, starting at the top.
+    Prunes subtrees that appear in both trees at any depth or position, since
+    identical pointers mean identical contents, and loads each layer's
+    remaining subtrees in both trees with a single :meth:`Storage.read_many`
+    call.
+
+    Unlike :func:`mst_diff`, doesn't collect node CIDs, only record changes.
+
+    Args:
+      cur (MST)
+      prev (MST): optional
+
+    Yields:
+      Change: ``prev`` is None for new records, ``cid`` is None for deleted
+      records
+    """
+    cur_entries = [cur]
+    prev_entries = [prev] if prev else []
+
+    while True:
+        shared = ({e.get_pointer() for e in cur_entries if isinstance(e, MST)}
+                  & {e.get_pointer() for e in prev_entries if isinstance(e, MST)})
+        cur_entries = [e for e in cur_entries
+                       if not (isinstance(e, MST) and e.pointer in shared)]
+        prev_entries = [e for e in prev_entries
+                        if not (isinstance(e, MST) and e.pointer in shared)]
+
+        subtrees = [e for e in cur_entries + prev_entries if isinstance(e, MST)]
+        if not subtrees:
+            break
+
+        # only load the top layer, since lower subtrees may still be pruned.
+        # (roots don't know their layer until they're loaded.)
+        MST.load_many([subtree for subtree in subtrees if subtree.layer is None])
+        top = max(subtree.get_layer() for subtree in subtrees)
+        MST.load_many([subtree for subtree in subtrees if subtree.layer == top])
+
+        def expand(entries):
+            for entry in entries:
+                if isinstance(entry, MST) and entry.get_layer() == top:
+                    yield from entry.get_entries()
+                else:
+                    yield entry
+
+        cur_entries = list(expand(cur_entries))
+        prev_entries = list(expand(prev_entries))
+
+    # only leaves are left, so merge them
+    cur_iter = iter(cur_entries)
+    prev_iter = iter(prev_entries)
+    cur_leaf = next(cur_iter, None)
+    prev_leaf = next(prev_iter, None)
+
+    while cur_leaf or prev_leaf:
+        if prev_leaf is None or (cur_leaf and cur_leaf.key < prev_leaf.key):
+            yield Change(key=cur_leaf.key, cid=cur_leaf.value)
+            cur_leaf = next(cur_iter, None)
+        elif cur_leaf is None or prev_leaf.key < cur_leaf.key:
+            yield Change(key=prev_leaf.key, cid=None, prev=prev_leaf.value)
+            prev_leaf = next(prev_iter, None)
+        else:
+            if cur_leaf.value != prev_leaf.value:
+                yield Change(key=cur_leaf.key, cid=cur_leaf.value,
+                             prev=prev_leaf.value)
+            cur_leaf = next(cur_iter, None)
+            prev_leaf = next(prev_iter, None)
+
+
 def null_diff(tree):
     """Generates a "null" diff for a single MST with all adds and new CIDs.
 
@@ -0,0 +1,663 @@
+"""Append-only, memory-mapped log implementation of repo storage.
+
+Blocks are appended to segment files as length-prefixed records::
+
+    length (uint32) | CRC-32 (uint32) |
+    seq (uint64) | time (int64, µs since epoch) |
+    CID length (uint16) | repo length (uint16) | ops length (uint32) |
+    CID | repo DID (UTF-8) | ops (DAG-CBOR) | encoded (DAG-CBOR)
+
+All integers are little-endian. ``length`` and the CRC-32 both cover
+everything after the CRC. Segments are read through ``mmap``, so blocks'
+``encoded`` bytes are zero-copy ``memoryview`` slices of the mapped file.
+
+Repo metadata is appended to a separate ``repos.jsonl`` file, one JSON object
+per line. Later lines for a DID override earlier ones field by field.
+"""
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
+import heapq
+import itertools
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+import dag_cbor
+from multiformats import CID
+
+from .mst import MST
+from .repo import Repo
+from .storage import (
+    Action,
+    Block,
+    CommitOp,
+    Storage,
+    SUBSCRIBE_REPOS_NSID,
+)
+from .util import (
+    DEACTIVATED,
+    DELETED,
+    InactiveRepo,
+    load_private_key,
+    private_key_pem,
+    tid_to_int,
+    TOMBSTONED,
+)
+
+logger = logging.getLogger(__name__)
+
+# start a new segment file when the current one would grow past this many bytes
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+# number of records per sparse seq index entry
+SEQ_INDEX_INTERVAL = 256
+
+PREFIX = struct.Struct('<II')  # length, CRC-32
+HEADER = struct.Struct('<QqHHI')  # seq, time, CID length, repo length, ops length
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+SEGMENT_SUFFIX = '.seg'
+REPOS_FILE = 'repos.jsonl'
+
+
+def encode_record(block, repo_did, seq):
+    """Serializes a block into a log record.
+
+    Args:
+      block (Block)
+      repo_did (str)
+      seq (int)
+
+    Returns:
+      bytes:
+    """
+    cid = bytes(block.cid)
+    repo = repo_did.encode()
+    # empty means None. non-commit blocks don't have ops.
+    ops = b''
+    if block.ops is not None:
+        ops = dag_cbor.encode([[op.action.name, op.path, op.cid]
+                               for op in block.ops])
+
+    time = (block.time - EPOCH) // timedelta(microseconds=1)
+    header = HEADER.pack(seq, time, len(cid), len(repo), len(ops))
+    payload = (header, cid, repo, ops, block.encoded)
+    length = sum(len(part) for part in payload)
+    crc = 0
+    for part in payload:
+        crc = zlib.crc32(part, crc)
+    return b''.join((PREFIX.pack(length, crc), *payload))
+
+
+class LogStorage(Storage):
+    """Append-only log implementation of :class:`Storage`.
+
+    Optimized for high write volume and for the ``subscribeRepos`` access
+    pattern, reading blocks in ``seq`` order. Writes only ever append. Reads
+    look up a block's position in an in-memory ``CID`` index, which is rebuilt
+    from the segments on startup, and read it from the mapped segment without
+    copying.
+
+    ``seq`` numbers are mostly, but not strictly, increasing in log order, eg
+    a commit's ``seq`` is allocated before the events that
+    :meth:`Repo.create_from_commit` writes ahead of it. So the sparse seq index
+    stores each run of :const:`SEQ_INDEX_INTERVAL` records' position and min
+    and max ``seq``, and :meth:`read_blocks_by_seq` seeks to the first run that
+    could contain ``start`` and reorders the few out of order blocks with a
+    small heap as it scans forward.
+
+    ``com.atproto.sync.subscribeRepos`` sequence numbers resume after the
+    highest ``seq`` in the log on startup. Other NSIDs' sequences are only
+    kept in memory.
+
+    Like :class:`DatastoreStorage`, all blocks in a given commit have the same
+    sequence number, and blocks that already exist keep their original sequence
+    numbers.
+
+    Each segment is mapped in chunks. When a read goes past the end of the
+    last chunk, eg after appends to the active segment, only the new part of
+    the segment is mapped, not the whole segment. Each new chunk is merged
+    with the ones before it unless they're at least twice as big, so a
+    segment has O(log size) chunks, and each byte is remapped O(log size)
+    times.
+
+    Each record has a CRC-32, which is checked when the log is opened, so
+    torn or corrupt writes at the end of the log are detected and truncated.
+
+    Thread safe. Repo metadata has its own lock, which :meth:`apply_commit`
+    holds from its status check through its head update.
+
+    See :class:`Storage` for method details.
+
+    Attributes:
+      dir (str): directory with the segment files and repo metadata
+      segment_size (int): maximum segment file size, in bytes
+      sequences (dict): {str NSID: int next sequence number}
+    """
+    dir = None
+    segment_size = None
+    sequences = None
+
+    def __init__(self, dir, *, segment_size=SEGMENT_SIZE, fsync=False):
+        """Constructor.
+
+        Opens the log in ``dir``, creating it if necessary, and rebuilds the
+        indexes from its segments. Truncates a partially written or corrupt
+        record, ie one whose CRC-32 doesn't match, and everything after it, at
+        the end of the last segment, eg from a crash.
+
+        Args:
+          dir (str): directory path
+          segment_size (int): maximum segment file size, in bytes
+          fsync (bool): whether to ``fsync`` after every write. If False, the
+            default, writes are flushed to the OS but not necessarily to disk.
+        """
+        super().__init__()
+        self.dir = dir
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.sequences = {}
+        self._lock = threading.Lock()
+        # guards _repos, _handles, and repos.jsonl. reentrant so that
+        # apply_commit can hold it across _write_repo. always acquired before
+        # _lock, never after.
+        self._repos_lock = threading.RLock()
+
+        # maps bytes CID to (int segment, int offset)
+        self._index = {}
+        # sparse seq index: list of [int segment, int offset, int min seq,
+        # int max seq, int num records] runs. _seq_index_max[i] is the max seq in
+        # runs 0 through i, which is sorted, so we can bisect it.
+        self._seq_index = []
+        self._seq_index_max = []
+
+        self._sizes = []     # each segment's size in bytes
+        self._readers = []   # each segment's file object, opened for reading
+        # maps int segment to list of (int start offset, mmap) chunks, sorted
+        self._maps = {}
+        self._maps_lock = threading.Lock()
+        self._repos = {}     # maps DID to dict metadata
+        self._handles = {}   # maps handle to DID
+
+        os.makedirs(dir, exist_ok=True)
+        self._load_segments()
+        self._load_repos()
+
+        self._writer = open(self._segment_path(len(self._sizes) - 1), 'ab')
+        self._repos_writer = open(os.path.join(dir, REPOS_FILE), 'a')
+
+    def close(self):
+        """Closes the log's open files and maps.
+
+        Maps with ``memoryview`` s into them, eg from blocks that are still
+        alive, can't be closed yet. They're unmapped when the last one is
+        garbage collected.
+        """
+        self._writer.close()
+        self._repos_writer.close()
+        for reader in self._readers:
+            reader.close()
+
+        with self._maps_lock:
+            for segment in list(self._maps):
+                self._close_maps(segment)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.dir, f'{segment:08d}{SEGMENT_SUFFIX}')
+
+    def _open_segment(self, segment):
+        """Creates a new, empty segment and starts tracking it."""
+        path = self._segment_path(segment)
+        open(path, 'ab').close()
+        self._readers.append(open(path, 'rb'))
+        self._sizes.append(0)
+
+    def _load_segments(self):
+        """Scans all segments and rebuilds the CID and seq indexes."""
+        num = len([f for f in os.listdir(self.dir) if f.endswith(SEGMENT_SUFFIX)])
+        for segment in range(num):
+            path = self._segment_path(segment)
+            self._readers.append(open(path, 'rb'))
+            size = os.path.getsize(path)
+            self._sizes.append(size)
+
+            offset = 0
+            while offset < size:
+                problem = None
+                record_end = offset + PREFIX.size
+                if record_end > size:
+                    problem = 'Partial'
+                else:
+                    length, crc = PREFIX.unpack(
+                        self._view(segment, offset, record_end))
+                    record_end += length
+                    if record_end > size:
+                        problem = 'Partial'
+                    elif zlib.crc32(self._view(segment, offset + PREFIX.size,
+                                               record_end)) != crc:
+                        problem = 'Corrupt'
+
+                if problem:
+                    if segment < num - 1:
+                        raise RuntimeError(
+                            f'{problem} record in {path} at offset {offset}')
+                    logger.warning(f'Truncating {problem.lower()} record at the end of {path}, offset {offset}')
+                    with self._maps_lock:
+                        self._close_maps(segment)
+                    os.truncate(path, offset)
+                    self._sizes[segment] = offset
+                    break
+
+                seq, cid, _ = self._parse_header(segment, offset)
+                self._add_to_indexes(cid, seq, segment, offset)
+                offset = record_end
+
+        if not self._sizes:
+            self._open_segment(0)
+
+        if self._seq_index_max:
+            self.sequences[SUBSCRIBE_REPOS_NSID] = self._seq_index_max[-1] + 1
+
+    def _load_repos(self):
+        """Loads repo metadata from ``repos.jsonl``."""
+        path = os.path.join(self.dir, REPOS_FILE)
+        if not os.path.exists(path):
+            return
+
+        with open(path) as f:
+            for line in f:
+                try:
+                    update = json.loads(line)
+                except json.JSONDecodeError:
+                    # partial line at the end, eg from a crash
+                    logger.warning(f'Skipping bad line in {path}: {line!r}')
+                    continue
+
+                repo = self._repos.setdefault(update['did'], {})
+                if repo.get('handle') and 'handle' in update:
+                    self._handles.pop(repo['handle'], None)
+                repo.update(update)
+                if handle := repo.get('handle'):
+                    self._handles[handle] = update['did']
+
+    def _write_repo(self, did, **fields):
+        """Updates a repo's metadata in memory and in ``repos.jsonl``.
+
+        Args:
+          did (str)
+          fields: metadata fields to update
+        """
+        with self._repos_lock:
+            repo = self._repos.setdefault(did, {})
+            if repo.get('handle') and 'handle' in fields:
+                self._handles.pop(repo['handle'], None)
+            repo.update(fields)
+            if handle := repo.get('handle'):
+                self._handles[handle] = did
+
+            self._repos_writer.write(json.dumps({'did': did, **fields}) + '\n')
+            self._repos_writer.flush()
+            if self.fsync:
+                os.fsync(self._repos_writer.fileno())
+
+    def _view(self, segment, start, end):
+        """Returns a zero-copy view of part of a segment.
+
+        If the range isn't mapped yet, eg because the segment has grown since
+        it was last mapped, maps a new chunk from ``start`` to the end of the
+        segment, merged with any preceding chunks that aren't at least twice
+        as big as it. Replaced chunks stay alive as long as any ``memoryview``
+        into them does.
+
+        Args:
+          segment (int)
+          start (int): offset, inclusive
+          end (int): offset, exclusive
+
+        Returns:
+          memoryview:
+        """
+        with self._maps_lock:
+            chunks = self._maps.setdefault(segment, [])
+            # the newest chunks cover the end of the segment, where most reads are
+            for chunk_start, map in reversed(chunks):
+                if chunk_start <= start and end <= chunk_start + len(map):
+                    return memoryview(map)[start - chunk_start:end - chunk_start]
+
+            size = os.fstat(self._readers[segment].fileno()).st_size
+            assert end <= size, (segment, end, size)
+            new_start = start
+            if chunks:
+                last_start, last = chunks[-1]
+                new_start = min(start, last_start + len(last))
+
+            # mmap offsets must be multiples of ALLOCATIONGRANULARITY
+            new_start -= new_start % mmap.ALLOCATIONGRANULARITY
+            # drop the chunks that the new one covers, then merge it with
+            # preceding chunks that aren't at least twice as big as it, so
+            # chunk sizes at least double going backward
+            while chunks and chunks[-1][0] >= new_start:
+                chunks.pop()
+            while chunks and len(chunks[-1][1]) < 2 * (size - new_start):
+                new_start = chunks.pop()[0]
+
+            map = mmap.mmap(self._readers[segment].fileno(), size - new_start,
+                            offset=new_start, access=mmap.ACCESS_READ)
+            chunks.append((new_start, map))
+            return memoryview(map)[start - new_start:end - new_start]
+
+    def _close_maps(self, segment):
+        """Stops using a segment's maps, eg before truncating it.
+
+        Callers should hold ``_maps_lock``.
+
+        Args:
+          segment (int)
+        """
+        for _, map in self._maps.pop(segment, []):
+            try:
+                map.close()
+            except BufferError:
+                pass
+
+    def _length(self, segment, offset):
+        """Reads a record's length, not including its length and CRC prefix.
+
+        Args:
+          segment (int)
+          offset (int)
+
+        Returns:
+          int:
+        """
+        return PREFIX.unpack(self._view(segment, offset, offset + PREFIX.size))[0]
+
+    def _parse_header(self, segment, offset):
+        """Reads just a record's ``seq``, CID, and repo.
+
+        Args:
+          segment (int)
+          offset (int)
+
+        Returns:
+          (int seq, bytes CID, str repo) tuple:
+        """
+        start = offset + PREFIX.size
+        seq, _, cid_len, repo_len, _ = HEADER.unpack(
+            self._view(segment, start, start + HEADER.size))
+        start += HEADER.size
+        view = self._view(segment, start, start + cid_len + repo_len)
+        return seq, bytes(view[:cid_len]), bytes(view[cid_len:]).decode()
+
+    def _read_record(self, segment, offset):
+        """Reads a record into a :class:`Block`.
+
+        Args:
+          segment (int)
+          offset (int)
+
+        Returns:
+          Block: its ``encoded`` is a ``memoryview`` into the segment's map
+        """
+        length = self._length(segment, offset)
+        start = offset + PREFIX.size
+        view = self._view(segment, start, start + length)
+
+        seq, time, cid_len, repo_len, ops_len = HEADER.unpack_from(view)
+        pos = HEADER.size
+        cid = CID.decode(bytes(view[pos:pos + cid_len]))
+        pos += cid_len
+        repo = bytes(view[pos:pos + repo_len]).decode()
+        pos += repo_len
+
+        ops = None
+        if ops_len:
+            ops = [CommitOp(action=Action[action], path=path, cid=cid)
+                   for action, path, cid
+                   in dag_cbor.decode(bytes(view[pos:pos + ops_len]))]
+        pos += ops_len
+
+        return Block(cid=cid, encoded=view[pos:], seq=seq, ops=ops, repo=repo,
+                     time=EPOCH + timedelta(microseconds=time))
+
+    def _add_to_indexes(self, cid, seq, segment, offset):
+        """Adds a record to the CID and sparse seq indexes.
+
+        Args:
+          cid (bytes)
+          seq (int)
+          segment (int)
+          offset (int)
+        """
+        self._index[cid] = (segment, offset)
+
+        if not self._seq_index or self._seq_index[-1][4] >= SEQ_INDEX_INTERVAL:
+            self._seq_index.append([segment, offset, seq, seq, 0])
+            self._seq_index_max.append(max(seq, self._seq_index_max[-1])
+                                       if self._seq_index_max else seq)
+
+        run = self._seq_index[-1]
+        run[2] = min(run[2], seq)
+        run[3] = max(run[3], seq)
+        run[4] += 1
+        self._seq_index_max[-1] = max(self._seq_index_max[-1], seq)
+
+    def _append(self, blocks, repo_did, seq):
+        """Appends blocks that aren't already stored to the log.
+
+        Writes them all with a single ``write`` call, unless they span a new
+        segment.
+
+        Args:
+          blocks (iterable of Block)
+          repo_did (str)
+          seq (int)
+        """
+        with self._lock:
+            records = []
+            seen = set()
+            segment = len(self._sizes) - 1
+            offset = self._sizes[segment]
+
+            def flush():
+                if records:
+                    self._writer.write(b''.join(rec for _, _, rec in records))
+                    self._writer.flush()
+                    if self.fsync:
+                        os.fsync(self._writer.fileno())
+                    self._sizes[segment] = offset
+                    for cid, pos, _ in records:
+                        self._add_to_indexes(cid, seq, segment, pos)
+                    records.clear()
+
+            for block in blocks:
+                cid = bytes(block.cid)
+                if cid in self._index or cid in seen:
+                    continue
+                seen.add(cid)
+
+                record = encode_record(block, repo_did, seq)
+                if offset and offset + len(record) > self.segment_size:
+                    flush()
+                    self._writer.close()
+                    segment += 1
+                    self._open_segment(segment)
+                    self._writer = open(self._segment_path(segment), 'ab')
+                    offset = 0
+
+                records.append((cid, offset, record))
+                offset += len(record)
+
+            flush()
+
+    def create_repo(self, repo, *, signing_key, rotation_key=None):
+        assert repo.did
+        assert repo.head
+
+        rotation_key_pem = private_key_pem(rotation_key)
+        self._write_repo(
+            repo.did, handle=repo.handle, head=repo.head.cid.encode('base32'),
+            signing_key=private_key_pem(signing_key).decode(),
+            rotation_key=rotation_key_pem.decode() if rotation_key_pem else None,
+            status=repo.status)
+
+    def _repo(self, did, meta, head=None, with_keys=True):
+        """Makes a :class:`Repo` from stored metadata.
+
+        Args:
+          did (str)
+          meta (dict)
+          head (Block): optional. If not provided, loaded from storage.
+          with_keys (bool): whether to parse the repo's keys
+
+        Returns:
+          Repo:
+        """
+        kwargs = {
+            'handle': meta.get('handle'),
+            'status': meta.get('status'),
+        }
+        if with_keys:
+            kwargs.update({
+                'signing_key': load_private_key(meta['signing_key'].encode()),
+                'rotation_key': load_private_key(
+                    (meta.get('rotation_key') or '').encode()),
+            })
+
+        if head:
+            # MST.load doesn't read from storage
+            mst = MST.load(storage=self, cid=head.decoded['data'])
+            return Repo(storage=self, mst=mst, head=head, **kwargs)
+
+        self.head = CID.decode(meta['head'])
+        return Repo.load(self, cid=self.head, **kwargs)
+
+    def load_repo(self, did_or_handle, *, with_keys=True):
+        assert did_or_handle
+
+        with self._repos_lock:
+            did = did_or_handle if did_or_handle in self._repos \
+                else self._handles.get(did_or_handle)
+            meta = dict(self._repos[did]) if did else None
+
+        if not did:
+            logger.info(f"Couldn't find repo for {did_or_handle}")
+            return None
+
+        logger.info(f'Loading repo {did}')
+        return self._repo(did, meta, with_keys=with_keys)
+
+    def load_repos(self, after=None, limit=500):
+        with self._repos_lock:
+            dids = sorted(self._repos)
+            if after:
+                dids = dids[bisect_right(dids, after):]
+            metas = [(did, dict(self._repos[did])) for did in dids[:limit]]
+
+        cids = [CID.decode(meta['head']) for _, meta in metas]
+        heads = self.read_many(cids)
+        return [self._repo(did, meta, head=heads[cid])
+                for (did, meta), cid in zip(metas, cids)]
+
+    def _set_repo_status(self, repo, status):
+        assert status in (DEACTIVATED, DELETED, TOMBSTONED, None)
+        repo.status = status
+        self._write_repo(repo.did, status=status)
+
+    def read(self, cid):
+        if pos := self._index.get(bytes(cid)):
+            return self._read_record(*pos)
+
+    def read_many(self, cids, require_all=True):
+        found = {}
+        for cid in cids:
+            pos = self._index.get(bytes(cid))
+            found[cid] = self._read_record(*pos) if pos else None
+        return found
+
+    def read_blocks_by_seq(self, start=0, repo=None):
+        assert start >= 0
+
+        # snapshot the index so that blocks appended while we're reading don't
+        # break our ordering. new blocks get picked up on the next call.
+        with self._lock:
+            first = bisect_left(self._seq_index_max, start)
+            runs = [tuple(run) for run in self._seq_index[first:]]
+            end = (len(self._sizes) - 1, self._sizes[-1])
+
+        # min seq in each run and all runs after it
+        later_min = list(itertools.accumulate(
+            (run[2] for run in reversed(runs)), min))[::-1] + [float('inf')]
+
+        heap = []
+        for i, (segment, offset, _, _, num) in enumerate(runs):
+            for _ in range(num):
+                if offset >= self._sizes[segment]:
+                    segment += 1
+                    offset = 0
+                if (segment, offset) >= end:
+                    break
+
+                seq, _, block_repo = self._parse_header(segment, offset)
+                if seq >= start and (not repo or block_repo == repo):
+                    heapq.heappush(heap, (seq, segment, offset))
+
+                offset += PREFIX.size + self._length(segment, offset)
+
+            # everything below the min seq in the remaining runs is final
+            while heap and heap[0][0] < later_min[i + 1]:
+                _, seg, off = heapq.heappop(heap)
+                yield self._read_record(seg, off)
+
+        while heap:
+            _, seg, off = heapq.heappop(heap)
+            yield self._read_record(seg, off)
+
+    def has(self, cid):
+        return bytes(cid) in self._index
+
+    def has_many(self, cids):
+        return {cid: bytes(cid) in self._index for cid in cids}
+
+    def write(self, repo_did, obj, seq=None):
+        if seq is None:
+            seq = self.allocate_seq(SUBSCRIBE_REPOS_NSID)
+
+        block = Block(decoded=obj, seq=seq, repo=repo_did)
+        self._append([block], repo_did, seq)
+        return block
+
+    def apply_commit(self, commit_data):
+        commit = commit_data.commit.decoded
+        seq = tid_to_int(commit['rev'])
+        assert seq
+
+        with self._repos_lock:
+            if repo := self._repos.get(commit['did']):
+                if repo.get('status'):
+                    raise InactiveRepo(commit['did'], repo['status'])
+
+            for block in commit_data.blocks.values():
+                block.seq = seq
+
+            self._append(commit_data.blocks.values(), commit['did'], seq)
+
+            self.head = commit_data.commit.cid
+            if repo:
+                self._write_repo(commit['did'], head=self.head.encode('base32'))
+
+    def allocate_seq(self, nsid):
+        assert nsid
+        with self._lock:
+            next = self.sequences.setdefault(nsid, 1)
+            self.sequences[nsid] += 1
+            return next
+
+    def last_seq(self, nsid):
+        assert nsid
+        return self.sequences.get(nsid, 1) - 1
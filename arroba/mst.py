@@ -44,21 +44,35 @@ If the first leaf in a tree is ``bsky/posts/abcdefg`` and the second is
 'bsky/posts/abcdefg'``, and the second will be described as ``prefix: 16, key:
 'hi'``.
 """
+from bisect import bisect_left, bisect_right
 from collections import namedtuple
-import copy
+from functools import lru_cache
 from hashlib import sha256
 import logging
 from os.path import commonprefix
 import re
+from threading import Lock
 
+from cachetools import LRUCache
 import dag_cbor
 from multiformats import CID
 
-from .storage import Block, Storage
+from .storage import Action, Block, Storage
 from .util import dag_cbor_cid
 
 logger = logging.getLogger(__name__)
 
+# max total size of decoded nodes in node_cache, in bytes
+NODE_CACHE_SIZE = 64 * 1024 * 1024
+# approximate in-memory sizes of decoded nodes, for node_size
+NODE_OVERHEAD = 100
+LEAF_OVERHEAD = 250  # plus key length
+SUBTREE_OVERHEAD = 150
+# max number of keys in leading_zeros_on_hash's cache
+LAYER_CACHE_SIZE = 128 * 1024
+# max number of subtree leaf counts in leaf_count_cache
+LEAF_COUNT_CACHE_SIZE = 1024 * 1024
+
 # this is treeEntry in mst.ts
 Entry = namedtuple('Entry', [
     'p',  # int, length of prefix that this data key shares with the prev data key
@@ -77,22 +91,33 @@ Leaf = namedtuple('Leaf', [
     'value',  # CID
 ])
 
+BatchOp = namedtuple('BatchOp', [  # used in MST.apply_batch
+    'key',     # str, data key
+    'layer',   # int, leading_zeros_on_hash(key)
+    'action',  # Action
+    'value',   # CID, or None for DELETE
+])
+
 
 class MST:
     """Merkle search tree class.
 
     Attributes:
       storage (Storage):
-      entries (sequence of MST and Leaf)
+      entries (tuple of MST and Leaf)
       layer (int): this MST's layer in the root MST
       pointer (CID):
       outdated_pointer (bool): whether pointer needs to be recalculated
+      leaf_keys (list of str): keys of the leaves in ``entries``, in order.
+        Populated lazily by :meth:`get_leaf_index`.
+      leaf_indices (list of int): indices in ``entries`` of the leaves in
+        ``leaf_keys``, followed by ``len(entries)``. Populated lazily by
+        :meth:`get_leaf_index`.
     """
-    storage = None
-    entries = None
-    layer = None
-    pointer = None
-    outdated_pointer = False
+    # we hold lots of these in memory for large repos, so avoid per-instance
+    # __dict__s
+    __slots__ = ('storage', 'entries', 'layer', 'pointer', 'outdated_pointer',
+                 'leaf_keys', 'leaf_indices')
 
     def __init__(self, *, storage=None, entries=None, pointer=None, layer=None):
         """Constructor.
@@ -107,9 +132,13 @@ class MST:
           MST:
         """
         self.storage = storage
-        self.entries = entries
+        # tuples are immutable, so we can share them instead of copying
+        self.entries = tuple(entries) if entries is not None else None
         self.pointer = pointer
         self.layer = layer
+        self.outdated_pointer = False
+        self.leaf_keys = None
+        self.leaf_indices = None
 
     @classmethod
     def load(cls, *, storage=None, cid=None):
@@ -132,6 +161,61 @@ class MST:
         pointer = cid_for_entries(entries)
         return MST(storage=storage, entries=entries, pointer=pointer, layer=layer)
 
+    @classmethod
+    def from_sorted_leaves(cls, storage, leaves):
+        """Builds a new MST bottom up from leaves, in one pass.
+
+        Much faster than calling :meth:`add` once per key, since each key's
+        layer is only calculated once and each node is only created and
+        hashed once. Generates the same tree, and root CID, as repeated
+        :meth:`add`.
+
+        Args:
+          storage (Storage)
+          leaves (iterable of Leaf): must be in ascending key order
+
+        Returns:
+          MST:
+
+        Raises:
+          ValueError: if a key is invalid, or if the leaves aren't sorted, or if
+            a key is repeated
+        """
+        # pending[i] is the entries so far of the in-progress node at layer i
+        pending = [[], []]
+        top = 0
+        last_key = None
+
+        def close(layer):
+            # finishes the in-progress node at layer, adds it to its parent
+            if pending[layer]:
+                node = cls.create(storage=storage, entries=pending[layer],
+                                  layer=layer)
+                pending[layer + 1].append(node)
+                pending[layer] = []
+
+        leaves = list(leaves)
+        layers = leading_zeros_on_hashes([leaf.key for leaf in leaves])
+
+        for leaf, layer in zip(leaves, layers):
+            ensure_valid_key(leaf.key)
+            if last_key is not None and leaf.key <= last_key:
+                raise ValueError(
+                    f'Leaves must be sorted and unique: {leaf.key} after {last_key}')
+            last_key = leaf.key
+
+            top = max(top, layer)
+            while len(pending) <= top + 1:
+                pending.append([])
+            for lower in range(layer):
+                close(lower)
+            pending[layer].append(leaf)
+
+        for lower in range(top):
+            close(lower)
+
+        return cls.create(storage=storage, entries=pending[top], layer=top)
+
 #     def from_data(storage, data, opts):
 #         """
 #         Returns:
@@ -176,24 +260,56 @@ class MST:
 
         We don't want to load entries of every subtree, just the ones we need.
 
+        Entries are immutable tuples, so callers can use them directly without
+        copying.
+
         Returns:
-          sequence of MST and Leaf:
+          tuple of MST and Leaf:
         """
         if self.entries is not None:
-            return copy.copy(self.entries)
+            return self.entries
 
         if self.pointer:
-            data = Data(**self.storage.read(self.pointer).decoded)
-            first_leaf = layer = None
-            if data.e:
-                layer = leading_zeros_on_hash(data.e[0]['k'])
-
-            self.entries = deserialize_node_data(storage=self.storage, data=data,
-                                                 layer=layer)
+            node = node_cache.load(self.storage, self.pointer)
+            self.entries = node_to_entries(storage=self.storage, node=node)
+            self.get_leaf_index()
             return self.entries
 
         raise RuntimeError('No entries or CID provided')
 
+    @staticmethod
+    def load_many(nodes):
+        """Loads the entries of multiple nodes with a single batched read.
+
+        Nodes that are already loaded are skipped. All nodes should use the
+        same storage.
+
+        Args:
+          nodes (sequence of MST)
+        """
+        unloaded = [node for node in nodes if node.entries is None]
+        if not unloaded:
+            return
+
+        storage = unloaded[0].storage
+        loaded = node_cache.load_many(storage, [node.pointer for node in unloaded])
+        for node in unloaded:
+            node.entries = node_to_entries(storage=storage, node=loaded[node.pointer])
+            node.get_leaf_index()
+
+    def load_layers(self):
+        """Loads all of this tree's nodes from storage, one layer at a time.
+
+        Uses :meth:`load_many` to read each layer's nodes in a single batch, so
+        loading a whole tree takes one storage round trip per layer instead of
+        one per node.
+        """
+        layer = [self]
+        while layer:
+            MST.load_many(layer)
+            layer = [entry for node in layer for entry in node.entries
+                     if isinstance(entry, MST)]
+
     def get_pointer(self):
         """Returns this MST's root CID pointer. Calculates it if necessary.
 
@@ -276,18 +392,20 @@ class MST:
         unstored = {}
         pointer = self.get_pointer()
 
-        if self.storage.has(pointer):
-            return pointer, unstored
-
-        entries = self.get_entries()
-        data = serialize_node_data(entries)
-        block = Block(decoded=data._asdict())
-        unstored[block.cid] = block
-
-        for entry in entries:
-            if isinstance(entry, MST):
-                _, blocks = entry.get_unstored_blocks()
-                unstored.update(blocks)
+        # breadth first, checking each layer with one has_many call. we only
+        # descend into nodes that aren't stored, ie new or changed.
+        layer = [self]
+        while layer:
+            stored = self.storage.has_many([node.get_pointer() for node in layer])
+            next_layer = []
+            for node in layer:
+                if stored[node.pointer]:
+                    continue
+                entries = node.get_entries()
+                block = Block(decoded=serialize_node_data(entries)._asdict())
+                unstored[block.cid] = block
+                next_layer.extend(e for e in entries if isinstance(e, MST))
+            layer = next_layer
 
         return pointer, unstored
 
@@ -441,7 +559,7 @@ class MST:
             if isinstance(prev, MST) and isinstance(next, MST):
                 merged = prev.append_merge(next)
                 return self.new_tree(
-                    self.slice(0, index - 1) + [merged] + self.slice(index + 2)
+                    self.slice(0, index - 1) + (merged,) + self.slice(index + 2)
                 )
             else:
                 return self.remove_entry(index)
@@ -457,6 +575,253 @@ class MST:
 
         raise KeyError(f'Could not find a record with key: {key}')
 
+    def apply_batch(self, ops, diff=None):
+        """Applies multiple creates, updates, and deletes at once.
+
+        Sorts the ops by key and rewrites each affected node once, instead of
+        once per op like calling :meth:`add`, :meth:`update`, and
+        :meth:`delete` one at a time. Generates the canonical tree for the
+        resulting set of keys and values, the same as
+        :meth:`from_sorted_leaves` would. Applying the ops one at a time
+        usually does too, but not always, eg if deletes empty the tree and
+        leave it on a higher layer than the keys that are then added.
+
+        If ``diff`` is provided, records the changes between this tree and the
+        new one in it, the same as :meth:`Diff.of` would, by comparing only the
+        nodes that the ops touched instead of walking both trees.
+
+        Args:
+          ops (sequence of CommitOp): ``path`` is the key, ``cid`` is the value
+            for creates and updates
+          diff (diff.Diff): optional
+
+        Returns:
+          MST:
+
+        Raises:
+          ValueError: if a create's key already exists
+          KeyError: if an update's or delete's key doesn't exist
+        """
+        ops = list(ops)
+
+        if diff is not None:
+            mst = self.apply_batch(ops)
+            self.record_diff(mst, sorted({op.path for op in ops}), diff)
+            return mst
+
+        # if a key has more than one op, apply them in order, in chunks where
+        # each key only appears once
+        seen = set()
+        for i, op in enumerate(ops):
+            if op.path in seen:
+                return self.apply_batch(ops[:i]).apply_batch(ops[i:])
+            seen.add(op.path)
+
+        if not ops:
+            return self
+
+        ops.sort(key=lambda op: op.path)
+        if (all(op.action == Action.CREATE for op in ops)
+                and not self.get_entries()):
+            return MST.from_sorted_leaves(
+                self.storage, [Leaf(key=op.path, value=op.cid) for op in ops])
+
+        batch = []
+        layers = leading_zeros_on_hashes([op.path for op in ops])
+        for op, op_layer in zip(ops, layers):
+            ensure_valid_key(op.path)
+            batch.append(BatchOp(key=op.path, layer=op_layer, action=op.action,
+                                 value=op.cid))
+
+        # if any new keys belong on higher layers, add layers on top first
+        root = self
+        layer = root.get_layer()
+        top = max((op.layer for op in batch if op.action == Action.CREATE),
+                  default=layer)
+        if top > layer:
+            if root.get_entries():
+                for _ in range(layer, top):
+                    root = root.create_parent()
+            else:
+                root = MST.create(storage=self.storage, entries=[], layer=top)
+            layer = top
+
+        return root.apply_sorted_batch(batch, layer).trim_top()
+
+    def apply_sorted_batch(self, batch, layer):
+        """Applies ops to this node and its subtrees. Used by :meth:`apply_batch`.
+
+        Args:
+          batch (sequence of BatchOp): sorted by key, all at or below ``layer``
+          layer (int): this node's layer
+
+        Returns:
+          MST:
+        """
+        # split this node's entries into its leaves and the gaps between them.
+        # each gap is a subtree or None.
+        leaves = []
+        gaps = [None]
+        for entry in self.get_entries():
+            if isinstance(entry, Leaf):
+                leaves.append(entry)
+                gaps.append(None)
+            else:
+                gaps[-1] = entry
+
+        # apply updates and deletes to leaves on this layer, merge the gaps on
+        # either side of deleted leaves, and collect ops for each gap
+        new_leaves = []
+        new_gaps = [[gaps[0], []]]  # [subtree or None, list of BatchOp]
+        i = 0
+        for leaf, next_gap in zip(leaves, gaps[1:]):
+            while i < len(batch) and batch[i].key < leaf.key:
+                new_gaps[-1][1].append(batch[i])
+                i += 1
+
+            if i < len(batch) and batch[i].key == leaf.key:
+                op = batch[i]
+                i += 1
+                if op.action == Action.CREATE:
+                    raise ValueError(f'There is already a value at key: {op.key}')
+                elif op.action == Action.DELETE:
+                    prev_gap = new_gaps[-1][0]
+                    if prev_gap and next_gap:
+                        new_gaps[-1][0] = prev_gap.append_merge(next_gap)
+                    else:
+                        new_gaps[-1][0] = prev_gap or next_gap
+                    continue
+                leaf = Leaf(key=leaf.key, value=op.value)
+
+            new_leaves.append(leaf)
+            new_gaps.append([next_gap, []])
+
+        new_gaps[-1][1].extend(batch[i:])
+
+        # apply each gap's ops. new leaves on this layer split the gap's subtree
+        # around them, everything else recurses into the subtree.
+        new_entries = []
+        for i, (subtree, ops) in enumerate(new_gaps):
+            if i > 0:
+                new_entries.append(new_leaves[i - 1])
+
+            sub_ops = []
+            for op in ops:
+                # updates and deletes of missing keys may be on higher layers
+                if op.layer >= layer:
+                    if op.action != Action.CREATE:
+                        raise KeyError(f'Could not find a record with key: {op.key}')
+                    left, right = (subtree.split_around(op.key) if subtree
+                                   else (None, None))
+                    new_entries.extend(self.apply_to_subtree(left, sub_ops, layer))
+                    new_entries.append(Leaf(key=op.key, value=op.value))
+                    subtree = right
+                    sub_ops = []
+                else:
+                    sub_ops.append(op)
+
+            new_entries.extend(self.apply_to_subtree(subtree, sub_ops, layer))
+
+        return self.new_tree(new_entries)
+
+    def record_diff(self, new, keys, diff):
+        """Records the changes from this tree to a new version of it in a diff.
+
+        Only compares the nodes that could have changed, ie those whose key
+        ranges include or border one of ``keys``, and prunes nodes that are
+        shared by both trees. Used by :meth:`apply_batch`.
+
+        Args:
+          new (MST): this tree after applying ops to ``keys``
+          keys (list of str): sorted
+          diff (diff.Diff)
+        """
+        old_nodes = self.touched_nodes(keys)
+        new_nodes = new.touched_nodes(keys)
+
+        key_set = set(keys)
+        def values(nodes):
+            return {entry.key: entry.value for node in nodes
+                    for entry in node.entries
+                    if isinstance(entry, Leaf) and entry.key in key_set}
+
+        old_values = values(old_nodes)
+        new_values = values(new_nodes)
+        for key in keys:
+            old_value = old_values.get(key)
+            new_value = new_values.get(key)
+            if old_value is None and new_value is not None:
+                diff.record_add(key, new_value)
+            elif old_value is not None and new_value is None:
+                diff.record_delete(key, old_value)
+            elif old_value != new_value:
+                diff.record_update(key, old_value, new_value)
+
+        # unchanged subtrees are the same objects in both trees
+        old_ids = {id(node) for node in old_nodes}
+        new_ids = {id(node) for node in new_nodes}
+        for node in new_nodes:
+            if id(node) not in old_ids:
+                diff.record_new_cid(node.get_pointer())
+        for node in old_nodes:
+            if id(node) not in new_ids:
+                diff.record_removed_cid(node.get_pointer())
+
+    def touched_nodes(self, keys, after=None, before=None):
+        """Returns loaded nodes whose key ranges include or border any of keys.
+
+        These are the only nodes that writes to ``keys`` can change. Nodes that
+        haven't been loaded can't have been changed, so they're skipped. Used by
+        :meth:`record_diff`.
+
+        Args:
+          keys (list of str): sorted
+          after (str): all keys in this tree are greater than this, or None
+          before (str): all keys in this tree are less than this, or None
+
+        Returns:
+          list of MST:
+        """
+        if self.entries is None:
+            return []
+
+        i = bisect_left(keys, after) if after is not None else 0
+        if i == len(keys) or (before is not None and keys[i] > before):
+            return []
+
+        nodes = [self]
+        prev_key = after
+        for i, entry in enumerate(self.entries):
+            if isinstance(entry, Leaf):
+                prev_key = entry.key
+            else:
+                next_key = (self.entries[i + 1].key if i + 1 < len(self.entries)
+                            else before)
+                nodes.extend(entry.touched_nodes(keys, prev_key, next_key))
+
+        return nodes
+
+    def apply_to_subtree(self, subtree, batch, layer):
+        """Applies ops to a subtree of this node. Used by :meth:`apply_batch`.
+
+        Args:
+          subtree (MST or None): creates a new one if necessary
+          batch (sequence of BatchOp): sorted by key, all below ``layer``
+          layer (int): this node's layer
+
+        Returns:
+          list of MST: the updated subtree, or empty if it no longer has any
+          entries
+        """
+        if not batch:
+            # untouched, so don't load it
+            return [subtree] if subtree else []
+
+        if not subtree:
+            subtree = MST.create(storage=self.storage, entries=[], layer=layer - 1)
+        subtree = subtree.apply_sorted_batch(batch, layer - 1)
+        return [subtree] if subtree.get_entries() else []
+
 
 #     Simple Operations
 #     -------------------
@@ -472,7 +837,7 @@ class MST:
           MST:
         """
         return self.new_tree(
-            entries=self.slice(0, index) + [entry] + self.slice(index + 1))
+            entries=self.slice(0, index) + (entry,) + self.slice(index + 1))
 
     def remove_entry(self, index):
         """Removes the entry at a given index.
@@ -494,7 +859,7 @@ class MST:
         Returns:
           MST:
         """
-        return self.new_tree(self.get_entries() + [entry])
+        return self.new_tree(self.get_entries() + (entry,))
 
     def prepend(self, entry):
         """Prepends an entry to the start of the node.
@@ -505,7 +870,7 @@ class MST:
         Returns:
           MST:
         """
-        return self.new_tree([entry] + self.get_entries())
+        return self.new_tree((entry,) + self.get_entries())
 
     def at_index(self, index):
         """Returns the entry at a given index.
@@ -528,7 +893,7 @@ class MST:
           end (int): optional, exclusive
 
         Returns:
-          sequence of MST and Leaf:
+          tuple of MST and Leaf:
         """
         return self.get_entries()[start:end]
 
@@ -542,7 +907,7 @@ class MST:
         Returns:
           MST:
         """
-        return self.new_tree(self.slice(0, index) + [entry] + self.slice(index))
+        return self.new_tree(self.slice(0, index) + (entry,) + self.slice(index))
 
     def replace_with_split(self, index, left=None, leaf=None, right=None):
         """Replaces an entry with [ Maybe(tree), Leaf, Maybe(tree) ].
@@ -556,7 +921,7 @@ class MST:
         Returns:
           MST:
         """
-        updated = self.slice(0, index)
+        updated = list(self.slice(0, index))
         if left:
             updated.append(left)
         updated.append(leaf)
@@ -639,7 +1004,7 @@ class MST:
         if isinstance(last_in_left, MST) and isinstance(first_in_right, MST):
             merged = last_in_left.append_merge(first_in_right)
             return self.new_tree(
-                list(self_entries[:-1]) + [merged] + to_merge_entries[1:])
+                self_entries[:-1] + (merged,) + to_merge_entries[1:])
         else:
             return self.new_tree(self_entries + to_merge_entries)
 
@@ -669,6 +1034,32 @@ class MST:
 #     Finding insertion points
 #     -------------------
 
+    def get_leaf_index(self):
+        """Returns this node's leaf keys and their indices in its entries.
+
+        Built once per node, the first time it's needed, and then cached in
+        :attr:`leaf_keys` and :attr:`leaf_indices`. Nodes never change their
+        entries, so this never needs to be invalidated.
+
+        Returns:
+          (list of str, list of int) tuple: :attr:`leaf_keys`, :attr:`leaf_indices`
+        """
+        if self.entries is None:
+            self.get_entries()  # loads entries and builds the index
+
+        if self.leaf_keys is None:
+            keys = []
+            indices = []
+            for i, entry in enumerate(self.entries):
+                if isinstance(entry, Leaf):
+                    keys.append(entry.key)
+                    indices.append(i)
+            indices.append(len(self.entries))
+            self.leaf_keys = keys
+            self.leaf_indices = indices
+
+        return self.leaf_keys, self.leaf_indices
+
     def find_gt_or_equal_leaf_index(self, key):
         """Finds the index of the first leaf node greater than or equal to value.
 
@@ -676,15 +1067,10 @@ class MST:
           key (str)
 
         Returns:
-          int:
+          int: if we can't find it, the number of entries, ie the end
         """
-        entries = self.get_entries()
-        for i, entry in enumerate(entries):
-            if isinstance(entry, Leaf) and entry.key >= key:
-                return i
-
-        # if we can't find it, we're on the end
-        return len(entries)
+        keys, indices = self.get_leaf_index()
+        return indices[bisect_left(keys, key)]
 
 
 #     List operations (partial tree traversal)
@@ -704,19 +1090,47 @@ class MST:
         index = self.find_gt_or_equal_leaf_index(key)
         entries = self.get_entries()
 
-        if index > 0:
-            prev = entries[index - 1]
-            if prev and isinstance(prev, MST):
-                for e in prev.walk_leaves_from(key):
-                    yield e
+        # the subtree right before index may have keys on either side of key
+        if index > 0 and isinstance(entries[index - 1], MST):
+            index -= 1
+        entries = entries[index:]
+        subtrees = [e for e in entries if isinstance(e, MST)]
 
-        for entry in entries[index:]:
+        i = 0
+        for entry in entries:
             if isinstance(entry, Leaf):
                 yield entry
             else:
+                # load this subtree and the next one in one batch, lazily, so
+                # callers that stop early don't load the rest
+                MST.load_many(subtrees[i:i + 2])
+                i += 1
                 for e in entry.walk_leaves_from(key):
                     yield e
 
+    def walk_leaves_backwards_from(self, key):
+        """Walk tree backwards, starting at key.
+
+        Generator for leaves in the tree with keys less than or equal to a given
+        key, in descending order. Only loads subtrees that overlap that range.
+
+        Args:
+          key (str):
+
+        Generates:
+          Leaf
+        """
+        keys, indices = self.get_leaf_index()
+        # index of first leaf greater than key. the subtree right before it may
+        # have keys on either side of key, so we recurse into it with key too.
+        end = indices[bisect_right(keys, key)]
+        for entry in reversed(self.get_entries()[:end]):
+            if isinstance(entry, Leaf):
+                yield entry
+            else:
+                for e in entry.walk_leaves_backwards_from(key):
+                    yield e
+
     def list(self, after=None, before=None):
         """Returns entries, optionally bounded within a key range.
 
@@ -759,17 +1173,24 @@ class MST:
 #     Full tree traversal
 #     -------------------
 
-    def walk(self):
+    def walk(self, prefetch=True):
         """Walk full tree, depth first, and emit nodes.
 
+        Args:
+          prefetch (bool): whether to load all nodes first with
+            :meth:`load_layers`, which batches reads from storage
+
         Returns:
           generator of MST and Leaf:
         """
+        if prefetch:
+            self.load_layers()
+
         yield self
 
         for entry in self.get_entries():
             if isinstance(entry, MST):
-                for e in entry.walk():
+                for e in entry.walk(prefetch=False):
                     yield e
             else:
                 yield entry
@@ -825,10 +1246,119 @@ class MST:
     def leaf_count(self):
         """Returns the total number of leaves in this MST.
 
+        Counts are cached in :data:`leaf_count_cache` by node CID, so after the
+        first call, counting a tree only touches nodes that have changed since.
+        Subtrees that aren't cached yet are loaded one layer at a time, with one
+        :meth:`load_many` batch per layer.
+
+        Returns:
+          int:
+        """
+        if (count := self.cached_leaf_count()) is not None:
+            return count
+
+        layer = [self]
+        while layer:
+            MST.load_many(layer)
+            layer = [e for node in layer for e in node.entries
+                     if isinstance(e, MST) and e.cached_leaf_count() is None]
+
+        return self.count_loaded_leaves()
+
+    def cached_leaf_count(self):
+        """Returns this MST's leaf count from :data:`leaf_count_cache`.
+
+        Returns:
+          int, or None if it's not cached or this node's pointer is outdated:
+        """
+        if self.pointer and not self.outdated_pointer:
+            with leaf_count_lock:
+                return leaf_count_cache.get(self.pointer)
+
+    def count_loaded_leaves(self):
+        """Implements :meth:`leaf_count` after uncached subtrees are loaded.
+
         Returns:
           int:
         """
-        return len(self.leaves())
+        if (count := self.cached_leaf_count()) is not None:
+            return count
+
+        count = sum(1 if isinstance(entry, Leaf) else entry.count_loaded_leaves()
+                    for entry in self.get_entries())
+
+        if self.pointer and not self.outdated_pointer:
+            with leaf_count_lock:
+                leaf_count_cache[self.pointer] = count
+
+        return count
+
+    def count_range(self, start=None, end=None):
+        """Returns the number of leaves with keys in a range.
+
+        Only descends into the subtrees that straddle ``start`` and ``end``, at
+        most two per layer, and uses :meth:`leaf_count` for subtrees entirely
+        inside the range. Once those counts are cached, this is O(depth).
+
+        Args:
+          start (str): inclusive. None means no lower bound.
+          end (str): exclusive. None means no upper bound.
+
+        Returns:
+          int:
+        """
+        return self.count_range_within(start, end, None, None)
+
+    def count_range_within(self, start, end, after, before):
+        """Implements :meth:`count_range`.
+
+        Args:
+          start (str): inclusive, or None
+          end (str): exclusive, or None
+          after (str): all keys in this tree are greater than this, or None if
+            unknown. The key of the leaf to the left of this tree in its parent.
+          before (str): all keys in this tree are less than this, or None if
+            unknown. The key of the leaf to the right of this tree in its parent.
+
+        Returns:
+          int:
+        """
+        count = 0
+        entries = self.get_entries()
+        prev_key = after
+
+        for i, entry in enumerate(entries):
+            if isinstance(entry, Leaf):
+                if ((start is None or entry.key >= start)
+                        and (end is None or entry.key < end)):
+                    count += 1
+                prev_key = entry.key
+                continue
+
+            # this subtree's keys are all between the leaves on either side
+            next_key = entries[i + 1].key if i + 1 < len(entries) else before
+            if ((end is not None and prev_key is not None and prev_key >= end)
+                    or (start is not None and next_key is not None
+                        and next_key <= start)):
+                continue  # entirely outside
+            elif ((start is None or (prev_key is not None and prev_key >= start))
+                    and (end is None or (next_key is not None and next_key <= end))):
+                count += entry.leaf_count()  # entirely inside
+            else:
+                count += entry.count_range_within(start, end, prev_key, next_key)
+
+        return count
+
+    def count_prefix(self, prefix):
+        """Returns the number of leaves whose keys start with a given prefix.
+
+        Args:
+          prefix (str): must not be empty
+
+        Returns:
+          int:
+        """
+        return self.count_range(prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))
 
 
 #     Reachable tree traversal
@@ -906,29 +1436,121 @@ class MST:
         for cid, block in leaf_blocks.items():
             yield cid, block.encoded
 
-#     def cids_for_path(self, key):
-#         """Returns the CIDs in a given key path. ???
-#
-#         Args:
-#           key (str):
-#
-#         Returns:
-#           sequence of :class:`CID`
-#         """
-#         cids: CID[] = [self.get_pointer()]
-#         index = self.find_gt_or_equal_leaf_index(key)
-#         found = self.at_index(index)
-#         if found and isinstance(found, Leaf) and found.key == key:
-#             return cids + [found.value]
-#         prev = self.at_index(index - 1)
-#         if prev and isinstance(prev, MST):
-#             return cids + prev.cids_for_path(key)
-#         return cids
+    def cids_for_path(self, key):
+        """Returns the CIDs on the path from this node to a given key.
+
+        The path includes the record CID if the key exists. If it doesn't, the
+        path proves that it doesn't, since the key would have to be in the last
+        node.
 
+        Args:
+          key (str):
 
+        Returns:
+          list of :class:`CID`: MST node CIDs, starting with this one, and then
+          the record CID if ``key`` exists
+        """
+        cids = [self.get_pointer()]
+        index = self.find_gt_or_equal_leaf_index(key)
+        found = self.at_index(index)
+        if isinstance(found, Leaf) and found.key == key:
+            return cids + [found.value]
+
+        prev = self.at_index(index - 1)
+        if isinstance(prev, MST):
+            return cids + prev.cids_for_path(key)
+
+        return cids
+
+    def blocks_for_path(self, key):
+        """Returns the MST node blocks on the path from this node to a given key.
+
+        Walks the path once, like :meth:`cids_for_path`. Each node's block is
+        read from storage at most once, when the node itself is loaded. Nodes
+        that are already loaded or in :data:`node_cache` are re-encoded instead.
+
+        Args:
+          key (str):
+
+        Returns:
+          (list of :class:`Block`, :class:`CID`) tuple: MST node blocks,
+          starting with this one, and the record CID, or None if ``key``
+          doesn't exist
+        """
+        blocks = []
+        node = self
+
+        while True:
+            with node_cache.lock:
+                cached = node.entries is not None or node.pointer in node_cache
+
+            if cached:
+                entries = node.get_entries()
+                block = Block(decoded=serialize_node_data(entries)._asdict())
+            else:
+                block = node.storage.read(node.pointer)
+                assert block, f'MST node {node.pointer} not found'
+                decoded = decode_node_data(Data(**block.decoded))
+                node_cache.add(node.pointer, decoded)
+                node.entries = node_to_entries(storage=node.storage, node=decoded)
+                node.get_leaf_index()
+
+            blocks.append(block)
+
+            index = node.find_gt_or_equal_leaf_index(key)
+            found = node.at_index(index)
+            if isinstance(found, Leaf) and found.key == key:
+                return blocks, found.value
+
+            prev = node.at_index(index - 1)
+            if not isinstance(prev, MST):
+                return blocks, None
+            node = prev
+
+
+# maps byte to the number of leading pairs of zero bits in it, for the first
+# nonzero byte of a hash. (fully zero bytes count as 4.)
+BYTE_LEADING_ZEROS = tuple([4] + [(8 - byte.bit_length()) // 2
+                                  for byte in range(1, 256)])
+
+
+# functools.lru_cache instead of cachetools because it's implemented in C. Hits
+# are much cheaper than hashing, but a cachetools cache's overhead isn't.
+@lru_cache(maxsize=LAYER_CACHE_SIZE)
 def leading_zeros_on_hash(key):
     """Returns the number of leading zeros in a key's hash.
 
+    Memoized in a bounded LRU cache, since the same keys are hashed repeatedly,
+    eg when adding keys and loading nodes. To compute many keys' layers at once
+    without churning the cache, use :func:`leading_zeros_on_hashes`.
+
+    Args:
+      key (str or bytes)
+
+    Returns:
+      int:
+    """
+    return hash_leading_zeros(key)
+
+
+def leading_zeros_on_hashes(keys):
+    """Batch version of :func:`leading_zeros_on_hash`.
+
+    Doesn't use or populate :func:`leading_zeros_on_hash`'s cache, since bulk
+    operations like imports usually hash each key only once.
+
+    Args:
+      keys (sequence of str or bytes)
+
+    Returns:
+      list of int: layers, in the same order as ``keys``
+    """
+    return [hash_leading_zeros(key) for key in keys]
+
+
+def hash_leading_zeros(key):
+    """Computes :func:`leading_zeros_on_hash`, without caching.
+
     Args:
       key (str or bytes)
 
@@ -938,17 +1560,15 @@ def leading_zeros_on_hash(key):
     if not isinstance(key, bytes):
         key = key.encode()  # ensure_valid_key enforces that this is ASCII only
 
+    digest = sha256(key).digest()
+    # fast path: the first byte is nonzero ~99.6% of the time
+    if digest[0]:
+        return BYTE_LEADING_ZEROS[digest[0]]
+
     leading_zeros = 0
-    for byte in sha256(key).digest():
-        if byte < 64:
-             leading_zeros += 1
-        if byte < 16:
-             leading_zeros += 1
-        if byte < 4:
-             leading_zeros += 1
-        if byte == 0:
-            leading_zeros += 1
-        else:
+    for byte in digest:
+        leading_zeros += BYTE_LEADING_ZEROS[byte]
+        if byte:
             break
 
     return leading_zeros
@@ -976,10 +1596,22 @@ def deserialize_node_data(*, storage=None, data=None, layer=None):
     Returns:
       sequence of MST and Leaf:
     """
+    return node_to_entries(storage=storage, node=decode_node_data(data),
+                           layer=layer)
+
+
+def decode_node_data(data):
+    """Decodes a serialized node, independent of storage.
+
+    Args:
+      data (Data)
+
+    Returns:
+      tuple of Leaf and CID: CIDs are subtree pointers
+    """
     entries = []
     if (data.l is not None):
-        entries.append(MST(storage=storage, pointer=data.l,
-                           layer=layer - 1 if layer else None))
+        entries.append(data.l)
 
     last_key = ''
     for entry_data in data.e:
@@ -990,10 +1622,173 @@ def deserialize_node_data(*, storage=None, data=None, layer=None):
         entries.append(Leaf(key, entry.v))
         last_key = key
         if entry.t is not None:
-            entries.append(MST(storage=storage, pointer=entry.t,
-                               layer=layer - 1 if layer else None))
+            entries.append(entry.t)
+
+    return tuple(entries)
+
+
+def node_to_entries(*, storage=None, node=None, layer=None):
+    """Converts a decoded node to entries, with new :class:`MST` s for subtrees.
+
+    Args:
+      storage (Storage)
+      node (tuple of Leaf and CID): from :func:`decode_node_data`
+      layer (int): optional. If not provided, calculated from the node's first
+        leaf, if any.
+
+    Returns:
+      tuple of MST and Leaf:
+    """
+    if layer is None:
+        layer = layer_for_entries(node)
+
+    child_layer = layer - 1 if layer else None
+    return tuple(entry if isinstance(entry, Leaf)
+                 else MST(storage=storage, pointer=entry, layer=child_layer)
+                 for entry in node)
+
+
+def node_size(node):
+    """Returns the approximate size in memory of a decoded node, in bytes.
+
+    Used as ``getsizeof`` for :class:`NodeCache`.
+
+    Args:
+      node (tuple of Leaf and CID): from :func:`decode_node_data`
+
+    Returns:
+      int:
+    """
+    return NODE_OVERHEAD + sum(
+        LEAF_OVERHEAD + len(entry.key) if isinstance(entry, Leaf)
+        else SUBTREE_OVERHEAD
+        for entry in node)
+
 
-    return entries
+class NodeCache(LRUCache):
+    """Process-wide LRU cache of decoded MST nodes, keyed by CID, bounded by bytes.
+
+    Values are tuples of :class:`Leaf` and :class:`CID`, as returned by
+    :func:`decode_node_data`, so they're immutable and independent of storage,
+    and can be shared by any :class:`MST`. Nodes are content-addressed, so
+    entries never need to be invalidated.
+
+    Thread safe.
+
+    Attributes:
+      hits (int): number of :meth:`load` calls served from cache
+      misses (int): number of :meth:`load` calls that read from storage
+      evictions (int): number of nodes evicted to stay under ``maxsize``
+    """
+    def __init__(self, maxsize):
+        """Constructor.
+
+        Args:
+          maxsize (int): maximum total size of cached nodes, in bytes
+        """
+        super().__init__(maxsize=maxsize, getsizeof=node_size)
+        self.lock = Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def load(self, storage, cid):
+        """Returns a decoded node, from the cache if possible, else storage.
+
+        Args:
+          storage (Storage)
+          cid (CID)
+
+        Returns:
+          tuple of Leaf and CID: see :func:`decode_node_data`
+        """
+        with self.lock:
+            node = self.get(cid)
+            if node is not None:
+                self.hits += 1
+                return node
+            self.misses += 1
+
+        node = decode_node_data(Data(**storage.read(cid).decoded))
+        self.add(cid, node)
+        return node
+
+    def load_many(self, storage, cids):
+        """Returns decoded nodes, from the cache if possible, else storage.
+
+        Reads all nodes that aren't cached with a single
+        :meth:`Storage.read_many` call.
+
+        Args:
+          storage (Storage)
+          cids (sequence of CID)
+
+        Returns:
+          dict: maps CID to tuple of Leaf and CID, see :func:`decode_node_data`
+        """
+        found = {}
+        missing = []
+        with self.lock:
+            for cid in dict.fromkeys(cids):
+                node = self.get(cid)
+                if node is None:
+                    self.misses += 1
+                    missing.append(cid)
+                else:
+                    self.hits += 1
+                    found[cid] = node
+
+        if missing:
+            for cid, block in storage.read_many(missing).items():
+                assert block, f'MST node {cid} not found'
+                node = found[cid] = decode_node_data(Data(**block.decoded))
+                self.add(cid, node)
+
+        return found
+
+    def add(self, cid, node):
+        """Adds a decoded node to the cache, unless it's larger than ``maxsize``.
+
+        Args:
+          cid (CID)
+          node (tuple of Leaf and CID): see :func:`decode_node_data`
+        """
+        if node_size(node) <= self.maxsize:
+            with self.lock:
+                self[cid] = node
+
+    def popitem(self):
+        self.evictions += 1
+        return super().popitem()
+
+    def clear(self):
+        """Empties the cache and resets the counters."""
+        with self.lock:
+            super().clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Returns the current counters and size.
+
+        Returns:
+          dict: with int values for ``hits``, ``misses``, ``evictions``,
+          ``nodes``, ``size``, and ``maxsize``
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'nodes': len(self),
+            'size': self.currsize,
+            'maxsize': self.maxsize,
+        }
+
+
+node_cache = NodeCache(maxsize=NODE_CACHE_SIZE)
+
+# Process-wide side index of subtree sizes: maps node CID to the number of
+# leaves in that subtree. Populated by MST.leaf_count. Like node_cache, nodes
+# are content-addressed, so entries never need to be invalidated.
+leaf_count_cache = LRUCache(maxsize=LEAF_COUNT_CACHE_SIZE)
+leaf_count_lock = Lock()
 
 
 def serialize_node_data(entries):
@@ -16,7 +16,7 @@ import dag_cbor
 from multiformats import CID
 
 from . import util
-from .diff import Diff
+from .diff import Diff, mst_changes
 from .mst import MST
 from .server import server
 from .storage import (
@@ -96,11 +96,11 @@ class Repo:
           status (str): None (if active) or ``'deactivated'``, ``'deleted'``,
             or ``'tombstoned'`` (deprecated)
           callback (callable, (CommitData | dict) => None)
-          signing_key (ec.EllipticCurvePrivateKey): required
+          signing_key (ec.EllipticCurvePrivateKey): required to write commits.
+            None if the repo was loaded without keys, ie read only.
           rotation_key (ec.EllipticCurvePrivateKey)
         """
         assert storage
-        assert signing_key
 
         self.storage = storage
         self.mst = mst
@@ -141,6 +141,62 @@ class Repo:
         if cid:
             return self.storage.read(cid).decoded
 
+    def diff(self, from_commit_cid, to_commit_cid=None):
+        """Generates the record changes between two commits in this repo.
+
+        See :func:`diff.mst_changes` for details. Only loads the MST nodes
+        that differ between the two commits.
+
+        Args:
+          from_commit_cid (CID): None means the empty repo before the first
+            commit
+          to_commit_cid (CID): defaults to the current head
+
+        Yields:
+          diff.Change: ``prev`` is None for new records, ``cid`` is None for
+          deleted records
+
+        Raises:
+          ValueError: if either commit isn't in this repo
+        """
+        to_commit_cid = to_commit_cid or self.head.cid
+        commits = self.storage.read_many(
+            {cid for cid in (from_commit_cid, to_commit_cid) if cid})
+
+        def load_mst(cid):
+            commit = commits.get(cid)
+            if not (commit and commit.decoded.get('did') == self.did
+                    and commit.decoded.get('data')):
+                raise ValueError(f'Commit {cid} not found in {self.did}')
+            return MST.load(storage=self.storage, cid=commit.decoded['data'])
+
+        to_mst = load_mst(to_commit_cid)
+        from_mst = load_mst(from_commit_cid) if from_commit_cid else None
+        return mst_changes(to_mst, from_mst)
+
+    def get_record_proof(self, collection, rkey):
+        """Returns the blocks that prove a record's inclusion in this repo.
+
+        If the record doesn't exist, they prove that instead. Walks the MST
+        path once with :meth:`MST.blocks_for_path`, which reads each path node
+        from storage at most once, then reads the record.
+
+        Args:
+          collection (str)
+          rkey (str)
+
+        Returns:
+          (list of :class:`Block`, :class:`Block`) tuple: the head commit, the
+          MST nodes on the path from the root to the record, in order, and the
+          record if it exists; and the record, or None if it doesn't exist
+        """
+        nodes, record_cid = self.mst.blocks_for_path(f'{collection}/{rkey}')
+        record = self.storage.read(record_cid) if record_cid else None
+        blocks = [self.head] + nodes
+        if record:
+            blocks.append(record)
+        return blocks, record
+
     def get_contents(self):
         """
 
@@ -156,6 +212,37 @@ class Repo:
 
         return contents
 
+    def collections(self):
+        """Returns the names of this repo's collections, in MST key order.
+
+        Seeks from each collection to the next with :meth:`MST.walk_leaves_from`
+        instead of walking the whole tree, and doesn't count records.
+
+        Returns:
+          list of str:
+        """
+        collections = []
+        start = ''
+        while leaf := next(self.mst.walk_leaves_from(key=start), None):
+            collection = leaf.key.split('/', 1)[0]
+            collections.append(collection)
+            # '0' is the character right after '/'
+            start = f'{collection}0'
+
+        return collections
+
+    def collection_counts(self):
+        """Counts the records in each collection without walking the whole tree.
+
+        Finds collections with :meth:`collections` and counts each one with
+        :meth:`MST.count_prefix`.
+
+        Returns:
+          dict mapping str collection to int number of records:
+        """
+        return {collection: self.mst.count_prefix(f'{collection}/')
+                for collection in self.collections()}
+
     @classmethod
     def create_from_commit(cls, storage, commit_data, *, signing_key,
                            rotation_key=None, **kwargs):
@@ -266,6 +353,7 @@ class Repo:
             storage = repo.storage
             repo_did = repo.did
             signing_key = repo.signing_key
+            assert signing_key, f'{repo_did} was loaded without keys'
             mst = repo.mst
             cur_head = repo.head.cid
 
@@ -275,26 +363,25 @@ class Repo:
         commit_blocks = {}  # maps CID to Block
         if writes is None:
             writes = []
-        orig_mst = mst
 
+        ops = []
         for write in writes:
             assert isinstance(write, Write), type(write)
-            data_key = f'{write.collection}/{write.rkey}'
+            cid = None
+
+            if write.action != Action.DELETE:
+                # raises ValidationError if it doesn't validate
+                server.validate(write.record.get('$type'), 'record', write.record)
 
-            if write.action == Action.DELETE:
-                mst = mst.delete(data_key)
-                continue
+                block = Block(decoded=write.record, repo=repo_did)
+                commit_blocks[block.cid] = block
+                cid = block.cid
 
-            # raises ValidationError if it doesn't validate
-            server.validate(write.record.get('$type'), 'record', write.record)
+            ops.append(CommitOp(action=write.action,
+                                path=f'{write.collection}/{write.rkey}', cid=cid))
 
-            block = Block(decoded=write.record, repo=repo_did)
-            commit_blocks[block.cid] = block
-            if write.action == Action.CREATE:
-                mst = mst.add(data_key, block.cid)
-            else:
-                assert write.action == Action.UPDATE
-                mst = mst.update(data_key, block.cid)
+        diff = Diff()
+        mst = mst.apply_batch(ops, diff=diff)
 
         root, unstored_blocks = mst.get_unstored_blocks()
         for block in unstored_blocks.values():
@@ -303,7 +390,6 @@ class Repo:
 
         # ensure we're not missing any blocks that were removed and then
         # re-added in this commit
-        diff = Diff.of(mst, orig_mst)
         missing = diff.new_cids - commit_blocks.keys()
         if missing:
             commit_blocks.update(storage.read_many(missing))
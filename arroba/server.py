@@ -25,13 +25,26 @@ def auth():
         raise ValueError('Invalid bearer token in Authorization header')
 
 
-def load_repo(did_or_at_uri):
+def load_repo(did_or_at_uri, with_keys=True):
+    """Loads a repo for an XRPC method.
+
+    Args:
+      did_or_at_uri (str): DID, handle, or ``at://`` URI
+      with_keys (bool): whether to load the repo's keys. Read-only methods
+        should pass False.
+
+    Returns:
+      Repo:
+
+    Raises:
+      XrpcError: if the repo doesn't exist or isn't active
+    """
     if did_or_at_uri.startswith('at://'):
         did_or_handle, _, _ = parse_at_uri(did_or_at_uri)
     else:
         did_or_handle = did_or_at_uri
 
-    repo = storage.load_repo(did_or_handle)
+    repo = storage.load_repo(did_or_handle, with_keys=with_keys)
     if not repo:
         raise XrpcError(f'Repo {did_or_handle} not found', name='RepoNotFound')
     elif repo.status:
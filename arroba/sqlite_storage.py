@@ -0,0 +1,447 @@
+"""SQLite implementation of repo storage, for single node deployments."""
+from contextlib import contextmanager
+from datetime import datetime
+import itertools
+import json
+import logging
+import sqlite3
+import threading
+import weakref
+
+from multiformats import CID
+
+from .mst import MST
+from .repo import Repo
+from .storage import (
+    Action,
+    Block,
+    CommitOp,
+    Storage,
+    SUBSCRIBE_REPOS_NSID,
+)
+from .util import (
+    DEACTIVATED,
+    DELETED,
+    InactiveRepo,
+    load_private_key,
+    private_key_pem,
+    tid_to_int,
+    TOMBSTONED,
+)
+
+logger = logging.getLogger(__name__)
+
+# max number of bound parameters per statement. SQLite's compiled in limit is
+# 999 before 3.32.0 and 32766 after.
+# https://www.sqlite.org/limits.html#max_variable_number
+MAX_VARIABLES = 999
+
+# number of blocks that read_blocks_by_seq fetches per query
+BLOCKS_PAGE_SIZE = 1000
+
+# how long connections wait for other connections' locks before raising
+# sqlite3.OperationalError, in seconds
+# https://www.sqlite.org/c3ref/busy_timeout.html
+TIMEOUT = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS repos (
+  did TEXT PRIMARY KEY,
+  handle TEXT,
+  head TEXT NOT NULL,
+  signing_key_pem BLOB NOT NULL,
+  rotation_key_pem BLOB,
+  status TEXT
+);
+CREATE INDEX IF NOT EXISTS repos_handle ON repos (handle);
+
+CREATE TABLE IF NOT EXISTS blocks (
+  cid BLOB PRIMARY KEY,
+  repo TEXT NOT NULL,
+  encoded BLOB NOT NULL,
+  seq INTEGER NOT NULL,
+  ops TEXT,
+  time TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blocks_seq ON blocks (seq);
+CREATE INDEX IF NOT EXISTS blocks_repo_seq ON blocks (repo, seq);
+
+CREATE TABLE IF NOT EXISTS sequences (
+  nsid TEXT PRIMARY KEY,
+  next INTEGER NOT NULL
+);
+"""
+
+BLOCK_COLUMNS = 'cid, repo, encoded, seq, ops, time'
+REPO_COLUMNS = 'did, handle, head, signing_key_pem, rotation_key_pem, status'
+
+# unique names for in-memory databases. not id(), since ids can be reused while
+# an old database's connections are still open.
+_memory_db_ids = itertools.count()
+
+
+def chunks(seq, size):
+    """Splits a sequence into lists of at most ``size`` elements.
+
+    Args:
+      seq (iterable)
+      size (int)
+
+    Yields:
+      list:
+    """
+    it = iter(seq)
+    while chunk := list(itertools.islice(it, size)):
+        yield chunk
+
+
+class SqliteStorage(Storage):
+    """SQLite implementation of :class:`Storage`.
+
+    Stores everything in a single SQLite database file in WAL mode, so that
+    readers, eg ``subscribeRepos`` streams, don't block the writer and vice
+    versa. Each thread gets its own connection. Call :meth:`close` to close
+    them all when you're done.
+
+    Tables:
+
+    * ``repos``: one row per repo, keyed by DID, indexed by handle.
+    * ``blocks``: one row per block, keyed by binary :class:`CID`, indexed by
+      ``seq`` and ``(repo, seq)``.
+    * ``sequences``: next sequence number for each NSID.
+
+    Like :class:`DatastoreStorage`, all blocks in a given commit have the same
+    sequence number, and blocks that already exist keep their original sequence
+    numbers.
+
+    See :class:`Storage` for method details.
+
+    Attributes:
+      path (str): database file path, or ``:memory:``
+    """
+    path = None
+
+    def __init__(self, path=':memory:'):
+        """Constructor.
+
+        Args:
+          path (str): database file path. If ``:memory:``, the default, uses a
+            private, shared cache in-memory database that lives as long as this
+            object.
+        """
+        super().__init__()
+        self.path = path
+        self._local = threading.local()
+        # maps Thread to its connection, so close() can close them all. weak so
+        # that exited threads' connections are closed when they're collected.
+        self._conns = weakref.WeakKeyDictionary()
+        self._conns_lock = threading.Lock()
+        self._keepalive = None
+
+        if path == ':memory:':
+            self._uri = (f'file:arroba-{next(_memory_db_ids)}'
+                         '?mode=memory&cache=shared')
+            # keep one connection open so the in-memory database stays alive
+            self._keepalive = self._connect()
+        else:
+            self._uri = None
+
+        self.db.executescript(SCHEMA)
+
+    def _connect(self):
+        """Opens and configures a new connection.
+
+        Returns:
+          sqlite3.Connection:
+        """
+        # each connection is only used by its own thread, but close() may close
+        # it from a different thread
+        conn = sqlite3.connect(self._uri or self.path, uri=bool(self._uri),
+                               isolation_level=None, check_same_thread=False,
+                               timeout=TIMEOUT)
+
+        conn.execute('PRAGMA journal_mode = WAL')
+        # with WAL, NORMAL only risks losing the last transactions on power
+        # loss, not corruption
+        # https://www.sqlite.org/pragma.html#pragma_synchronous
+        conn.execute('PRAGMA synchronous = NORMAL')
+        return conn
+
+    @property
+    def db(self):
+        """(sqlite3.Connection) this thread's connection."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            with self._conns_lock:
+                self._conns[threading.current_thread()] = conn
+        return conn
+
+    def close(self):
+        """Closes all of this storage's connections, from all threads.
+
+        If this is an in-memory database, it's discarded.
+        """
+        with self._conns_lock:
+            conns = list(self._conns.values())
+            self._conns.clear()
+
+        if self._keepalive:
+            conns.append(self._keepalive)
+            self._keepalive = None
+
+        for conn in conns:
+            conn.close()
+
+        self._local = threading.local()
+
+    @contextmanager
+    def transaction(self):
+        """Context manager for a write transaction.
+
+        Takes the database's write lock up front with ``BEGIN IMMEDIATE``, so
+        that reads inside the transaction can't go stale. Nested calls join the
+        outer transaction.
+
+        Yields:
+          sqlite3.Connection:
+        """
+        db = self.db
+        if db.in_transaction:
+            yield db
+            return
+
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def create_repo(self, repo, *, signing_key, rotation_key=None):
+        assert repo.did
+        assert repo.head
+
+        with self.transaction() as db:
+            db.execute(f"""
+              INSERT INTO repos ({REPO_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)
+              ON CONFLICT (did) DO UPDATE SET
+                handle = excluded.handle,
+                head = excluded.head,
+                signing_key_pem = excluded.signing_key_pem,
+                rotation_key_pem = excluded.rotation_key_pem,
+                status = excluded.status
+            """, (repo.did, repo.handle, repo.head.cid.encode('base32'),
+                  private_key_pem(signing_key), private_key_pem(rotation_key),
+                  repo.status))
+
+        logger.info(f'Stored repo {repo.did}')
+
+    def load_repo(self, did_or_handle, *, with_keys=True):
+        assert did_or_handle
+
+        row = (self.db.execute(f'SELECT {REPO_COLUMNS} FROM repos WHERE did = ?',
+                               (did_or_handle,)).fetchone()
+               or self.db.execute(
+                   f'SELECT {REPO_COLUMNS} FROM repos WHERE handle = ? LIMIT 1',
+                   (did_or_handle,)).fetchone())
+
+        if not row:
+            logger.info(f"Couldn't find repo for {did_or_handle}")
+            return None
+
+        did, handle, head, signing_key_pem, rotation_key_pem, status = row
+        logger.info(f'Loading repo {did}')
+        self.head = CID.decode(head)
+        keys = {}
+        if with_keys:
+            keys = {'signing_key': load_private_key(signing_key_pem),
+                    'rotation_key': load_private_key(rotation_key_pem)}
+        return Repo.load(self, cid=self.head, handle=handle, status=status,
+                         **keys)
+
+    def load_repos(self, after=None, limit=500):
+        rows = self.db.execute(
+            f'SELECT {REPO_COLUMNS} FROM repos WHERE did > ? ORDER BY did LIMIT ?',
+            (after or '', limit)).fetchall()
+
+        # duplicates parts of Repo.load but batches reading blocks from storage
+        cids = [CID.decode(row[2]) for row in rows]
+        blocks = self.read_many(cids)
+        heads = [blocks[cid] for cid in cids]
+
+        # MST.load doesn't read from storage
+        return [Repo(storage=self, head=head, handle=handle, status=status,
+                     mst=MST.load(storage=self, cid=head.decoded['data']),
+                     signing_key=load_private_key(signing_key_pem),
+                     rotation_key=load_private_key(rotation_key_pem))
+                for (_, handle, _, signing_key_pem, rotation_key_pem, status), head
+                in zip(rows, heads)]
+
+    def _set_repo_status(self, repo, status):
+        assert status in (DEACTIVATED, DELETED, TOMBSTONED, None)
+        repo.status = status
+
+        with self.transaction() as db:
+            db.execute('UPDATE repos SET status = ? WHERE did = ?',
+                       (status, repo.did))
+
+    @staticmethod
+    def _to_row(block, repo_did, seq):
+        """Converts a :class:`Block` to a ``blocks`` table row.
+
+        Args:
+          block (Block)
+          repo_did (str)
+          seq (int)
+
+        Returns:
+          tuple: values for :const:`BLOCK_COLUMNS`
+        """
+        ops = None
+        if block.ops is not None:
+            ops = json.dumps([[op.action.name, op.path,
+                               op.cid.encode('base32') if op.cid else None]
+                              for op in block.ops])
+
+        return (bytes(block.cid), repo_did, block.encoded, seq, ops,
+                block.time.isoformat())
+
+    @staticmethod
+    def _from_row(row):
+        """Converts a ``blocks`` table row to a :class:`Block`.
+
+        Args:
+          row (tuple): values for :const:`BLOCK_COLUMNS`
+
+        Returns:
+          Block:
+        """
+        cid, repo, encoded, seq, ops, time = row
+        if ops is not None:
+            ops = [CommitOp(action=Action[action], path=path,
+                            cid=CID.decode(cid) if cid else None)
+                   for action, path, cid in json.loads(ops)]
+
+        return Block(cid=CID.decode(cid), encoded=encoded, seq=seq, ops=ops,
+                     time=datetime.fromisoformat(time), repo=repo)
+
+    def read(self, cid):
+        row = self.db.execute(f'SELECT {BLOCK_COLUMNS} FROM blocks WHERE cid = ?',
+                              (bytes(cid),)).fetchone()
+        if row:
+            return self._from_row(row)
+
+    def read_many(self, cids, require_all=True):
+        cids = list(cids)
+        found = {}
+
+        for chunk in chunks(cids, MAX_VARIABLES):
+            query = (f'SELECT {BLOCK_COLUMNS} FROM blocks '
+                     f'WHERE cid IN ({",".join("?" * len(chunk))})')
+            for row in self.db.execute(query, [bytes(cid) for cid in chunk]):
+                block = self._from_row(row)
+                found[block.cid] = block
+
+        return {cid: found.get(cid) for cid in cids}
+
+    def read_blocks_by_seq(self, start=0, repo=None):
+        assert start >= 0
+
+        # page with a (seq, rowid) cursor instead of holding one query open, so
+        # that long running readers like subscribeRepos don't pin an old WAL
+        # snapshot and block checkpoints
+        where = 'repo = ? AND ' if repo else ''
+        query = f"""
+          SELECT rowid, {BLOCK_COLUMNS} FROM blocks
+          WHERE {where}(seq, rowid) > (?, ?)
+          ORDER BY seq, rowid
+          LIMIT {BLOCKS_PAGE_SIZE}
+        """
+        cursor = (start, 0)  # rowids start at 1
+
+        while True:
+            params = ((repo,) if repo else ()) + cursor
+            rows = self.db.execute(query, params).fetchall()
+            for row in rows:
+                yield self._from_row(row[1:])
+
+            if len(rows) < BLOCKS_PAGE_SIZE:
+                return
+            cursor = (rows[-1][4], rows[-1][0])
+
+    def has(self, cid):
+        return self.db.execute('SELECT 1 FROM blocks WHERE cid = ?',
+                               (bytes(cid),)).fetchone() is not None
+
+    def has_many(self, cids):
+        cids = list(cids)
+        found = set()
+
+        for chunk in chunks(cids, MAX_VARIABLES):
+            query = (f'SELECT cid FROM blocks '
+                     f'WHERE cid IN ({",".join("?" * len(chunk))})')
+            found.update(row[0] for row in
+                         self.db.execute(query, [bytes(cid) for cid in chunk]))
+
+        return {cid: bytes(cid) in found for cid in cids}
+
+    def write(self, repo_did, obj, seq=None):
+        if seq is None:
+            seq = self.allocate_seq(SUBSCRIBE_REPOS_NSID)
+
+        block = Block(decoded=obj, seq=seq, repo=repo_did)
+        with self.transaction() as db:
+            # OR IGNORE so we don't wipe out an existing block's sequence number
+            db.execute(f'INSERT OR IGNORE INTO blocks ({BLOCK_COLUMNS}) '
+                       f'VALUES (?, ?, ?, ?, ?, ?)',
+                       self._to_row(block, repo_did, seq))
+        return block
+
+    def apply_commit(self, commit_data):
+        commit = commit_data.commit.decoded
+        seq = tid_to_int(commit['rev'])
+        assert seq
+
+        with self.transaction() as db:
+            row = db.execute('SELECT status FROM repos WHERE did = ?',
+                             (commit['did'],)).fetchone()
+            if row and row[0]:
+                raise InactiveRepo(commit['did'], row[0])
+
+            # OR IGNORE so we don't wipe out any existing blocks' sequence
+            # numbers. (occasionally we see existing blocks recur, eg MST nodes.)
+            db.executemany(
+                f'INSERT OR IGNORE INTO blocks ({BLOCK_COLUMNS}) '
+                f'VALUES (?, ?, ?, ?, ?, ?)',
+                (self._to_row(block, commit['did'], seq)
+                 for block in commit_data.blocks.values()))
+
+            self.head = commit_data.commit.cid
+            if row:
+                db.execute('UPDATE repos SET head = ? WHERE did = ?',
+                           (self.head.encode('base32'), commit['did']))
+
+        for block in commit_data.blocks.values():
+            block.seq = seq
+
+    def allocate_seq(self, nsid):
+        assert nsid
+
+        with self.transaction() as db:
+            db.execute('INSERT OR IGNORE INTO sequences (nsid, next) VALUES (?, 1)',
+                       (nsid,))
+            seq = db.execute('SELECT next FROM sequences WHERE nsid = ?',
+                             (nsid,)).fetchone()[0]
+            db.execute('UPDATE sequences SET next = next + 1 WHERE nsid = ?',
+                       (nsid,))
+
+        return seq
+
+    def last_seq(self, nsid):
+        assert nsid
+
+        row = self.db.execute('SELECT next FROM sequences WHERE nsid = ?',
+                              (nsid,)).fetchone()
+        return row[0] - 1 if row else 0
@@ -3,9 +3,9 @@
 Lightly based on:
 https://github.com/bluesky-social/atproto/blob/main/packages/repo/src/storage/repo-storage.ts
 """
+from bisect import bisect_left, bisect_right
 from collections import namedtuple
 from enum import auto, Enum
-import itertools
 
 import dag_cbor
 from multiformats import CID, multicodec, multihash
@@ -15,6 +15,9 @@ from .util import dag_cbor_cid, DEACTIVATED, tid_to_int, TOMBSTONED, InactiveRep
 
 SUBSCRIBE_REPOS_NSID = 'com.atproto.sync.subscribeRepos'
 
+# number of events that read_events_by_seq assembles at a time
+READ_EVENTS_WINDOW = 100
+
 
 class Action(Enum):
     """Used in :meth:`Repo.format_commit`.
@@ -68,7 +71,7 @@ class Block:
     Attributes:
       cid (CID): lazy-loaded (dynamic property)
       decoded (dict): decoded object (dynamic property)
-      encoded (bytes): DAG-CBOR encoded data (dynamic property)
+      encoded (bytes or memoryview): DAG-CBOR encoded data (dynamic property)
       seq (int): ``com.atproto.sync.subscribeRepos`` sequence number
       ops (list): :class:`CommitOp`\s if this is a commit, otherwise None
       time (datetime): when this block was first created
@@ -77,6 +80,9 @@ class Block:
         includes it. In practice, it's often the first or last repo that
         included it.
     """
+    # we hold lots of these in memory, so avoid per-instance __dict__s
+    __slots__ = ('_cid', '_encoded', '_decoded', 'seq', 'ops', 'time', 'repo')
+
     def __init__(self, *, cid=None, decoded=None, encoded=None, seq=None,
                  ops=None, time=None, repo=None):
         """Constructor.
@@ -84,7 +90,7 @@ class Block:
         Args:
           cid (CID): optional
           decoded (dict): optional
-          encoded (bytes): optional
+          encoded (bytes or memoryview): optional
         """
         assert encoded or decoded
         self._cid = cid
@@ -114,7 +120,10 @@ class Block:
     @property
     def decoded(self):
         if self._decoded is None:
-            self._decoded = dag_cbor.decode(self.encoded)
+            encoded = self.encoded
+            if isinstance(encoded, memoryview):  # dag_cbor only decodes bytes
+                encoded = bytes(encoded)
+            self._decoded = dag_cbor.decode(encoded)
         return self._decoded
 
     def __eq__(self, other):
@@ -154,11 +163,15 @@ class Storage:
         """
         raise NotImplementedError()
 
-    def load_repo(self, did_or_handle):
+    def load_repo(self, did_or_handle, *, with_keys=True):
         """Loads a repo from storage.
 
         Args:
           did_or_handle (str): optional
+          with_keys (bool): whether to load the repo's signing and rotation
+            keys. If False, the returned repo's keys may be None, so it can be
+            read but not written. Storage implementations may skip parsing the
+            keys in that case.
 
         Returns:
           Repo, or None if the did or handle wasn't found:
@@ -279,13 +292,20 @@ class Storage:
         """
         raise NotImplementedError()
 
-    def read_events_by_seq(self, start=0, repo=None):
+    def read_events_by_seq(self, start=0, repo=None, window_size=None):
         """Batch read commits and other events by ``subscribeRepos`` sequence number.
 
+        Assembles up to ``window_size`` events at a time, and reads the records
+        that their commits need but don't include with a single
+        :meth:`read_many` call per window.
+
         Args:
           start (int): optional ``subscribeRepos`` sequence number to start from,
             inclusive. Defaults to 0.
           repo (str): optional repo DID. If not provided, all repos are included.
+          window_size (int): optional number of events to assemble before
+            yielding any of them. Defaults to :const:`READ_EVENTS_WINDOW`. Use 1
+            to yield each event as soon as it's read, eg when tailing new events.
 
         Returns:
           generator: generator of :class:`CommitData` for commits and dict
@@ -293,24 +313,42 @@ class Storage:
           ascending ``seq`` order
         """
         assert start >= 0
+        if window_size is None:
+            window_size = READ_EVENTS_WINDOW
+        assert window_size >= 1
 
         seq = commit_block = blocks = None
+        window = []  # CommitData and message dicts, in seq order
 
         def make_commit():
-            for op in commit_block.ops:
-                if (op.action in (Action.CREATE, Action.UPDATE)
-                        and op.cid not in blocks):
-                    record = self.read(op.cid)
-                    assert record
-                    blocks[op.cid] = record
             return CommitData(blocks=blocks, commit=commit_block,
                               prev=commit_block.decoded.get('prev'))
 
+        def flush():
+            # commits' blocks don't include records that were already stored
+            # before, since they keep their original seq, so fetch those for
+            # the whole window at once
+            missing = {op.cid for event in window if isinstance(event, CommitData)
+                       for op in event.commit.ops
+                       if (op.action in (Action.CREATE, Action.UPDATE)
+                           and op.cid not in event.blocks)}
+            if missing:
+                records = self.read_many(list(missing))
+                for event in window:
+                    if isinstance(event, CommitData):
+                        for op in event.commit.ops:
+                            if op.cid in missing:
+                                assert records[op.cid], op.cid
+                                event.blocks[op.cid] = records[op.cid]
+
+            yield from window
+            window.clear()
+
         for block in self.read_blocks_by_seq(start=start, repo=repo):
             assert block.seq
             if block.seq != seq:  # switching to a new commit's blocks
                 if commit_block:
-                    yield make_commit()
+                    window.append(make_commit())
                 else:
                     # we shouldn't have any dangling blocks that we don't serve
                     assert not blocks
@@ -318,9 +356,12 @@ class Storage:
                 blocks = {}  # maps CID to Block
                 commit_block = None
 
+                if len(window) >= window_size:
+                    yield from flush()
+
             if block.decoded.get('$type', '').startswith(
                     'com.atproto.sync.subscribeRepos#'):  # non-commit message
-                yield block.decoded
+                window.append(block.decoded)
                 continue
 
             blocks[block.cid] = block
@@ -331,7 +372,9 @@ class Storage:
         # final commit
         if blocks:
             assert commit_block, f'seq {seq}'
-            yield make_commit()
+            window.append(make_commit())
+
+        yield from flush()
 
     def has(self, cid):
         """Checks if a given :class:`CID` is currently stored.
@@ -344,6 +387,20 @@ class Storage:
         """
         raise NotImplementedError()
 
+    def has_many(self, cids):
+        """Batch checks whether multiple :class:`CID` s are currently stored.
+
+        Subclasses should override this with a single round trip that doesn't
+        read the blocks' contents, if possible.
+
+        Args:
+          cids (sequence of CID)
+
+        Returns:
+          dict: {:class:`CID`: bool}
+        """
+        return {cid: self.has(cid) for cid in cids}
+
     def write(self, repo_did, obj, seq=None):
         """Writes a node to storage.
 
@@ -434,6 +491,17 @@ class Storage:
 class MemoryStorage(Storage):
     """In memory storage implementation.
 
+    Blocks are also indexed by ``seq``, overall and per repo, in sorted lists
+    that :meth:`read_blocks_by_seq` bisects into. Blocks are almost always
+    written in ``seq`` order, so inserts are nearly always appends.
+
+    Repos are indexed by DID in a sorted list that :meth:`load_repos` bisects
+    into, and by handle. The handle index is updated by :meth:`create_repo`,
+    so after changing a repo's :attr:`Repo.handle`, pass it to
+    :meth:`create_repo` again to update the index. :meth:`load_repo` also
+    checks the indexed repo's current handle, so it never returns a repo for
+    a handle it no longer has.
+
     Attributes:
       repos (dict mapping str DID to :class:`Repo`)
       blocks (dict): {:class:`CID`: :class:`Block`}
@@ -449,25 +517,70 @@ class MemoryStorage(Storage):
         self.blocks = {}
         self.repos = {}
         self.sequences = {}
+        # seq index: parallel lists of seqs and Blocks, sorted by seq
+        self._seqs = []
+        self._seq_blocks = []
+        # per repo seq indexes: maps DID to (seqs, Blocks) lists
+        self._repo_seqs = {}
+        # maps handle to DID, and DID to handle
+        self._handles = {}
+        self._repo_handles = {}
+        # sorted list of DIDs in self.repos
+        self._dids = []
+
+    def _add_block(self, block):
+        """Stores a new block and adds it to the seq indexes.
+
+        Args:
+          block (Block)
+        """
+        self.blocks[block.cid] = block
+
+        indexes = [(self._seqs, self._seq_blocks)]
+        if block.repo:
+            indexes.append(self._repo_seqs.setdefault(block.repo, ([], [])))
+
+        for seqs, blocks in indexes:
+            i = bisect_right(seqs, block.seq)
+            seqs.insert(i, block.seq)
+            blocks.insert(i, block)
 
     def create_repo(self, repo, *, signing_key, rotation_key=None):
-        assert repo.did not in self.repos
+        if repo.did not in self.repos:
+            self._dids.insert(bisect_left(self._dids, repo.did), repo.did)
         self.repos[repo.did] = repo
+        self._set_handle(repo.did, repo.handle)
 
-    def load_repo(self, did_or_handle):
+    def _set_handle(self, did, handle):
+        """Updates the handle index for a repo.
+
+        Args:
+          did (str)
+          handle (str or None)
+        """
+        if old := self._repo_handles.pop(did, None):
+            if self._handles.get(old) == did:
+                del self._handles[old]
+
+        if handle:
+            self._handles[handle] = did
+            self._repo_handles[did] = handle
+
+    def load_repo(self, did_or_handle, *, with_keys=True):
         assert did_or_handle
 
-        for repo in self.repos.values():
-            if did_or_handle in (repo.did, repo.handle):
-                return repo
+        if repo := self.repos.get(did_or_handle):
+            return repo
 
-    def load_repos(self, after=None, limit=500):
-        it = iter(sorted(self.repos.values(), key=lambda repo: repo.did))
+        did = self._handles.get(did_or_handle)
+        if did and (repo := self.repos.get(did)) and repo.handle == did_or_handle:
+            return repo
 
-        if after:
-            it = itertools.dropwhile(lambda repo: repo.did <= after, it)
+        return None
 
-        return list(itertools.islice(it, limit))
+    def load_repos(self, after=None, limit=500):
+        start = bisect_right(self._dids, after) if after else 0
+        return [self.repos[did] for did in self._dids[start:start + limit]]
 
     def _set_repo_status(self, repo, status):
         repo.status = status
@@ -484,20 +597,23 @@ class MemoryStorage(Storage):
 
     def read_blocks_by_seq(self, start=0, repo=None):
         assert start >= 0
-        return sorted((b for b in self.blocks.values()
-                       if b.seq >= start and (not repo or b.repo == repo)),
-                      key=lambda b: b.seq)
+        seqs, blocks = (self._repo_seqs.get(repo, ([], [])) if repo
+                        else (self._seqs, self._seq_blocks))
+        return blocks[bisect_left(seqs, start):]
 
     def has(self, cid):
         return cid in self.blocks
 
+    def has_many(self, cids):
+        return {cid: cid in self.blocks for cid in cids}
+
     def write(self, repo_did, obj, seq=None):
         if seq is None:
             seq = self.allocate_seq(SUBSCRIBE_REPOS_NSID)
 
         block = Block(decoded=obj, seq=seq, repo=repo_did)
-        if block not in self.blocks:
-            self.blocks[block.cid] = block
+        if block.cid not in self.blocks:
+            self._add_block(block)
         return block
 
     def apply_commit(self, commit_data):
@@ -508,13 +624,15 @@ class MemoryStorage(Storage):
         seq = tid_to_int(commit_data.commit.decoded['rev'])
         assert seq
 
-        for block in commit_data.blocks.values():
-            block.seq = seq
-
         # only add new blocks so we don't wipe out any existing blocks' sequence
         # numbers. (occasionally we see existing blocks recur, eg MST nodes.)
+        # commits can include stored Block objects themselves, so leave those
+        # untouched too.
         for cid, block in commit_data.blocks.items():
-            self.blocks.setdefault(cid, block)
+            if self.blocks.get(cid) is not block:
+                block.seq = seq
+            if cid not in self.blocks:
+                self._add_block(block)
 
         self.head = commit_data.commit.cid
         # the Repo will generally already be in self.repos, and it updates its
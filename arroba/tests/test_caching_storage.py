@@ -0,0 +1,168 @@
+"""Unit tests for caching_storage.py."""
+from unittest.mock import patch
+
+from ..caching_storage import BLOCK_OVERHEAD, CachingStorage
+from ..repo import Repo, Write
+from ..storage import Action, Block, MemoryStorage
+from ..util import dag_cbor_cid, next_tid
+
+from .test_storage import StorageTest
+from .testutil import TestCase
+
+
+class CachingStorageTest(StorageTest):
+    """Run all of StorageTest's tests with CachingStorage around MemoryStorage."""
+
+    def setUp(self):
+        super().setUp()
+        self.STORAGE_CLS = lambda: CachingStorage(MemoryStorage())
+
+
+class CachingStorageSpecificTest(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.inner = MemoryStorage()
+        self.storage = CachingStorage(self.inner)
+
+    def write(self, obj):
+        return self.inner.write('did:web:user.com', obj)
+
+    def test_read(self):
+        block = self.write({'foo': 'bar'})
+
+        with patch.object(self.inner, 'read', wraps=self.inner.read) as mock_read:
+            first = self.storage.read(block.cid)
+            second = self.storage.read(block.cid)
+            third = self.storage.read(block.cid)
+
+        mock_read.assert_called_once_with(block.cid)
+        for got in first, second, third:
+            self.assertEqual(block, got)
+            self.assertEqual(block.seq, got.seq)
+            self.assertEqual({'foo': 'bar'}, got.decoded)
+
+        # promoted to the decoded tier on the second read
+        self.assertIs(second.decoded, third.decoded)
+        self.assertEqual({
+            'hits': 2,
+            'decoded_hits': 1,
+            'misses': 1,
+            'hit_rate': 2 / 3,
+            'blocks': 1,
+            'encoded_size': BLOCK_OVERHEAD + len(block.encoded),
+            'decoded_size': self.storage.decoded.currsize,
+        }, self.storage.stats())
+
+    def test_read_not_found(self):
+        cid = dag_cbor_cid({'x': 'y'})
+        self.assertIsNone(self.storage.read(cid))
+        self.assertIsNone(self.storage.read(cid))
+        self.assertEqual(2, self.storage.misses)
+
+    def test_read_returns_new_blocks(self):
+        block = self.write({'foo': 'bar'})
+        self.storage.read(block.cid)
+        got = self.storage.read(block.cid)
+        got.seq = 999
+        self.assertEqual(block.seq, self.storage.read(block.cid).seq)
+
+    def test_read_many_batches_misses(self):
+        blocks = [self.write({'i': i}) for i in range(5)]
+        cids = [block.cid for block in blocks]
+        other = dag_cbor_cid({'x': 'y'})
+        self.storage.read_many(cids[:2])
+
+        with patch.object(self.inner, 'read_many',
+                          wraps=self.inner.read_many) as mock_read_many:
+            got = self.storage.read_many(cids + [other])
+
+        mock_read_many.assert_called_once_with(cids[2:] + [other])
+        self.assertEqual(cids + [other], list(got.keys()))
+        self.assertEqual(blocks + [None], list(got.values()))
+
+        with patch.object(self.inner, 'read_many') as mock_read_many:
+            self.assertEqual(blocks, list(self.storage.read_many(cids).values()))
+        mock_read_many.assert_not_called()
+
+    def test_has_many(self):
+        block = self.write({'foo': 'bar'})
+        other = dag_cbor_cid({'x': 'y'})
+        self.storage.read(block.cid)
+
+        with patch.object(self.inner, 'has_many',
+                          wraps=self.inner.has_many) as mock_has_many:
+            self.assertEqual({block.cid: True, other: False},
+                             self.storage.has_many([block.cid, other]))
+        mock_has_many.assert_called_once_with([other])
+
+    def test_encoded_size_bound(self):
+        blocks = [self.write({'i': i}) for i in range(5)]
+        size = BLOCK_OVERHEAD + len(blocks[0].encoded)
+        storage = CachingStorage(self.inner, encoded_size=size * 3,
+                                 decoded_size=0)
+
+        for block in blocks:
+            storage.read(block.cid)
+
+        self.assertEqual(3, len(storage.encoded))
+        self.assertEqual(0, len(storage.decoded))
+        self.assertNotIn(blocks[0].cid, storage.encoded)
+        self.assertIn(blocks[4].cid, storage.encoded)
+
+    def test_too_big_not_cached(self):
+        block = self.write({'foo': 'bar' * 100})
+        storage = CachingStorage(self.inner, encoded_size=10)
+        self.assertEqual(block, storage.read(block.cid))
+        self.assertEqual(0, len(storage.encoded))
+
+    def test_apply_commit_populates_cache(self):
+        repo = Repo.create(self.storage, 'did:web:user.com', signing_key=self.key)
+        self.storage.clear()
+
+        repo.apply_writes([Write(Action.CREATE, 'co.ll', next_tid(), {'foo': 'bar'})])
+        record = Block(decoded={'foo': 'bar'})
+        self.assertIn(record.cid, self.storage.encoded)
+        self.assertIn(repo.head.cid, self.storage.decoded)
+
+        with patch.object(self.inner, 'read') as mock_read:
+            got = self.storage.read(repo.head.cid)
+        mock_read.assert_not_called()
+        self.assertEqual(repo.head.seq, got.seq)
+        self.assertEqual(repo.head.ops, got.ops)
+
+    def test_apply_commit_doesnt_cache_existing_blocks(self):
+        repo = Repo.create(self.storage, 'did:web:user.com', signing_key=self.key)
+        record = self.write({'foo': 'bar'})
+
+        repo.apply_writes([Write(Action.CREATE, 'co.ll', next_tid(), {'foo': 'bar'})])
+        self.assertNotIn(record.cid, self.storage.encoded)
+        self.assertIn(repo.head.cid, self.storage.encoded)
+
+        # the record already existed, so it keeps its original seq
+        self.assertEqual(record.seq, self.storage.read(record.cid).seq)
+        self.assertLess(record.seq, repo.head.seq)
+
+    def test_load_repo_reads_through_cache(self):
+        repo = Repo.create(self.inner, 'did:web:user.com', signing_key=self.key)
+        repo.apply_writes([Write(Action.CREATE, 'co.ll', next_tid(), {'foo': 'bar'})])
+
+        repo = self.storage.load_repo('did:web:user.com')
+        self.assertIs(self.storage, repo.storage)
+        self.assertIs(self.storage, repo.mst.storage)
+
+        with patch.object(self.inner, 'read_many',
+                          wraps=self.inner.read_many) as mock_read_many:
+            repo.get_contents()
+            repo.get_contents()
+        self.assertEqual(1, mock_read_many.call_count)
+
+    def test_write_event_passes_through(self):
+        repo = Repo.create(self.storage, 'did:web:user.com', signing_key=self.key)
+
+        with patch.object(self.inner, 'write_event',
+                          wraps=self.inner.write_event) as mock_write_event:
+            self.storage.write_event(repo, 'identity', handle='han.dull')
+
+        mock_write_event.assert_called_once_with(repo, 'identity',
+                                                 handle='han.dull')
@@ -1,8 +1,11 @@
 """Unit tests for datastore_storage.py."""
+from datetime import timedelta
 import os
 from unittest.mock import MagicMock, patch
 
 from google.cloud import ndb
+from google.cloud.ndb.exceptions import ContextError
+from google.cloud.ndb.model import _entity_to_ds_entity
 
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import ec
@@ -18,6 +21,7 @@ from ..datastore_storage import (
     DatastoreStorage,
     WriteOnceBlobProperty,
 )
+from .. import util
 from ..repo import Action, Repo, Write
 from ..storage import Block, CommitData, MemoryStorage, SUBSCRIBE_REPOS_NSID
 from ..util import (
@@ -26,6 +30,7 @@ from ..util import (
     InactiveRepo,
     new_key,
     next_tid,
+    tid_to_int,
     TOMBSTONED,
 )
 
@@ -61,6 +66,40 @@ class DatastoreStorageTest(DatastoreTest):
         self.assertEqual(41, AtpSequence.last('foo'))
         self.assertEqual(42, AtpSequence.get_by_id('foo').next)
 
+    def test_atpsequence_allocate_many(self):
+        self.assertEqual(1, AtpSequence.allocate_many('foo', 10))
+        self.assertEqual(11, AtpSequence.get_by_id('foo').next)
+        self.assertEqual(11, AtpSequence.allocate_many('foo', 5))
+        self.assertEqual(16, AtpSequence.allocate('foo'))
+
+    def test_allocate_seq_leases(self):
+        storage = DatastoreStorage(ndb_client=self.ndb_client, seq_block_size=10)
+        other = DatastoreStorage(ndb_client=self.ndb_client, seq_block_size=10)
+
+        with patch.object(AtpSequence, 'allocate_many',
+                          wraps=AtpSequence.allocate_many) as mock_allocate:
+            self.assertEqual([1, 2, 3], [storage.allocate_seq('foo')
+                                         for _ in range(3)])
+            self.assertEqual(11, other.allocate_seq('foo'))
+            self.assertEqual(4, storage.allocate_seq('foo'))
+            self.assertEqual(2, mock_allocate.call_count)
+
+        self.assertEqual(21, AtpSequence.get_by_id('foo').next)
+
+        # each process stays monotonic across leases
+        seqs = [storage.allocate_seq('foo') for _ in range(7)]
+        self.assertEqual([5, 6, 7, 8, 9, 10, 21], seqs)
+        self.assertEqual(1, storage.allocate_seq('bar'))
+
+    def test_last_seq_leases_ignores_unused(self):
+        storage = DatastoreStorage(ndb_client=self.ndb_client, seq_block_size=10)
+        self.assertEqual(0, storage.last_seq(SUBSCRIBE_REPOS_NSID))
+
+        block = storage.write('did:web:user.com', {'foo': 'bar'})
+        self.assertEqual(1, block.seq)
+        self.assertEqual(1, storage.last_seq(SUBSCRIBE_REPOS_NSID))
+        self.assertEqual(10, AtpSequence.last(SUBSCRIBE_REPOS_NSID))
+
     def test_create_load_repo(self):
         self.assertIsNone(self.storage.load_repo('han.dull'))
         self.assertIsNone(self.storage.load_repo('did:web:user.com'))
@@ -156,6 +195,22 @@ class DatastoreStorageTest(DatastoreTest):
         self.assertEqual(data, stored.decoded)
         self.assertGreater(stored.seq, 0)
 
+    def test_atp_block_create_store_decoded_false(self):
+        data = {'foo': 'bar'}
+        atp_block = AtpBlock.create(repo_did='did:web:user.com', data=data, seq=1,
+                                    store_decoded=False)
+        self.assertIsNone(_entity_to_ds_entity(atp_block)['decoded'])
+
+        stored = AtpBlock.get_by_id(dag_cbor_cid(data).encode('base32'))
+        self.assertEqual(data, stored.to_block().decoded)
+
+        # loading and putting again doesn't add decoded
+        self.assertIsNone(stored.decoded)
+        stored.put()
+        stored = stored.key.get(use_cache=False)
+        self.assertIsNone(stored.decoded)
+        self.assertIsNone(_entity_to_ds_entity(stored)['decoded'])
+
     def test_write_once(self):
         class Foo(ndb.Model):
             prop = WriteOnceBlobProperty()
@@ -185,6 +240,17 @@ class DatastoreStorageTest(DatastoreTest):
         self.assertEqual(data, self.storage.read(block.cid).decoded)
         self.assertTrue(self.storage.has(block.cid))
 
+    def test_has_many(self):
+        self.assertEqual({cid: False for cid in CIDS}, self.storage.has_many(CIDS))
+
+        block = self.storage.write(repo_did='did:web:user.com', obj={'foo': 'bar'})
+        expected = {CIDS[0]: False, block.cid: True, CIDS[1]: False}
+        self.assertEqual(expected, self.storage.has_many(expected.keys()))
+
+        # inside a transaction
+        self.assertEqual(expected, ndb.transaction(
+            lambda: self.storage.has_many(expected.keys())))
+
     def test_read_many(self):
         self.assertEqual({cid: None for cid in CIDS},
                          self.storage.read_many(CIDS))
@@ -251,6 +317,45 @@ class DatastoreStorageTest(DatastoreTest):
         self.ndb_context.__exit__(None, None, None)
         self.assertEqual([blocks[1]], list(call))
 
+    def test_read_blocks_by_seq_pages(self):
+        storage = DatastoreStorage(blocks_page_size=2)
+        blocks = [storage.write(repo_did='did:plc:123', obj={'x': i})
+                  for i in range(5)]
+
+        with patch.object(ndb.Query, 'fetch_page_async', autospec=True,
+                          side_effect=ndb.Query.fetch_page_async) as mock_fetch:
+            call = storage.read_blocks_by_seq()
+            self.assertEqual(blocks[0], next(call))
+            # first page, and second page prefetched
+            self.assertEqual(2, mock_fetch.call_count)
+            self.assertEqual(blocks[1:], list(call))
+
+        for call in mock_fetch.call_args_list:
+            self.assertEqual(2, call.args[1])
+
+    def test_read_blocks_by_seq_resumes_at_cursor(self):
+        storage = DatastoreStorage(blocks_page_size=1)
+        blocks = [storage.write(repo_did='did:plc:123', obj={'x': i})
+                  for i in range(3)]
+
+        orig_fetch = ndb.Query.fetch_page_async
+        cursors = []
+        def fetch(query, page_size, start_cursor=None, **kwargs):
+            cursors.append(start_cursor)
+            if len(cursors) == 3:
+                # lose the context while prefetching the third page
+                raise ContextError()
+            return orig_fetch(query, page_size, start_cursor=start_cursor, **kwargs)
+
+        with patch.object(ndb.Query, 'fetch_page_async', autospec=True,
+                          side_effect=fetch):
+            self.assertEqual(blocks, list(storage.read_blocks_by_seq()))
+
+        # resumed at the second page, not the beginning
+        self.assertIsNone(cursors[0])
+        self.assertIsNotNone(cursors[3])
+        self.assertEqual(cursors[1], cursors[3])
+
     def assert_same_seq(self, cids):
         """
         Args:
@@ -318,6 +423,200 @@ class DatastoreStorageTest(DatastoreTest):
         atp_repo = AtpRepo.get_by_id('did:web:user.com')
         self.assertEqual(cid, CID.decode(atp_repo.head))
 
+    def test_apply_commit_one_get_multi_one_put_multi(self):
+        repo = Repo.create(self.storage, 'did:web:user.com', signing_key=self.key)
+        existing = self.storage.write('did:web:user.com', {'foo': 'bar'})
+
+        commit_data = Repo.format_commit(repo=repo, writes=[
+            Write(Action.CREATE, 'coll', next_tid(), {'foo': 'bar'}),
+            Write(Action.CREATE, 'coll', next_tid(), {'baz': 'biff'}),
+        ])
+
+        with patch.object(ndb, 'get_multi', wraps=ndb.get_multi) as mock_get, \
+             patch.object(ndb, 'put_multi', wraps=ndb.put_multi) as mock_put, \
+             patch.object(AtpBlock, 'get_or_insert') as mock_get_or_insert:
+            self.storage.apply_commit(commit_data)
+
+        mock_get.assert_called_once()
+        mock_put.assert_called_once()
+        mock_get_or_insert.assert_not_called()
+
+        # the existing record block isn't rewritten, so it keeps its seq
+        put = mock_put.call_args.args[0]
+        self.assertNotIn(existing.cid.encode('base32'),
+                         [entity.key.id() for entity in put])
+        self.assertEqual(existing.seq, self.storage.read(existing.cid).seq)
+
+        self.assertEqual(commit_data.commit.cid,
+                         CID.decode(AtpRepo.get_by_id('did:web:user.com').head))
+        seq = tid_to_int(commit_data.commit.decoded['rev'])
+        self.assertEqual(seq, self.storage.read(commit_data.commit.cid).seq)
+
+    def test_load_repo_cache(self):
+        storage = DatastoreStorage(repo_cache_ttl=timedelta(minutes=1))
+        Repo.create(storage, 'did:web:user.com', handle='han.dull',
+                    signing_key=self.key)
+        storage.load_repo('did:web:user.com')
+
+        with patch.object(AtpRepo, 'get_by_id') as mock_get, \
+             patch.object(AtpRepo, 'query') as mock_query, \
+             patch.object(storage, 'read') as mock_read:
+            repo = storage.load_repo('did:web:user.com', with_keys=False)
+            self.assertEqual(repo, storage.load_repo('han.dull', with_keys=False))
+
+        mock_get.assert_not_called()
+        mock_query.assert_not_called()
+        mock_read.assert_not_called()
+        self.assertEqual('han.dull', repo.handle)
+
+    def test_load_repo_cache_with_keys_reads_head(self):
+        storage = DatastoreStorage(repo_cache_ttl=timedelta(minutes=1))
+        repo = Repo.create(storage, 'did:web:user.com', signing_key=self.key)
+        storage.load_repo('did:web:user.com')
+
+        # another process commits
+        other = DatastoreStorage()
+        other_repo = other.load_repo('did:web:user.com')
+        other_repo.apply_writes([Write(Action.CREATE, 'coll', next_tid(),
+                                       {'foo': 'bar'})])
+
+        with patch.object(serialization, 'load_pem_private_key') as mock_load:
+            got = storage.load_repo('did:web:user.com')
+
+        # keys are cached, head isn't
+        mock_load.assert_not_called()
+        self.assertEqual(other_repo.head, got.head)
+        self.assertEqual(self.key.private_numbers(),
+                         got.signing_key.private_numbers())
+
+    def test_apply_commit_stale_prev(self):
+        repo = Repo.create(self.storage, 'did:web:user.com', signing_key=self.key)
+        stale = self.storage.load_repo('did:web:user.com')
+        repo.apply_writes([Write(Action.CREATE, 'coll', next_tid(), {'foo': 'bar'})])
+
+        with self.assertRaises(ValueError):
+            stale.apply_writes([Write(Action.CREATE, 'coll', next_tid(),
+                                      {'baz': 'biff'})])
+
+        self.assertEqual(repo.head, self.storage.load_repo('did:web:user.com').head)
+
+    def test_load_repo_cache_invalidated_by_commit(self):
+        storage = DatastoreStorage(repo_cache_ttl=timedelta(minutes=1))
+        repo = Repo.create(storage, 'did:web:user.com', signing_key=self.key)
+        load = lambda: storage.load_repo('did:web:user.com', with_keys=False)
+        self.assertEqual(repo.head, load().head)
+
+        repo.apply_writes([Write(Action.CREATE, 'coll', next_tid(), {'foo': 'bar'})])
+        self.assertEqual(repo.head, load().head)
+
+        storage.deactivate_repo(repo)
+        self.assertEqual(DEACTIVATED, load().status)
+
+    def test_load_repo_cache_invalidated_after_transaction_commits(self):
+        storage = DatastoreStorage(repo_cache_ttl=timedelta(minutes=1))
+        repo = Repo.create(storage, 'did:web:user.com', signing_key=self.key)
+        head = repo.head
+        load = lambda: storage.load_repo('did:web:user.com', with_keys=False)
+        load()
+
+        commit_data = Repo.format_commit(repo=repo, writes=[
+            Write(Action.CREATE, 'coll', next_tid(), {'foo': 'bar'})])
+
+        @ndb.transactional()
+        def apply():
+            storage.apply_commit(commit_data)
+            # still cached until the transaction commits
+            self.assertEqual(head, load().head)
+
+        apply()
+        self.assertEqual(commit_data.commit, load().head)
+
+    def test_load_repo_without_keys(self):
+        Repo.create(self.storage, 'did:web:user.com', signing_key=self.key)
+
+        with patch.object(serialization, 'load_pem_private_key') as mock_load:
+            repo = self.storage.load_repo('did:web:user.com', with_keys=False)
+
+        mock_load.assert_not_called()
+        self.assertEqual('did:web:user.com', repo.did)
+        self.assertIsNone(repo.signing_key)
+        self.assertIsNone(repo.rotation_key)
+
+    def _apply_commit_stored_decoded(self, storage):
+        """Applies a commit and returns the ``decoded`` values it stored.
+
+        Returns:
+          (CommitData, dict mapping CID to stored decoded value)
+        """
+        repo = Repo.create(storage, 'did:web:user.com', signing_key=self.key)
+        commit_data = Repo.format_commit(repo=repo, writes=[
+            Write(Action.CREATE, 'coll', next_tid(), {'foo': 'bar'}),
+        ])
+
+        with patch.object(ndb, 'put_multi', wraps=ndb.put_multi) as mock_put:
+            storage.apply_commit(commit_data)
+
+        return commit_data, {
+            entity.cid: _entity_to_ds_entity(entity)['decoded']
+            for entity in mock_put.call_args.args[0]
+            if isinstance(entity, AtpBlock)}
+
+    def test_apply_commit_store_decoded_false(self):
+        storage = DatastoreStorage(store_decoded=False)
+        commit_data, stored = self._apply_commit_stored_decoded(storage)
+
+        self.assertEqual(commit_data.blocks.keys(), stored.keys())
+        self.assertEqual({None}, set(stored.values()))
+
+        for cid, block in commit_data.blocks.items():
+            got = storage.read(cid)
+            self.assertEqual(block.encoded, got.encoded)
+            self.assertEqual(block.decoded, got.decoded)
+            self.assertEqual(block.seq, got.seq)
+
+    def test_apply_commit_store_decoded_records(self):
+        storage = DatastoreStorage(store_decoded='records')
+        commit_data, stored = self._apply_commit_stored_decoded(storage)
+
+        record_cid = dag_cbor_cid({'foo': 'bar'})
+        self.assertEqual({'foo': 'bar'}, stored.pop(record_cid))
+        self.assertEqual({None}, set(stored.values()))
+
+    def test_apply_commit_rev_goes_backwards(self):
+        storage = DatastoreStorage(ndb_client=self.ndb_client, seq_block_size=10)
+        repo = Repo.create(storage, 'did:web:user.com', signing_key=self.key)
+        head = repo.head
+        prev_seq = tid_to_int(head.decoded['rev'])
+
+        with patch.object(storage, 'allocate_seq', return_value=prev_seq):
+            commit_data = Repo.format_commit(repo=repo, writes=[
+                Write(Action.CREATE, 'coll', next_tid(), {'foo': 'bar'})])
+
+        with self.assertRaises(ValueError):
+            storage.apply_commit(commit_data)
+
+        self.assertEqual(head.cid, storage.load_repo('did:web:user.com').head.cid)
+
+    def test_apply_commit_v2_prev(self):
+        storage = DatastoreStorage(ndb_client=self.ndb_client, seq_block_size=10)
+        repo = Repo.create(storage, 'did:web:user.com', signing_key=self.key)
+
+        # pre-v3 commits don't have revs
+        v2 = {k: v for k, v in repo.head.decoded.items() if k not in ('rev', 'sig')}
+        v2['version'] = 2
+        v2_block = storage.write('did:web:user.com', util.sign(v2, self.key))
+        atp_repo = AtpRepo.get_by_id('did:web:user.com')
+        atp_repo.head = v2_block.cid.encode('base32')
+        atp_repo.put()
+
+        repo = storage.load_repo('did:web:user.com')
+        self.assertEqual(v2_block.cid, repo.head.cid)
+        repo.apply_writes([Write(Action.CREATE, 'coll', next_tid(), {'foo': 'bar'})])
+
+        head = storage.load_repo('did:web:user.com').head
+        self.assertEqual(v2_block.cid, head.decoded['prev'])
+        self.assertEqual(3, head.decoded['version'])
+
     def test_apply_commit_inactive_repo(self):
         repo = Repo.create(self.storage, 'did:web:user.com', signing_key=self.key,
                            status=DEACTIVATED)
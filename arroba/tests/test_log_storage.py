@@ -0,0 +1,245 @@
+"""Unit tests for log_storage.py."""
+import math
+import mmap
+import os
+import tempfile
+import threading
+from unittest.mock import patch
+
+from ..repo import Repo, Write
+from .. import log_storage
+from ..log_storage import LogStorage
+from ..storage import Action, SUBSCRIBE_REPOS_NSID
+from ..util import dag_cbor_cid, InactiveRepo, next_tid, TOMBSTONED
+
+from . import test_storage
+from .testutil import TestCase
+
+
+class LogStorageTest(test_storage.StorageTest):
+    """Run all of StorageTest's tests with LogStorage."""
+
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.TemporaryDirectory()
+        self.storages = []
+
+        def make_storage():
+            storage = LogStorage(self.dir.name)
+            self.storages.append(storage)
+            return storage
+
+        self.STORAGE_CLS = make_storage
+
+    def tearDown(self):
+        for storage in self.storages:
+            storage.close()
+        self.dir.cleanup()
+        super().tearDown()
+
+
+class LogStorageSpecificTest(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.TemporaryDirectory()
+        self.storage = LogStorage(self.dir.name)
+
+    def tearDown(self):
+        self.storage.close()
+        self.dir.cleanup()
+        super().tearDown()
+
+    def reopen(self, **kwargs):
+        self.storage.close()
+        self.storage = LogStorage(self.dir.name, **kwargs)
+        return self.storage
+
+    def test_read_zero_copy(self):
+        block = self.storage.write('did:web:user.com', {'foo': 'bar'})
+
+        got = self.storage.read(block.cid)
+        self.assertIsInstance(got.encoded, memoryview)
+        self.assertEqual(block.encoded, got.encoded)
+        self.assertEqual({'foo': 'bar'}, got.decoded)
+        self.assertEqual(block.seq, got.seq)
+        self.assertEqual('did:web:user.com', got.repo)
+        self.assertEqual(block.time, got.time)
+        self.assertIsNone(got.ops)
+
+    def test_read_many(self):
+        block = self.storage.write('did:web:user.com', {'foo': 'bar'})
+        other = dag_cbor_cid({'x': 'y'})
+        self.assertEqual({block.cid: block, other: None},
+                         self.storage.read_many([block.cid, other]))
+
+    def test_write_existing_keeps_seq(self):
+        first = self.storage.write('did:web:user.com', {'foo': 'bar'})
+        self.storage.write('did:web:user.com', {'foo': 'bar'})
+        self.assertEqual(first.seq, self.storage.read(first.cid).seq)
+        self.assertEqual(1, len(list(self.storage.read_blocks_by_seq())))
+
+    def test_reopen(self):
+        repo = Repo.create(self.storage, 'did:web:user.com', handle='han.dull',
+                           signing_key=self.key)
+        repo.apply_writes([Write(Action.CREATE, 'co.ll', 'abc', {'foo': 'bar'})])
+        blocks = list(self.storage.read_blocks_by_seq())
+
+        storage = self.reopen()
+        got = storage.load_repo('han.dull')
+        self.assertEqual('did:web:user.com', got.did)
+        self.assertEqual(repo.head, got.head)
+        self.assertEqual({'foo': 'bar'}, got.get_record('co.ll', 'abc'))
+        self.assertEqual(blocks, list(storage.read_blocks_by_seq()))
+        self.assertEqual(repo.head.ops, storage.read(repo.head.cid).ops)
+
+        self.assertEqual(4, storage.last_seq(SUBSCRIBE_REPOS_NSID))
+        self.assertEqual(5, storage.allocate_seq(SUBSCRIBE_REPOS_NSID))
+
+    def test_reopen_status_and_handle(self):
+        repo = Repo.create(self.storage, 'did:web:user.com', handle='han.dull',
+                           signing_key=self.key)
+        self.storage.tombstone_repo(repo)
+        repo.handle = 'new.handle'
+        self.storage.create_repo(repo, signing_key=self.key)
+
+        storage = self.reopen()
+        self.assertIsNone(storage.load_repo('han.dull'))
+        got = storage.load_repo('new.handle')
+        self.assertEqual(TOMBSTONED, got.status)
+
+        with self.assertRaises(InactiveRepo):
+            got.apply_writes([Write(Action.CREATE, 'co.ll', 'abc', {'x': 'y'})])
+
+    def test_concurrent_repo_writes(self):
+        repos = [Repo.create(self.storage, f'did:web:{i}', handle=f'{i}.han',
+                             signing_key=self.key)
+                 for i in range(8)]
+
+        def write(repo):
+            for j in range(10):
+                repo.apply_writes([Write(Action.CREATE, 'co.ll', next_tid(),
+                                         {'j': j})])
+                self.storage.deactivate_repo(repo)
+                self.storage.activate_repo(repo)
+
+        threads = [threading.Thread(target=write, args=[repo]) for repo in repos]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        storage = self.reopen()
+        for repo in repos:
+            got = storage.load_repo(repo.handle)
+            self.assertEqual(repo.did, got.did)
+            self.assertEqual(repo.head, got.head)
+            self.assertIsNone(got.status)
+            self.assertEqual(10, len(got.get_contents()['co.ll']))
+
+    def test_reopen_truncates_partial_record(self):
+        block = self.storage.write('did:web:user.com', {'foo': 'bar'})
+        self.storage.close()
+
+        path = os.path.join(self.dir.name, '00000000.seg')
+        size = os.path.getsize(path)
+        with open(path, 'ab') as f:
+            f.write(b'\x99\x00\x00\x00partial')
+
+        storage = self.reopen()
+        self.assertEqual(size, os.path.getsize(path))
+        self.assertEqual(block, storage.read(block.cid))
+
+        other = storage.write('did:web:user.com', {'baz': 'biff'})
+        self.assertEqual([block, other], list(storage.read_blocks_by_seq()))
+
+    def test_reopen_truncates_corrupt_record(self):
+        block = self.storage.write('did:web:user.com', {'foo': 'bar'})
+        path = os.path.join(self.dir.name, '00000000.seg')
+        size = os.path.getsize(path)
+        self.storage.write('did:web:user.com', {'baz': 'biff'})
+        self.storage.close()
+
+        # same length, different contents, eg a torn write
+        with open(path, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(bytes([last[0] ^ 0xff]))
+
+        storage = self.reopen()
+        self.assertEqual(size, os.path.getsize(path))
+        self.assertEqual([block], list(storage.read_blocks_by_seq()))
+
+    def test_reopen_corrupt_record_in_earlier_segment(self):
+        self.reopen(segment_size=100)
+        for i in range(3):
+            self.storage.write('did:web:user.com', {'i': i})
+        self.storage.close()
+
+        path = os.path.join(self.dir.name, '00000000.seg')
+        with open(path, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b'\xff')
+
+        with self.assertRaises(RuntimeError):
+            LogStorage(self.dir.name, segment_size=100)
+
+    def test_maps_grow_incrementally(self):
+        for i in range(2000):
+            block = self.storage.write('did:web:user.com', {'i': i})
+            self.assertEqual({'i': i}, self.storage.read(block.cid).decoded)
+
+        # merged chunks, not one per read
+        size = os.path.getsize(os.path.join(self.dir.name, '00000000.seg'))
+        chunks = self.storage._maps[0]
+        self.assertLessEqual(len(chunks), math.log2(size / mmap.ALLOCATIONGRANULARITY) + 2)
+        self.assertEqual(0, chunks[0][0])
+        self.assertEqual(size, chunks[-1][0] + len(chunks[-1][1]))
+
+        with patch('mmap.mmap') as mock_mmap:
+            self.assertEqual(2000, len(list(self.storage.read_blocks_by_seq())))
+        mock_mmap.assert_not_called()
+
+    def test_segments(self):
+        self.reopen(segment_size=100)
+        blocks = [self.storage.write('did:web:user.com', {'i': i})
+                  for i in range(10)]
+        self.assertGreater(len(os.listdir(self.dir.name)), 5)
+        self.assertEqual(blocks, list(self.storage.read_blocks_by_seq()))
+
+        storage = self.reopen(segment_size=100)
+        for block in blocks:
+            self.assertEqual(block.decoded, storage.read(block.cid).decoded)
+        self.assertEqual(blocks[3:], list(storage.read_blocks_by_seq(start=4)))
+
+    @patch.object(log_storage, 'SEQ_INDEX_INTERVAL', 2)
+    def test_read_blocks_by_seq_out_of_order(self):
+        seqs = [3, 1, 2, 6, 4, 5, 7, 9, 8, 10]
+        for i, seq in enumerate(seqs):
+            self.storage.write('did:web:user.com', {'i': i}, seq=seq)
+
+        for start in range(12):
+            self.assertEqual(
+                list(range(max(start, 1), 11)),
+                [b.seq for b in self.storage.read_blocks_by_seq(start=start)])
+
+        self.assertEqual(
+            [4, 5, 6], [b.seq for b in self.storage.read_blocks_by_seq(start=4)][:3])
+
+    def test_read_blocks_by_seq_repo(self):
+        Repo.create(self.storage, 'did:alice', signing_key=self.key)
+        Repo.create(self.storage, 'did:bob', signing_key=self.key)
+
+        alices = list(self.storage.read_blocks_by_seq(start=2, repo='did:alice'))
+        self.assertEqual({'did:alice'}, {b.repo for b in alices})
+        self.assertEqual([2, 3], [b.seq for b in alices])
+
+    def test_read_blocks_by_seq_snapshot(self):
+        self.storage.write('did:web:user.com', {'foo': 'bar'})
+        blocks = self.storage.read_blocks_by_seq()
+        next(blocks)
+
+        self.storage.write('did:web:user.com', {'baz': 'biff'})
+        self.assertEqual([], list(blocks))
+        self.assertEqual(2, len(list(self.storage.read_blocks_by_seq())))
@@ -7,11 +7,23 @@ Huge thanks to the Bluesky team for working in the public, in open source, and t
 Daniel Holmgren and Devin Ivy for this code specifically!
 """
 import random
+from unittest.mock import patch
 
 import dag_cbor.random
 from multiformats import CID
 
-from ..mst import common_prefix_len, ensure_valid_key, MST
+from ..diff import Diff
+from .. import mst as mst_module
+from ..mst import (
+    common_prefix_len,
+    ensure_valid_key,
+    Leaf,
+    leading_zeros_on_hash,
+    leading_zeros_on_hashes,
+    MST,
+    NodeCache,
+)
+from ..storage import Action, CommitOp, MemoryStorage
 from .. import util
 from . import testutil
 
@@ -21,8 +33,23 @@ CID1 = CID.decode('bafyreie5cvv4h45feadgeuwhbcutmh6t2ceseocckahdoe6uat64zmz454')
 class MstTest(testutil.TestCase):
 
     def setUp(self):
+        super().setUp()
         self.mst = MST.create()
 
+    def store(self, mst):
+        """Writes an MST's unstored blocks to its storage via :meth:`Storage.write`.
+
+        Args:
+          mst (MST)
+
+        Returns:
+          (CID, dict mapping CID to Block) tuple: root CID and the stored blocks
+        """
+        root, blocks = mst.get_unstored_blocks()
+        for block in blocks.values():
+            mst.storage.write('did:web:user.com', block.decoded)
+        return root, blocks
+
     def test_add(self):
         mst = self.mst
         data = self.random_keys_and_cids(1000)
@@ -86,6 +113,408 @@ class MstTest(testutil.TestCase):
 
         self.assertEqual(all_nodes, recreated.all_nodes())
 
+    def test_from_sorted_leaves(self):
+        mst = self.mst
+        data = self.random_keys_and_cids(1000)
+        for key, cid in data:
+            mst = mst.add(key, cid)
+
+        leaves = [Leaf(key, cid) for key, cid in sorted(data)]
+        built = MST.from_sorted_leaves(None, leaves)
+        self.assertEqual(mst.get_pointer(), built.get_pointer())
+        self.assertEqual(mst.all_nodes(), built.all_nodes())
+        self.assertEqual(1000, built.leaf_count())
+
+    def test_from_sorted_leaves_empty(self):
+        self.assertEqual(self.mst.get_pointer(),
+                         MST.from_sorted_leaves(None, []).get_pointer())
+
+    def test_from_sorted_leaves_unsorted_or_duplicate(self):
+        a = Leaf('com.example.record/3jqfcqzm3fo2j', CID1)
+        b = Leaf('com.example.record/3jqfcqzm3fp2j', CID1)
+        for leaves in [b, a], [a, a]:
+            with self.assertRaises(ValueError):
+                MST.from_sorted_leaves(None, leaves)
+
+    def test_apply_batch(self):
+        data = self.random_keys_and_cids(300)
+        mst = self.mst
+        for key, cid in data[:200]:
+            mst = mst.add(key, cid)
+
+        new_cids = dag_cbor.random.rand_cid()
+        ops = ([CommitOp(Action.CREATE, key, cid) for key, cid in data[200:]]
+               + [CommitOp(Action.UPDATE, key, next(new_cids))
+                  for key, _ in data[:50]]
+               + [CommitOp(Action.DELETE, key, None) for key, _ in data[50:100]])
+        random.shuffle(ops)
+
+        final = dict(data[:200])
+        for op in ops:
+            if op.action == Action.DELETE:
+                del final[op.path]
+            else:
+                final[op.path] = op.cid
+        expected = MST.from_sorted_leaves(None, [Leaf(key, cid) for key, cid
+                                                 in sorted(final.items())])
+
+        got = mst.apply_batch(ops)
+        self.assertEqual(expected.get_pointer(), got.get_pointer())
+        self.assertEqual(expected.all_nodes(), got.all_nodes())
+        self.assertEqual(250, got.leaf_count())
+
+    def test_apply_batch_canonical_after_emptying(self):
+        layer_1 = 'com.example.record/52pse43lprs22'
+        layer_0 = 'com.example.record/4sn275tssas22'
+        mst = self.mst.add(layer_1, CID1)
+        expected = MST.create().add(layer_0, CID1)
+
+        # one at a time, the emptied tree stays on layer 1, so the new key
+        # ends up under an extra layer 1 root
+        one_at_a_time = mst.delete(layer_1).add(layer_0, CID1)
+        self.assertNotEqual(expected.get_pointer(), one_at_a_time.get_pointer())
+
+        got = mst.apply_batch([CommitOp(Action.DELETE, layer_1, None),
+                               CommitOp(Action.CREATE, layer_0, CID1)])
+        self.assertEqual(expected.get_pointer(), got.get_pointer())
+        self.assertEqual(0, got.get_layer())
+
+    def test_apply_batch_repeated_key(self):
+        key = 'com.example.record/3jqfcqzm3fo2j'
+        mst = self.mst.apply_batch([
+            CommitOp(Action.CREATE, key, CID1),
+            CommitOp(Action.DELETE, key, None),
+            CommitOp(Action.CREATE, key, CID1),
+        ])
+        self.assertEqual(self.mst.add(key, CID1).get_pointer(), mst.get_pointer())
+
+    def test_apply_batch_errors(self):
+        key = 'com.example.record/3jqfcqzm3fo2j'
+        mst = self.mst.add(key, CID1)
+
+        with self.assertRaises(ValueError):
+            mst.apply_batch([CommitOp(Action.CREATE, key, CID1)])
+
+        for action in Action.UPDATE, Action.DELETE:
+            with self.assertRaises(KeyError):
+                mst.apply_batch([CommitOp(action, 'com.example.record/3jqfcqzm3fp2j',
+                                          CID1)])
+            # key would be on a higher layer than the whole tree
+            with self.assertRaises(KeyError):
+                mst.apply_batch([CommitOp(action, 'app.bsky.feed.post/9adeb165882c',
+                                          CID1)])
+
+    def test_apply_batch_diff(self):
+        storage = MemoryStorage()
+        data = self.random_keys_and_cids(300)
+        mst = MST.create(storage=storage)
+        for key, cid in data[:200]:
+            mst = mst.add(key, cid)
+        root, blocks = self.store(mst)
+        mst = MST.load(storage=storage, cid=root)
+
+        new_cids = dag_cbor.random.rand_cid()
+        for ops in (
+                [],
+                [CommitOp(Action.CREATE, data[200][0], data[200][1])],
+                [CommitOp(Action.UPDATE, data[0][0], next(new_cids))],
+                [CommitOp(Action.DELETE, data[1][0], None)],
+                [CommitOp(Action.DELETE, data[1][0], None),
+                 CommitOp(Action.CREATE, data[1][0], data[1][1])],
+                [CommitOp(Action.CREATE, key, cid) for key, cid in data[200:]]
+                + [CommitOp(Action.UPDATE, key, next(new_cids))
+                   for key, _ in data[10:50]]
+                + [CommitOp(Action.DELETE, key, None) for key, _ in data[50:100]],
+        ):
+            diff = Diff()
+            new = mst.apply_batch(ops, diff=diff)
+            expected = Diff.of(new, mst)
+            self.assertEqual(expected.adds, diff.adds)
+            self.assertEqual(expected.updates, diff.updates)
+            self.assertEqual(expected.deletes, diff.deletes)
+            self.assertEqual(expected.new_cids, diff.new_cids)
+            self.assertEqual(expected.removed_cids, diff.removed_cids)
+
+    def test_apply_batch_diff_one_write_only_loads_path(self):
+        storage = MemoryStorage()
+        mst = MST.create(storage=storage)
+        for key, cid in self.random_keys_and_cids(1000):
+            mst = mst.add(key, cid)
+        root, blocks = self.store(mst)
+
+        mst_module.node_cache.clear()
+        mst = MST.load(storage=storage, cid=root)
+        with patch.object(storage, 'read', wraps=storage.read) as mock_read, \
+             patch.object(storage, 'read_many', wraps=storage.read_many) as mock_read_many:
+            diff = Diff()
+            mst.apply_batch([CommitOp(Action.CREATE, 'com.example.record/3jqfcqzm3fo2j',
+                                      CID1)], diff=diff)
+
+        self.assertEqual(['com.example.record/3jqfcqzm3fo2j'], list(diff.adds))
+        self.assertLessEqual(mock_read.call_count + mock_read_many.call_count,
+                             mst.get_layer() + 1)
+
+    def test_count_range(self):
+        storage = MemoryStorage()
+        keys = sorted(key for key, _ in self.random_keys_and_cids(1000))
+        mst = MST.from_sorted_leaves(storage, [Leaf(key, CID1) for key in keys])
+        root, blocks = self.store(mst)
+
+        mst = MST.load(storage=storage, cid=root)
+        self.assertEqual(1000, mst.leaf_count())
+        self.assertEqual(1000, mst_module.leaf_count_cache[root])
+
+        for start, end in ((None, None), (keys[100], None), (None, keys[900]),
+                           (keys[123], keys[456]), (keys[5], keys[5]),
+                           ('a', 'b'), ('~', None)):
+            expected = len([k for k in keys if (start is None or k >= start)
+                            and (end is None or k < end)])
+            self.assertEqual(expected, mst.count_range(start, end), (start, end))
+
+        prefix = keys[500][:-8]
+        self.assertEqual(len([k for k in keys if k.startswith(prefix)]),
+                         mst.count_prefix(prefix))
+
+        # counts are cached, so counting a range only loads nodes on its edges
+        with patch.object(storage, 'read', wraps=storage.read) as mock_read, \
+             patch.object(storage, 'read_many', wraps=storage.read_many) as mock_read_many:
+            mst_module.node_cache.clear()
+            loaded = MST.load(storage=storage, cid=root)
+            self.assertEqual(333, loaded.count_range(keys[123], keys[456]))
+            self.assertLessEqual(mock_read.call_count + mock_read_many.call_count,
+                                 2 * mst.get_layer() + 1)
+
+    def test_cids_for_path(self):
+        mst = self.mst
+        data = self.random_keys_and_cids(300)
+        for key, cid in data:
+            mst = mst.add(key, cid)
+
+        for key, cid in data[:20]:
+            cids = mst.cids_for_path(key)
+            self.assertEqual(mst.get_pointer(), cids[0])
+            self.assertEqual(cid, cids[-1])
+
+            node = mst
+            for pointer in cids[1:-1]:
+                node = next(e for e in node.get_entries()
+                            if isinstance(e, MST) and e.get_pointer() == pointer)
+            self.assertIn(Leaf(key, cid), node.get_entries())
+
+        # not found: path to the node where the key would be, without a record
+        cids = mst.cids_for_path('com.example.record/2222222222222')
+        self.assertNotIn(cids[-1], [cid for _, cid in data])
+
+    def test_leaf_count_loads_each_layer_once(self):
+        storage = MemoryStorage()
+        keys = sorted(key for key, _ in self.random_keys_and_cids(1000))
+        mst = MST.from_sorted_leaves(storage, [Leaf(key, CID1) for key in keys])
+        root, blocks = self.store(mst)
+
+        mst_module.node_cache.clear()
+        mst_module.leaf_count_cache.clear()
+        mst = MST.load(storage=storage, cid=root)
+        with patch.object(storage, 'read', wraps=storage.read) as mock_read, \
+             patch.object(storage, 'read_many', wraps=storage.read_many) as mock_read_many:
+            self.assertEqual(1000, mst.leaf_count())
+
+        mock_read.assert_not_called()
+        self.assertEqual(mst.get_layer() + 1, mock_read_many.call_count)
+
+    def test_blocks_for_path(self):
+        storage = MemoryStorage()
+        data = self.random_keys_and_cids(300)
+        mst = MST.from_sorted_leaves(storage, [Leaf(key, cid)
+                                               for key, cid in sorted(data)])
+        root, blocks = self.store(mst)
+
+        for key, cid in data[:20]:
+            mst_module.node_cache.clear()
+            mst = MST.load(storage=storage, cid=root)
+            cids = mst.cids_for_path(key)
+
+            mst_module.node_cache.clear()
+            mst = MST.load(storage=storage, cid=root)
+            with patch.object(storage, 'read', wraps=storage.read) as mock_read, \
+                 patch.object(storage, 'read_many') as mock_read_many:
+                nodes, got_cid = mst.blocks_for_path(key)
+
+            self.assertEqual(cid, got_cid)
+            self.assertEqual(cids[:-1], [node.cid for node in nodes])
+            # each node read exactly once
+            self.assertEqual(len(nodes), mock_read.call_count)
+            mock_read_many.assert_not_called()
+
+            # loaded nodes are re-encoded, not read again
+            with patch.object(storage, 'read') as mock_read:
+                self.assertEqual((nodes, cid), mst.blocks_for_path(key))
+            mock_read.assert_not_called()
+
+        nodes, got_cid = mst.blocks_for_path('com.example.record/2222222222222')
+        self.assertIsNone(got_cid)
+        self.assertEqual(mst.cids_for_path('com.example.record/2222222222222'),
+                         [node.cid for node in nodes])
+
+    def test_walk_leaves_backwards_from(self):
+        mst = self.mst
+        data = sorted(self.random_keys_and_cids(500))
+        for key, cid in data:
+            mst = mst.add(key, cid)
+
+        leaves = [Leaf(key, cid) for key, cid in data]
+        self.assertEqual(leaves[::-1], list(mst.walk_leaves_backwards_from('~')))
+        self.assertEqual(leaves[200::-1],
+                         list(mst.walk_leaves_backwards_from(data[200][0])))
+        self.assertEqual([], list(mst.walk_leaves_backwards_from('a')))
+
+    def test_find_gt_or_equal_leaf_index(self):
+        a = Leaf('com.example.record/3jqfcqzm3fo2j', CID1)
+        c = Leaf('com.example.record/3jqfcqzm3fr2j', CID1)
+        sub = MST.create(entries=[Leaf('com.example.record/3jqfcqzm3fp2j', CID1)])
+        mst = MST.create(entries=[a, sub, c])
+
+        self.assertEqual(0, mst.find_gt_or_equal_leaf_index('com.example.record/1'))
+        self.assertEqual(0, mst.find_gt_or_equal_leaf_index(a.key))
+        self.assertEqual(2, mst.find_gt_or_equal_leaf_index(
+            'com.example.record/3jqfcqzm3fp2j'))
+        self.assertEqual(2, mst.find_gt_or_equal_leaf_index(c.key))
+        self.assertEqual(3, mst.find_gt_or_equal_leaf_index('com.example.record/9'))
+        self.assertEqual(0, self.mst.find_gt_or_equal_leaf_index(a.key))
+
+    def test_node_cache(self):
+        storage = MemoryStorage()
+        mst = MST.create(storage=storage)
+        for key, cid in self.random_keys_and_cids(100):
+            mst = mst.add(key, cid)
+        root, blocks = self.store(mst)
+
+        cache = mst_module.node_cache
+        leaves = MST.load(storage=storage, cid=root).leaves()
+        self.assertEqual(100, len(leaves))
+        self.assertEqual(0, cache.hits)
+        self.assertEqual(len(blocks), cache.misses)
+        self.assertEqual(len(blocks), len(cache))
+
+        # a new MST should use the cache instead of reading from storage
+        storage.blocks.clear()
+        self.assertEqual(leaves, MST.load(storage=storage, cid=root).leaves())
+        self.assertEqual(len(blocks), cache.hits)
+        self.assertEqual(len(blocks), cache.misses)
+        self.assertEqual(0, cache.evictions)
+
+    def test_get_unstored_blocks_checks_each_layer_once(self):
+        storage = MemoryStorage()
+        mst = MST.create(storage=storage)
+        for key, cid in self.random_keys_and_cids(1000):
+            mst = mst.add(key, cid)
+        root, blocks = self.store(mst)
+        layers = mst.get_layer() + 1
+
+        mst = MST.load(storage=storage, cid=root).add(
+            'com.example.record/3jqfcqzm3fo2j', CID1)
+        with patch.object(storage, 'has') as mock_has, \
+             patch.object(storage, 'has_many', wraps=storage.has_many) as mock_has_many:
+            _, blocks = mst.get_unstored_blocks()
+
+        mock_has.assert_not_called()
+        self.assertLessEqual(mock_has_many.call_count, layers + 1)
+        self.assertLessEqual(len(blocks), layers + 1)
+        self.assertEqual(set(blocks) | {CID1}, Diff.of(mst, MST.load(
+            storage=storage, cid=root)).new_cids)
+
+    def test_walk_batches_reads_by_layer(self):
+        storage = MemoryStorage()
+        mst = MST.create(storage=storage)
+        for key, cid in self.random_keys_and_cids(1000):
+            mst = mst.add(key, cid)
+        root, blocks = self.store(mst)
+        layers = mst.get_layer() + 1
+
+        loaded = MST.load(storage=storage, cid=root)
+        with patch.object(storage, 'read') as mock_read, \
+             patch.object(storage, 'read_many', wraps=storage.read_many) as mock_read_many:
+            self.assertEqual(1000, len(loaded.leaves()))
+
+        mock_read.assert_not_called()
+        self.assertEqual(layers, mock_read_many.call_count)
+        self.assertEqual(len(blocks), sum(len(call.args[0])
+                                          for call in mock_read_many.call_args_list))
+
+    def test_walk_leaves_from_loads_lazily(self):
+        storage = MemoryStorage()
+        keys = [f'com.example.record/{i:04d}' for i in range(2000)]
+        mst = MST.from_sorted_leaves(storage, [Leaf(key, CID1) for key in keys])
+        root, _ = self.store(mst)
+        layers = mst.get_layer() + 1
+
+        mst_module.node_cache.clear()
+        loaded = MST.load(storage=storage, cid=root)
+        loaded.get_entries()
+        with patch.object(storage, 'read') as mock_read, \
+             patch.object(storage, 'read_many', wraps=storage.read_many) as mock_read_many:
+            got = next(loaded.walk_leaves_from(keys[10]))
+
+        self.assertEqual(keys[10], got.key)
+        mock_read.assert_not_called()
+        # below the root, each layer loads at most the subtree it descends
+        # into and its next sibling
+        read = sum(len(call.args[0]) for call in mock_read_many.call_args_list)
+        self.assertLessEqual(read, 2 * (layers - 1))
+
+        self.assertEqual(keys[10:], [leaf.key for leaf in loaded.walk_leaves_from(keys[10])])
+
+    def test_node_cache_evicts(self):
+        cache = NodeCache(maxsize=1000)
+        node = (Leaf('com.example.record/3jqfcqzm3fo2j', CID1), CID1)
+        cache.add(CID1, node)
+        self.assertEqual(0, cache.evictions)
+
+        cid2 = next(dag_cbor.random.rand_cid())
+        cache.add(cid2, node)
+        self.assertEqual(1, cache.evictions)
+        self.assertNotIn(CID1, cache)
+        self.assertEqual(node, cache[cid2])
+
+        # too big
+        cache.add(CID1, node * 10)
+        self.assertNotIn(CID1, cache)
+
+    def test_entries_are_immutable_and_shared(self):
+        a = Leaf('com.example.record/3jqfcqzm3fo2j', CID1)
+        b = Leaf('com.example.record/3jqfcqzm3fp2j', CID1)
+        mst = MST.create(entries=[a])
+
+        entries = mst.get_entries()
+        self.assertEqual((a,), entries)
+        self.assertIs(entries, mst.get_entries())
+
+        self.assertEqual((a, b), mst.append(b).get_entries())
+        self.assertEqual((b, a), mst.prepend(b).get_entries())
+        self.assertEqual((b,), mst.update_entry(0, b).get_entries())
+        self.assertEqual((), mst.remove_entry(0).get_entries())
+        self.assertEqual((a,), mst.get_entries())
+
+    def test_leading_zeros_on_hash(self):
+        # from atproto's interop test fixtures
+        expected = {
+            '': 0,
+            'asdf': 0,
+            'blue': 1,
+            '2653ae71': 0,
+            '88bfafc7': 2,
+            '2a92d355': 4,
+            '884976f5': 6,
+            'app.bsky.feed.post/454397e440ec': 4,
+            'app.bsky.feed.post/9adeb165882c': 8,
+        }
+        for key, layer in expected.items():
+            self.assertEqual(layer, leading_zeros_on_hash(key), key)
+            self.assertEqual(layer, leading_zeros_on_hash(key.encode()), key)
+
+        self.assertEqual(list(expected.values()),
+                         leading_zeros_on_hashes(list(expected.keys())))
+        self.assertEqual([], leading_zeros_on_hashes([]))
+
     def test_common_prefix_length(self):
         self.assertEqual(3, common_prefix_len('abc', 'abc'))
         self.assertEqual(0, common_prefix_len('', 'abc'))
@@ -9,12 +9,19 @@ Daniel Holmgren and Devin Ivy for this code specifically!
 import copy
 from itertools import chain
 import random
+import tempfile
+from unittest.mock import patch
 
 import dag_cbor
 
+from ..caching_storage import CachingStorage
+from ..diff import Change, Diff
+from .. import mst
 from ..server import server
 from ..datastore_storage import DatastoreStorage
+from ..log_storage import LogStorage
 from ..repo import Repo, Write, writes_to_commit_ops
+from ..sqlite_storage import SqliteStorage
 from ..storage import Action, CommitOp, MemoryStorage
 from .. import util
 from ..util import dag_cbor_cid, next_tid, verify_sig
@@ -139,6 +146,114 @@ class RepoTest(TestCase):
         self.repo.apply_writes(writes)
         self.assertEqual(data, self.repo.get_contents())
 
+    def test_collection_counts(self):
+        self.assertEqual({}, self.repo.collection_counts())
+
+        data = {
+            'example.foo': self.random_objects(10),
+            'example.foo.bar': self.random_objects(20),
+            'example.fooo': self.random_objects(30),
+        }
+        self.repo.apply_writes(list(chain(*(
+            [Write(Action.CREATE, coll, tid, obj) for tid, obj in objs.items()]
+            for coll, objs in data.items()))))
+
+        self.assertEqual({coll: len(objs) for coll, objs in data.items()},
+                         self.repo.collection_counts())
+
+    def test_collections(self):
+        self.assertEqual([], self.repo.collections())
+
+        self.repo.apply_writes([
+            Write(Action.CREATE, coll, next_tid(), {'foo': 'bar'})
+            for coll in ('example.fooo', 'example.foo', 'example.foo.bar',
+                         'example.foo')])
+
+        with patch.object(mst.MST, 'count_prefix') as mock_count_prefix, \
+             patch.object(mst.MST, 'leaf_count') as mock_leaf_count:
+            # key order, and '.' sorts before '/'
+            self.assertEqual(['example.foo.bar', 'example.foo', 'example.fooo'],
+                             self.repo.collections())
+
+        mock_count_prefix.assert_not_called()
+        mock_leaf_count.assert_not_called()
+
+    def test_diff(self):
+        objs = list(self.random_objects(100).items())
+        self.repo.apply_writes([Write(Action.CREATE, 'co.ll', tid, obj)
+                                for tid, obj in objs])
+        first = self.repo.head.cid
+        first_mst = self.repo.mst
+
+        writes = ([Write(Action.CREATE, 'co.ll', tid, obj)
+                   for tid, obj in self.random_objects(10).items()]
+                  + [Write(Action.UPDATE, 'co.ll', tid, {'new': 'obj'})
+                     for tid, _ in objs[:10]]
+                  + [Write(Action.DELETE, 'co.ll', tid) for tid, _ in objs[10:20]])
+        self.repo.apply_writes(writes)
+
+        expected = Diff.of(self.repo.mst, first_mst)
+        changes = list(self.repo.diff(first))
+        self.assertEqual(sorted(expected.updated_keys()),
+                         [change.key for change in changes])
+        for change in changes:
+            if change.key in expected.adds:
+                self.assertEqual(Change(change.key, expected.adds[change.key].cid),
+                                 change)
+            elif change.key in expected.deletes:
+                self.assertEqual(Change(change.key, None,
+                                        expected.deletes[change.key].cid), change)
+            else:
+                self.assertEqual(expected.updates[change.key], change)
+
+        # reversed
+        self.assertEqual(
+            [Change(c.key, c.prev, c.cid) for c in changes],
+            list(self.repo.diff(self.repo.head.cid, first)))
+
+        self.assertEqual([], list(self.repo.diff(first, first)))
+        self.assertEqual(100, len(list(self.repo.diff(None, first))))
+
+        with self.assertRaises(ValueError):
+            self.repo.diff(dag_cbor_cid({'x': 'y'}))
+
+    def test_diff_batches_reads(self):
+        self.repo.apply_writes([Write(Action.CREATE, 'co.ll', tid, obj)
+                                for tid, obj in self.random_objects(500).items()])
+        first = self.repo.head.cid
+        self.repo.apply_writes([Write(Action.CREATE, 'co.ll', next_tid(), {'x': 'y'})])
+
+        mst.node_cache.clear()
+        with patch.object(self.storage, 'read') as mock_read, \
+             patch.object(self.storage, 'read_many',
+                          wraps=self.storage.read_many) as mock_read_many:
+            changes = list(self.repo.diff(first))
+
+        self.assertEqual(1, len(changes))
+        mock_read.assert_not_called()
+        # commits, then roots, then at most one per layer
+        self.assertLessEqual(mock_read_many.call_count,
+                             self.repo.mst.get_layer() + 3)
+        # only nodes on the path to the new key, in each tree, plus the commits
+        self.assertLessEqual(
+            sum(len(call.args[0]) for call in mock_read_many.call_args_list),
+            2 * (self.repo.mst.get_layer() + 2))
+
+    def test_create_initial_writes(self):
+        objs = self.random_objects(30)
+        writes = [Write(Action.CREATE, 'co.ll', tid, obj)
+                  for tid, obj in objs.items()]
+        repo = Repo.create(self.storage, 'did:web:other.com', signing_key=self.key,
+                           initial_writes=writes)
+        self.assertEqual({'co.ll': objs}, repo.get_contents())
+
+        # should be the same tree as adding one at a time
+        self.repo.apply_writes(writes)
+        self.assertEqual(self.repo.mst.get_pointer(), repo.mst.get_pointer())
+
+        reloaded = Repo.load(self.storage, repo.head.cid, signing_key=self.key)
+        self.assertEqual({'co.ll': objs}, reloaded.get_contents())
+
     def test_edits_and_deletes_content(self):
         objs = list(self.random_objects(20).items())
 
@@ -214,3 +329,30 @@ class RepoTest(TestCase):
 class DatastoreRepoTest(RepoTest, DatastoreTest):
     """Run all of RepoTest's tests with DatastoreStorage."""
     STORAGE_CLS = DatastoreStorage
+
+
+class SqliteRepoTest(RepoTest):
+    """Run all of RepoTest's tests with SqliteStorage."""
+    STORAGE_CLS = SqliteStorage
+
+
+class CachingRepoTest(RepoTest):
+    """Run all of RepoTest's tests with CachingStorage around MemoryStorage."""
+
+    def setUp(self):
+        self.STORAGE_CLS = lambda: CachingStorage(MemoryStorage())
+        super().setUp()
+
+
+class LogRepoTest(RepoTest):
+    """Run all of RepoTest's tests with LogStorage."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.STORAGE_CLS = lambda: LogStorage(self.dir.name)
+        super().setUp()
+
+    def tearDown(self):
+        self.storage.close()
+        self.dir.cleanup()
+        super().tearDown()
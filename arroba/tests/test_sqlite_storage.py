@@ -0,0 +1,182 @@
+"""Unit tests for sqlite_storage.py."""
+import os
+import sqlite3
+import tempfile
+import threading
+from unittest.mock import patch
+
+from ..repo import Repo, Write
+from .. import sqlite_storage
+from ..sqlite_storage import SqliteStorage
+from ..storage import Action, SUBSCRIBE_REPOS_NSID
+from ..util import dag_cbor_cid, InactiveRepo, next_tid
+
+from . import test_storage
+from .testutil import TestCase
+
+
+class SqliteStorageTest(test_storage.StorageTest):
+    """Run all of StorageTest's tests with SqliteStorage."""
+    STORAGE_CLS = SqliteStorage
+
+
+class SqliteStorageSpecificTest(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'arroba.db')
+        self.storage = SqliteStorage(self.path)
+
+    def tearDown(self):
+        self.storage.close()
+        self.dir.cleanup()
+        super().tearDown()
+
+    def test_wal_mode(self):
+        self.assertEqual('wal', self.storage.db.execute(
+            'PRAGMA journal_mode').fetchone()[0])
+
+    def test_indexes(self):
+        indexes = {row[0] for row in self.storage.db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")}
+        self.assertLessEqual({'blocks_seq', 'blocks_repo_seq', 'repos_handle'},
+                             indexes)
+
+    def test_persists_across_instances(self):
+        repo = Repo.create(self.storage, 'did:web:user.com', handle='han.dull',
+                           signing_key=self.key)
+
+        storage = SqliteStorage(self.path)
+        got = storage.load_repo('han.dull')
+        self.assertEqual('did:web:user.com', got.did)
+        self.assertEqual(repo.head, got.head)
+        self.assertEqual(3, storage.last_seq(SUBSCRIBE_REPOS_NSID))
+        self.assertEqual(4, storage.allocate_seq(SUBSCRIBE_REPOS_NSID))
+        storage.close()
+
+    def test_allocate_seq_threads(self):
+        seqs = []
+
+        def allocate():
+            storage = SqliteStorage(self.path)
+            seqs.extend(storage.allocate_seq('foo') for _ in range(20))
+            storage.close()
+
+        threads = [threading.Thread(target=allocate) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(list(range(1, 101)), sorted(seqs))
+        self.assertEqual(100, self.storage.last_seq('foo'))
+
+    def test_close(self):
+        self.storage.allocate_seq('foo')
+
+        thread = threading.Thread(target=self.storage.allocate_seq, args=('foo',))
+        thread.start()
+        thread.join()
+
+        conns = list(self.storage._conns.values())
+        self.assertEqual(2, len(conns))
+        self.storage.close()
+        for conn in conns:
+            with self.assertRaises(sqlite3.ProgrammingError):
+                conn.execute('SELECT 1')
+
+        # reopens on next use
+        self.assertEqual(3, self.storage.allocate_seq('foo'))
+
+    def test_close_memory(self):
+        storage = SqliteStorage()
+        storage.allocate_seq('foo')
+        keepalive = storage._keepalive
+        storage.close()
+        with self.assertRaises(sqlite3.ProgrammingError):
+            keepalive.execute('SELECT 1')
+
+    def test_timeout(self):
+        with patch.object(sqlite3, 'connect', wraps=sqlite3.connect) as mock_connect:
+            SqliteStorage().close()
+            SqliteStorage(self.path).close()
+
+        self.assertEqual(3, mock_connect.call_count)
+        for call in mock_connect.call_args_list:
+            self.assertEqual(sqlite_storage.TIMEOUT, call.kwargs['timeout'])
+
+    def test_last_seq_new(self):
+        self.assertEqual(0, self.storage.last_seq('foo'))
+        self.assertEqual(1, self.storage.allocate_seq('foo'))
+
+    def test_read_many(self):
+        block = self.storage.write('did:web:user.com', {'foo': 'bar'})
+        other = dag_cbor_cid({'x': 'y'})
+        self.assertEqual({block.cid: block, other: None},
+                         self.storage.read_many([block.cid, other]))
+
+    @patch.object(sqlite_storage, 'MAX_VARIABLES', 2)
+    def test_read_many_and_has_many_chunked(self):
+        blocks = [self.storage.write('did:web:user.com', {'i': i})
+                  for i in range(5)]
+        cids = [block.cid for block in blocks]
+
+        got = self.storage.read_many(cids)
+        self.assertEqual(cids, list(got.keys()))
+        self.assertEqual(blocks, list(got.values()))
+        self.assertEqual({cid: True for cid in cids},
+                         self.storage.has_many(cids))
+
+    def test_apply_commit_keeps_existing_block_seq(self):
+        repo = Repo.create(self.storage, 'did:web:user.com', signing_key=self.key)
+        first_seq = repo.head.seq
+
+        tid = next_tid()
+        repo.apply_writes([Write(Action.CREATE, 'co.ll', tid, {'foo': 'bar'})])
+        repo.apply_writes([Write(Action.DELETE, 'co.ll', tid)])
+
+        # the empty MST node recurs, but keeps its original seq
+        data = self.storage.read(repo.head.cid).decoded['data']
+        self.assertEqual(first_seq, self.storage.read(data).seq)
+        self.assertEqual(repo.head.cid, self.storage.load_repo(repo.did).head.cid)
+
+    def test_apply_commit_inactive_rolls_back(self):
+        repo = Repo.create(self.storage, 'did:web:user.com', signing_key=self.key)
+        commit_data = Repo.format_commit(repo=repo, writes=[
+            Write(Action.CREATE, 'co.ll', next_tid(), {'foo': 'bar'})])
+        self.storage.tombstone_repo(repo)
+
+        with self.assertRaises(InactiveRepo):
+            self.storage.apply_commit(commit_data)
+
+        self.assertIsNone(self.storage.read(commit_data.commit.cid))
+        self.assertFalse(self.storage.db.in_transaction)
+
+    @patch.object(sqlite_storage, 'BLOCKS_PAGE_SIZE', 2)
+    def test_read_blocks_by_seq_pages(self):
+        alice = Repo.create(self.storage, 'did:alice', signing_key=self.key)
+        bob = Repo.create(self.storage, 'did:bob', signing_key=self.key)
+        for repo in alice, bob, alice:
+            repo.apply_writes([Write(Action.CREATE, 'co.ll', next_tid(),
+                                     {'foo': next_tid()})])
+
+        blocks = list(self.storage.read_blocks_by_seq())
+        self.assertEqual(len(set(blocks)), len(blocks))
+        self.assertEqual(sorted(b.seq for b in blocks), [b.seq for b in blocks])
+        self.assertEqual(9, blocks[-1].seq)
+
+        alices = list(self.storage.read_blocks_by_seq(start=2, repo='did:alice'))
+        self.assertEqual({'did:alice'}, {b.repo for b in alices})
+        self.assertEqual([2, 3, 7, 7, 7, 9, 9, 9], [b.seq for b in alices])
+        self.assertEqual(alice.head, alices[-1])
+
+    def test_read_blocks_by_seq_ops(self):
+        repo = Repo.create(self.storage, 'did:web:user.com', signing_key=self.key)
+        repo.apply_writes([Write(Action.CREATE, 'co.ll', 'abc', {'foo': 'bar'})])
+
+        head = list(self.storage.read_blocks_by_seq(start=repo.head.seq))
+        commit = [b for b in head if b == repo.head][0]
+        self.assertEqual(repo.head.ops, commit.ops)
+        self.assertEqual(Action.CREATE, commit.ops[0].action)
+        self.assertEqual('co.ll/abc', commit.ops[0].path)
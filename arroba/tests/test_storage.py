@@ -1,10 +1,12 @@
 """Unit tests for storage.py."""
 import os
+from unittest.mock import patch
 
 import dag_cbor
 from multiformats import CID
 
 from ..repo import Repo, Write
+from .. import storage as storage_module
 from ..storage import Action, Block, MemoryStorage, SUBSCRIBE_REPOS_NSID
 from ..util import dag_cbor_cid, next_tid, DEACTIVATED, TOMBSTONED
 
@@ -16,6 +18,8 @@ CID_ = CID.decode('bafyreiblaotetvwobe7cu2uqvnddr6ew2q3cu75qsoweulzku2egca4dxq')
 
 
 class StorageTest(TestCase):
+    STORAGE_CLS = MemoryStorage
+
     def test_block_encoded(self):
         block = Block(encoded=ENCODED)
         self.assertEqual(DECODED, block.decoded)
@@ -32,8 +36,32 @@ class StorageTest(TestCase):
     def test_block_hash(self):
         self.assertEqual(id(Block(decoded=DECODED)), id(Block(encoded=ENCODED)))
 
+    def test_has_many(self):
+        storage = self.STORAGE_CLS()
+        block = storage.write(repo_did='did:web:user.com', obj=DECODED)
+        other = dag_cbor_cid({'x': 'y'})
+        self.assertEqual({block.cid: True, other: False},
+                         storage.has_many([block.cid, other]))
+        self.assertEqual({}, storage.has_many([]))
+
+    def test_read_blocks_by_seq(self):
+        storage = self.STORAGE_CLS()
+        for seq, repo in ((3, 'did:a'), (1, 'did:b'), (2, 'did:a'),
+                          (5, 'did:b'), (4, 'did:a')):
+            storage.write(repo, {'seq': seq}, seq=seq)
+
+        def seqs(**kwargs):
+            return [block.seq for block in storage.read_blocks_by_seq(**kwargs)]
+
+        self.assertEqual([1, 2, 3, 4, 5], seqs())
+        self.assertEqual([4, 5], seqs(start=4))
+        self.assertEqual([], seqs(start=6))
+        self.assertEqual([2, 3, 4], seqs(repo='did:a'))
+        self.assertEqual([4], seqs(start=4, repo='did:a'))
+        self.assertEqual([], seqs(repo='did:c'))
+
     def test_read_events_by_seq(self):
-        storage = MemoryStorage()
+        storage = self.STORAGE_CLS()
         repo = Repo.create(storage, 'did:web:user.com', signing_key=self.key)
         init = repo.head.cid
 
@@ -60,7 +88,7 @@ class StorageTest(TestCase):
         self.assertEqual([create, delete], [cd.commit.cid for cd in events])
 
     def test_read_events_by_seq_repo(self):
-        storage = MemoryStorage()
+        storage = self.STORAGE_CLS()
         alice = Repo.create(storage, 'did:alice', signing_key=self.key)
         alice_init = alice.head.cid
 
@@ -88,7 +116,7 @@ class StorageTest(TestCase):
         # https://github.com/snarfed/bridgy-fed/issues/1016#issuecomment-2109276344
         commit_cids = []
 
-        storage = MemoryStorage()
+        storage = self.STORAGE_CLS()
         repo = Repo.create(storage, 'did:web:user.com', signing_key=self.key)
         commit_cids.append(repo.head.cid)
 
@@ -113,8 +141,54 @@ class StorageTest(TestCase):
         self.assertEqual(prev, commits[1].prev)
         self.assertEqual(record, commits[1].blocks[record.cid])
 
+    def test_read_events_by_seq_batches_preexisting_records(self):
+        storage = self.STORAGE_CLS()
+        repo = Repo.create(storage, 'did:web:user.com', signing_key=self.key)
+        for _ in range(5):
+            repo.apply_writes([Write(Action.CREATE, 'co.ll', next_tid(),
+                                     {'foo': 'bar'})])
+
+        record = Block(decoded={'foo': 'bar'})
+        with patch.object(storage, 'read') as mock_read, \
+             patch.object(storage, 'read_many',
+                          wraps=storage.read_many) as mock_read_many, \
+             patch.object(storage_module, 'READ_EVENTS_WINDOW', 3):
+            commits = list(storage.read_events_by_seq(start=4))
+
+        self.assertEqual(5, len(commits))
+        for commit in commits:
+            self.assertEqual(record, commit.blocks[record.cid])
+
+        mock_read.assert_not_called()
+        # the first commit stored the record, so it doesn't need to read it.
+        # windows are commits 1-3, then 4-5.
+        self.assertEqual([[record.cid], [record.cid]],
+                         [call.args[0] for call in mock_read_many.call_args_list])
+
+    def test_read_events_by_seq_window_size_1(self):
+        storage = self.STORAGE_CLS()
+        repo = Repo.create(storage, 'did:web:user.com', signing_key=self.key)
+        for _ in range(5):
+            repo.apply_writes([Write(Action.CREATE, 'co.ll', next_tid(),
+                                     {'foo': 'bar'})])
+
+        record = Block(decoded={'foo': 'bar'})
+        with patch.object(storage, 'read_many',
+                          wraps=storage.read_many) as mock_read_many:
+            events = storage.read_events_by_seq(start=4, window_size=1)
+            first = next(events)
+            self.assertEqual(record, first.blocks[record.cid])
+            # the first commit stored the record, so nothing is read yet
+            mock_read_many.assert_not_called()
+
+            rest = list(events)
+
+        self.assertEqual(4, len(rest))
+        self.assertEqual([[record.cid]] * 4,
+                         [call.args[0] for call in mock_read_many.call_args_list])
+
     def test_read_events_tombstone_then_commit(self):
-        storage = MemoryStorage()
+        storage = self.STORAGE_CLS()
         alice = Repo.create(storage, 'did:alice', signing_key=self.key)
 
         storage.tombstone_repo(alice)
@@ -136,7 +210,7 @@ class StorageTest(TestCase):
         self.assertEqual(5, events[4].commit.seq)
 
     def test_read_events_commit_then_tombstone(self):
-        storage = MemoryStorage()
+        storage = self.STORAGE_CLS()
         alice = Repo.create(storage, 'did:alice', signing_key=self.key)
         storage.tombstone_repo(alice)
 
@@ -153,7 +227,7 @@ class StorageTest(TestCase):
         }, events[3])
 
     def test_load_repo(self):
-        storage = MemoryStorage()
+        storage = self.STORAGE_CLS()
         created = Repo.create(storage, 'did:web:user.com', signing_key=self.key)
 
         got = storage.load_repo('did:web:user.com')
@@ -161,8 +235,29 @@ class StorageTest(TestCase):
         self.assertEqual(created.head, got.head)
         self.assertIsNone(got.status)
 
+    def test_load_repo_handle(self):
+        storage = self.STORAGE_CLS()
+        repo = Repo.create(storage, 'did:web:user.com', handle='han.dull',
+                           signing_key=self.key)
+        self.assertEqual('did:web:user.com', storage.load_repo('han.dull').did)
+        self.assertIsNone(storage.load_repo('other.handle'))
+
+        repo.handle = 'new.handle'
+        storage.create_repo(repo, signing_key=self.key)
+        self.assertIsNone(storage.load_repo('han.dull'))
+        self.assertEqual('did:web:user.com', storage.load_repo('new.handle').did)
+
+    def test_load_repo_without_keys(self):
+        storage = self.STORAGE_CLS()
+        repo = Repo.create(storage, 'did:web:user.com', signing_key=self.key)
+        repo.apply_writes([Write(Action.CREATE, 'coll', 'abc', {'foo': 'bar'})])
+
+        loaded = storage.load_repo('did:web:user.com', with_keys=False)
+        self.assertEqual(repo.head, loaded.head)
+        self.assertEqual({'foo': 'bar'}, loaded.get_record('coll', 'abc'))
+
     def test_load_repos(self):
-        storage = MemoryStorage()
+        storage = self.STORAGE_CLS()
         alice = Repo.create(storage, 'did:web:alice', signing_key=self.key)
         bob = Repo.create(storage, 'did:plc:bob', signing_key=self.key)
         storage.tombstone_repo(bob)
@@ -177,7 +272,7 @@ class StorageTest(TestCase):
         self.assertEqual('tombstoned', got_bob.status)
 
     def test_load_repos_after(self):
-        storage = MemoryStorage()
+        storage = self.STORAGE_CLS()
         Repo.create(storage, 'did:web:alice', signing_key=self.key)
         Repo.create(storage, 'did:plc:bob', signing_key=self.key)
 
@@ -193,7 +288,7 @@ class StorageTest(TestCase):
         self.assertEqual([], got)
 
     def test_load_repos_limit(self):
-        storage = MemoryStorage()
+        storage = self.STORAGE_CLS()
         Repo.create(storage, 'did:web:alice', signing_key=self.key)
         Repo.create(storage, 'did:plc:bob', signing_key=self.key)
 
@@ -206,7 +301,7 @@ class StorageTest(TestCase):
 
     def test_tombstone_repo(self):
         seen = []
-        storage = MemoryStorage()
+        storage = self.STORAGE_CLS()
         repo = Repo.create(storage, 'did:user', signing_key=self.key)
         self.assertEqual(3, storage.last_seq(SUBSCRIBE_REPOS_NSID))
 
@@ -229,7 +324,7 @@ class StorageTest(TestCase):
 
     def test_deactivate_repo(self):
         seen = []
-        storage = MemoryStorage()
+        storage = self.STORAGE_CLS()
         repo = Repo.create(storage, 'did:user', signing_key=self.key)
         self.assertEqual(3, storage.last_seq(SUBSCRIBE_REPOS_NSID))
 
@@ -252,7 +347,7 @@ class StorageTest(TestCase):
 
     def test_activate_repo(self):
         seen = []
-        storage = MemoryStorage()
+        storage = self.STORAGE_CLS()
         repo = Repo.create(storage, 'did:user', signing_key=self.key,
                            status=DEACTIVATED)
         self.assertEqual(3, storage.last_seq(SUBSCRIBE_REPOS_NSID))
@@ -275,7 +370,7 @@ class StorageTest(TestCase):
         self.assertIsNone(storage.load_repo('did:user').status)
 
     def test_write_event(self):
-        storage = MemoryStorage()
+        storage = self.STORAGE_CLS()
         repo = Repo.create(storage, 'did:user', signing_key=self.key)
         self.assertEqual(3, storage.last_seq(SUBSCRIBE_REPOS_NSID))
 
@@ -290,3 +385,45 @@ class StorageTest(TestCase):
             'status': 'foo',
         }, block.decoded)
         self.assertEqual(block, storage.read(block.cid))
+
+
+class MemoryStorageTest(TestCase):
+
+    def test_load_repo_handle_changed_directly(self):
+        storage = MemoryStorage()
+        repo = Repo.create(storage, 'did:web:user.com', handle='han.dull',
+                           signing_key=self.key)
+        self.assertIs(repo, storage.load_repo('han.dull'))
+
+        repo.handle = 'new.handle'
+        self.assertIsNone(storage.load_repo('han.dull'))
+        # not indexed yet
+        self.assertIsNone(storage.load_repo('new.handle'))
+
+        storage.create_repo(repo, signing_key=self.key)
+        self.assertIsNone(storage.load_repo('han.dull'))
+        self.assertIs(repo, storage.load_repo('new.handle'))
+        self.assertEqual(['did:web:user.com'], [r.did for r in storage.load_repos()])
+
+    def test_load_repo_unknown(self):
+        storage = MemoryStorage()
+        Repo.create(storage, 'did:web:user.com', handle='han.dull',
+                    signing_key=self.key)
+        self.assertIsNone(storage.load_repo('did:web:other.com'))
+        self.assertIsNone(storage.load_repo('other.handle'))
+
+    def test_load_repos_pages(self):
+        storage = MemoryStorage()
+        dids = [f'did:plc:{i:02d}' for i in range(20)]
+        for did in reversed(dids):
+            Repo.create(storage, did, signing_key=self.key)
+
+        got = []
+        after = None
+        while page := storage.load_repos(after=after, limit=7):
+            got.extend(repo.did for repo in page)
+            after = page[-1].did
+        self.assertEqual(dids, got)
+
+        self.assertEqual(dids[11:18], [repo.did for repo in storage.load_repos(
+            after='did:plc:10x', limit=7)])
@@ -40,6 +40,15 @@ class XrpcRepoTest(testutil.XrpcTestCase):
         resp = xrpc_repo.describe_repo({}, repo='did:web:user.com')
         self.assertEqual('did:web:user.com', resp['did'])
         self.assertEqual('han.dull', resp['handle'])
+        self.assertEqual([], resp['collections'])
+
+        self.repo.apply_writes([
+            Write(action=Action.CREATE, collection=coll, rkey=rkey,
+                  record={'foo': 'bar'})
+            for coll, rkey in [('a.b', '1'), ('a.b', '2'), ('a.bc', '3'),
+                               ('x.y', '4')]])
+        resp = xrpc_repo.describe_repo({}, repo='did:web:user.com')
+        self.assertEqual(['a.b', 'a.bc', 'x.y'], resp['collections'])
 
     # based on atproto/packages/pds/tests/crud.test.ts
     def test_create_record(self):
@@ -69,6 +78,33 @@ class XrpcRepoTest(testutil.XrpcTestCase):
         self.assertEqual(1, len(resp['records']))
         self.assertEqual('Hello, world!', resp['records'][0]['value']['text'])
 
+    def test_list_records_reverse(self):
+        repo = server.load_repo('did:web:user.com')
+        repo.apply_writes([
+            Write(action=Action.CREATE, collection=coll, rkey=rkey,
+                  record={'foo': rkey})
+            for coll, rkey in [('test.coll', 'a'), ('test.coll', 'b'),
+                               ('test.coll', 'c'), ('test.coll0', 'd'),
+                               ('test.col', 'e')]])
+
+        resp = xrpc_repo.list_records({}, repo='did:web:user.com',
+                                      collection='test.coll', reverse=True)
+        self.assertEqual(['c', 'b', 'a'],
+                         [r['value']['foo'] for r in resp['records']])
+        self.assertNotIn('cursor', resp)
+
+        resp = xrpc_repo.list_records({}, repo='did:web:user.com',
+                                      collection='test.coll', reverse=True,
+                                      limit=2)
+        self.assertEqual(['c', 'b'], [r['value']['foo'] for r in resp['records']])
+        self.assertEqual('test.coll/b', resp['cursor'])
+
+        # cursor is inclusive
+        resp = xrpc_repo.list_records({}, repo='did:web:user.com',
+                                      collection='test.coll', reverse=True,
+                                      cursor='test.coll/b')
+        self.assertEqual(['b', 'a'], [r['value']['foo'] for r in resp['records']])
+
     def test_list_records_encodes_cids_blobs(self):
         repo = server.load_repo('did:web:user.com')
 
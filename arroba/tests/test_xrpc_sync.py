@@ -1,6 +1,7 @@
 """Unit tests for xrpc_sync.py."""
 from datetime import timedelta
 from io import BytesIO
+import itertools
 from threading import Semaphore, Thread
 import time
 from unittest import skip
@@ -179,16 +180,58 @@ class XrpcSyncTest(testutil.XrpcTestCase):
             'rev': '2222222222622',
         }, resp)
 
+    def assertRecordProof(self, path, obj, head, car_bytes):
+        """Checks that a CAR proves that a record is in a commit."""
+        roots, blocks = read_car(car_bytes)
+        self.assertEqual([head.cid], roots)
+        self.assertEqual(head, blocks[0])
+        self.assertTrue(util.verify_sig(blocks[0].decoded, self.key.public_key()))
+        self.assertEqual(obj, blocks[-1].decoded)
+
+        # each block should be linked from the previous one, following the path
+        # through the MST to the record
+        self.assertEqual(blocks[1].cid, blocks[0].decoded['data'])
+        for parent, child in zip(blocks[1:-1], blocks[2:]):
+            self.assertIn(child.cid, [parent.decoded['l']] + list(
+                itertools.chain(*((e['v'], e['t']) for e in parent.decoded['e']))))
+
+        key = b''
+        leaves = {}
+        for entry in blocks[-2].decoded['e']:
+            key = key[:entry['p']] + entry['k']
+            leaves[key.decode()] = entry['v']
+        self.assertEqual(blocks[-1].cid, leaves[path])
+
     def test_get_record(self):
         path, obj = next(iter(self.data.items()))
         coll, rkey = path.split('/')
         resp = xrpc_sync.get_record({}, did='did:web:user.com', collection=coll,
                                     rkey=rkey)
+        self.assertRecordProof(path, obj, self.repo.head, resp)
 
-        expected = Block(decoded=obj)
-        roots, blocks = read_car(resp)
-        self.assertEqual([expected.cid], roots)
-        self.assertEqual([expected], blocks)
+    def test_get_record_commit(self):
+        path, obj = next(iter(self.data.items()))
+        coll, rkey = path.split('/')
+        old_head = self.repo.head
+
+        self.repo.apply_writes([Write(Action.UPDATE, coll, rkey, {'new': 'obj'})])
+        resp = xrpc_sync.get_record({}, did='did:web:user.com', collection=coll,
+                                    rkey=rkey, commit=old_head.cid.encode('base32'))
+        self.assertRecordProof(path, obj, old_head, resp)
+
+        resp = xrpc_sync.get_record({}, did='did:web:user.com', collection=coll,
+                                    rkey=rkey)
+        self.assertRecordProof(path, {'new': 'obj'}, self.repo.head, resp)
+
+    def test_get_record_commit_not_found(self):
+        path, obj = next(iter(self.data.items()))
+        coll, rkey = path.split('/')
+
+        for commit in ('nope', dag_cbor_cid(obj).encode('base32'),
+                       dag_cbor_cid({'x': 'y'}).encode('base32')):
+            with self.assertRaises(ValueError):
+                xrpc_sync.get_record({}, did='did:web:user.com', collection=coll,
+                                     rkey=rkey, commit=commit)
 
     def test_get_record_not_found(self):
         with self.assertRaises(ValueError):
@@ -23,6 +23,7 @@ from multiformats import CID
 import requests
 
 from ..datastore_storage import DatastoreStorage
+from .. import mst
 from ..repo import Repo
 from .. import server
 from ..storage import MemoryStorage
@@ -111,6 +112,8 @@ class TestCase(unittest.TestCase):
         did.resolve_handle.cache.clear()
         did.resolve_plc.cache.clear()
         did.resolve_web.cache.clear()
+        mst.node_cache.clear()
+        mst.leaf_count_cache.clear()
 
         os.environ.setdefault('PDS_HOST', 'localhost:8080')
         os.environ.setdefault('PLC_HOST', 'plc.bsky-sandbox.dev')
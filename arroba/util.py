@@ -15,7 +15,7 @@ from cryptography.hazmat.primitives.asymmetric.utils import (
     decode_dss_signature,
     encode_dss_signature,
 )
-from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import hashes, serialization
 import dag_cbor
 import jwt
 from multiformats import CID, multicodec, multihash
@@ -275,6 +275,36 @@ def new_key(seed=None):
         return ec.generate_private_key(ec.SECP256K1())
 
 
+def private_key_pem(key):
+    """Serializes a private key to unencrypted PKCS8 PEM.
+
+    Args:
+      key (ec.EllipticCurvePrivateKey or None)
+
+    Returns:
+      bytes or None:
+    """
+    if key:
+        return key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption(),
+        )
+
+
+def load_private_key(pem):
+    """Loads a private key from PEM.
+
+    Args:
+      pem (bytes or None)
+
+    Returns:
+      ec.EllipticCurvePrivateKey or None:
+    """
+    if pem:
+        return serialization.load_pem_private_key(pem, password=None)
+
+
 def sign(obj, private_key):
     """Signs an object, eg a repo commit or DID document.
 
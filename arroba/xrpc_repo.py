@@ -50,7 +50,7 @@ def get_record(input, repo=None, collection=None, rkey=None, cid=None):
         raise ValueError(f'cid not supported yet')
 
     try:
-        repo = server.load_repo(input['repo'])
+        repo = server.load_repo(input['repo'], with_keys=False)
         record = repo.get_record(collection, rkey)
         if record is not None:
             return json.loads(dag_json.encode({
@@ -115,17 +115,21 @@ def list_records(input, repo=None, collection=None, limit=50, cursor=None,
 
     if rkeyStart or rkeyEnd:
         raise ValueError(f'rkeyStart/rkeyEnd not supported')
-    elif reverse:
-        raise ValueError(f'reverse not supported yet')
     elif not collection:
         raise ValueError(f'collection is required')
 
-    repo = server.load_repo(input['repo'])
+    repo = server.load_repo(input['repo'], with_keys=False)
+
+    prefix = f'{collection}/'
+    if reverse:
+        # '0' is the character right after '/', so every key in this collection
+        # is less than this
+        leaves = repo.mst.walk_leaves_backwards_from(key=cursor or f'{collection}0')
+    else:
+        leaves = repo.mst.walk_leaves_from(key=cursor or prefix)
 
-    start = cursor or f'{collection}/'
     entries = list(itertools.islice(
-        itertools.takewhile(lambda entry: entry.key.startswith(f'{collection}/'),
-                            repo.mst.walk_leaves_from(key=start)),
+        itertools.takewhile(lambda entry: entry.key.startswith(prefix), leaves),
         limit))
     blocks = server.storage.read_many([e.value for e in entries])
     records = [blocks[e.value].decoded for e in entries]
@@ -172,16 +176,13 @@ def put_record(input):
 def describe_repo(input, repo=None):
     """Handler for ``com.atproto.repo.describeRepo`` XRPC method."""
     validate(input, repo=repo)
-    repo = server.load_repo(input['repo'])
+    repo = server.load_repo(input['repo'], with_keys=False)
 
     return {
         'did': repo.did,
         'handle': repo.handle,
         'didDoc': {'TODO': 'TODO'},
-        'collections': [
-            'app.bsky.actor.profile',
-            'TODO',
-        ],
+        'collections': repo.collections(),
         'handleIsCorrect': True,
     }
 
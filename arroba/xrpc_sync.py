@@ -14,6 +14,8 @@ from multiformats import CID
 from multiformats.multibase import MultibaseKeyError, MultibaseValueError
 
 from .datastore_storage import AtpBlock, AtpRemoteBlob, AtpRepo, DatastoreStorage
+from .mst import MST
+from .repo import Repo
 from . import server
 from .storage import CommitData, SUBSCRIBE_REPOS_NSID
 from . import util
@@ -40,7 +42,7 @@ def get_checkout(input, did=None):
 @server.server.method('com.atproto.sync.getRepo')
 def get_repo(input, did=None, since=None):
     """Handler for ``com.atproto.sync.getRepo`` XRPC method."""
-    repo = server.load_repo(did)
+    repo = server.load_repo(did, with_keys=False)
     start = util.tid_to_int(since) if since else 0
 
     blocks_and_head = itertools.chain(
@@ -54,7 +56,7 @@ def get_repo(input, did=None, since=None):
 def get_repo_status(input, did=None):
     """Handler for ``com.atproto.sync.getRepoStatus`` XRPC method."""
     try:
-        repo = server.load_repo(did)
+        repo = server.load_repo(did, with_keys=False)
     except XrpcError as e:
         if e.name == 'RepoDeactivated':
             return {
@@ -197,7 +199,10 @@ def subscribe_repos(cursor=None):
         with new_events:
             new_events.wait(timeout_s)
 
-        for commit_data in server.storage.read_events_by_seq(start=cur_seq + 1):
+        # we stop at the first gap, so yield each event as soon as it's read
+        # instead of assembling whole windows that we may not serve
+        for commit_data in server.storage.read_events_by_seq(start=cur_seq + 1,
+                                                             window_size=1):
             last_seq = cur_seq
             event = handle(commit_data)
 
@@ -221,7 +226,7 @@ def subscribe_repos(cursor=None):
 @server.server.method('com.atproto.sync.getBlocks')
 def get_blocks(input, did=None, cids=()):
     """Handler for ``com.atproto.sync.getBlocks`` XRPC method."""
-    repo = server.load_repo(did)
+    repo = server.load_repo(did, with_keys=False)
 
     try:
         cids = [CID.decode(cid) for cid in cids]
@@ -247,7 +252,7 @@ def get_head(input, did=None):
 
     Deprecated! Use ``getLatestCommit`` instead.
     """
-    repo = server.load_repo(did)
+    repo = server.load_repo(did, with_keys=False)
     return {
         'root': repo.head.cid.encode('base32'),
     }
@@ -256,7 +261,7 @@ def get_head(input, did=None):
 @server.server.method('com.atproto.sync.getLatestCommit')
 def get_latest_commit(input, did=None):
     """Handler for ``com.atproto.sync.getLatestCommit`` XRPC method."""
-    repo = server.load_repo(did)
+    repo = server.load_repo(did, with_keys=False)
     return {
         'cid': repo.head.cid.encode('base32'),
         'rev': repo.head.decoded['rev'],
@@ -267,21 +272,35 @@ def get_latest_commit(input, did=None):
 def get_record(input, did=None, collection=None, rkey=None, commit=None):
     """Handler for ``com.atproto.sync.getRecord`` XRPC method.
 
-    TODO:
+    Returns a CAR with the commit, the MST nodes on the path from its root to
+    the record, and the record itself, so that clients can verify the record
+    without fetching the whole repo.
 
-    * implement commit
-    * merge with xrpc_repo.get_record?
+    TODO: merge with xrpc_repo.get_record?
     """
-    if commit:
-        raise ValueError('commit not supported yet')
+    repo = server.load_repo(did, with_keys=False)
 
-    repo = server.load_repo(did)
-    record = repo.get_record(collection, rkey)
-    if record is None:
+    if commit:
+        try:
+            commit_cid = CID.decode(commit)
+        except (MultibaseKeyError, MultibaseValueError):
+            raise ValueError(f'Invalid commit CID {commit}')
+
+        block = server.storage.read(commit_cid)
+        if not (block and block.decoded.get('did') == repo.did
+                and block.decoded.get('data')):
+            raise ValueError(f'Commit {commit} not found in {repo.did}')
+
+        mst = MST.load(storage=server.storage, cid=block.decoded['data'])
+        repo = Repo(storage=server.storage, mst=mst, head=block,
+                    handle=repo.handle, signing_key=repo.signing_key)
+
+    blocks, record = repo.get_record_proof(collection, rkey)
+    if not record:
         raise ValueError(f'{collection} {rkey} not found')
 
-    block = car.Block(decoded=record)
-    return car.write_car([block.cid], [block])
+    return car.write_car([repo.head.cid], (car.Block(cid=block.cid, data=block.encoded)
+                                           for block in blocks))
 
 
 @server.server.method('com.atproto.sync.getBlob')